@@ -11,37 +11,129 @@
 # 
 
 import sys                          # for CLI argument parsing
+import argparse                     # for CLI argument parsing
+import time                         # for per-pass timing
+import os                           # for JIT runtime library and stdout capture
+import ctypes                       # for calling JIT-compiled main
+import subprocess                   # for compiling runtime.c
+import tempfile                     # for capturing stdout of JIT-compiled programs
+import threading                    # for compilations running concurrently in threads
+import multiprocessing              # for parallel codegen
+from concurrent.futures import ProcessPoolExecutor  # for parallel codegen
+import socketserver                 # for the compile server
+import signal                       # for stopping the compile server
+import json                         # for the compile server protocol
+import io                           # for capturing the output of server requests
+import traceback                    # for reporting server request errors
+import hashlib                      # for fingerprints of incremental compilation
+from collections import OrderedDict # for the LRU cache of incremental compilation
+import shutil                       # for the compilation cache
+import fcntl                        # for the compilation cache shared by processes
 import llvmlite.binding as llvm     # for llvmlite IR generation
 import llvmlite.ir as ir            # for llvmlite IR generation
-import pydot                        # for .dot file parsing
+import re                           # for .dot file parsing
+import mmap                         # for loading binary ASTs without copying
+import struct                       # for the header of binary ASTs
+import logging                      # for debug messages of the compiler
+import tracemalloc                  # for peak memory of the passes (--stats)
+from contextlib import contextmanager, nullcontext   # for the spans of CompileStats
+from array import array             # for compact AST storage
 from enum import Enum               # for enum in python
+from types import GeneratorType     # for handlers driven by walk()
+
+# Debug messages of the compiler, off unless --log-level asks for them. Pass the values as arguments
+# (logger.debug("binop %s %s", left, right)) so that nothing is formatted when the level is disabled
+logger = logging.getLogger("a4")
+log_lock = threading.Lock()
+log_levels = {}     # [dict of int: int] level of the compilations logging through request_logging(), by thread ident
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+log_handler.setLevel(logging.WARNING)
+log_handler.addFilter(lambda record: record.thread not in log_levels)
+logger.addHandler(log_handler)
+logger.setLevel(logging.WARNING)
+logger.propagate = False
+
+@contextmanager
+def request_logging(level, stream):
+    """
+    Send the debug messages of the current thread at this level to stream, without changing the other threads,
+    e.g. the concurrent requests of the compile server each log to their own stderr
+
+    Args:
+        - level(int): logging level, e.g. logging.DEBUG
+        - stream(file): stderr of the compilation
+    """
+    thread = threading.get_ident()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(log_handler.formatter)
+    handler.setLevel(level)
+    handler.addFilter(lambda record: record.thread == thread)
+    with log_lock:
+        log_levels[thread] = level
+        logger.addHandler(handler)
+        # the logger lets through the lowest level asked for, each handler keeps the messages of its thread
+        logger.setLevel(min(list(log_levels.values()) + [logging.WARNING]))
+    try:
+        yield
+    finally:
+        with log_lock:
+            logger.removeHandler(handler)
+            del log_levels[thread]
+            logger.setLevel(min(list(log_levels.values()) + [logging.WARNING]))
+
+class IRReference:
+    """
+    Argument of a debug message formatting an IR value as its type and reference (e.g. i32 %"addtmp"),
+    str() of a value would format the whole instruction or function, and llvmlite keeps that text
+    even if the value changes afterwards (e.g. a phi waiting for its incoming values)
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value              # [ir.Value]
+
+    def __str__(self):
+        return "%s %s" % (self.value.type, self.value.get_reference())
 
-DEBUG = False
+class Symbol:
+    """
+    Entry of the symbol table for one declaration of an identifier
+    """
+    __slots__ = ("lexeme", "datatype", "scope_id", "unique_name", "shadowed", "value")
+
+    def __init__(self, lexeme, datatype, scope_id, shadowed=None):
+        self.lexeme = lexeme            # [str] lexeme of the identifier
+        self.datatype = datatype        # [DataType] type of the identifier
+        self.scope_id = scope_id        # [int] ID of the scope declaring it
+        self.unique_name = lexeme + "-" + str(scope_id)     # [str] unique name used for IR codegen
+        self.shadowed = shadowed        # [Symbol] declaration of the same lexeme in an outer scope, hidden by this one
+        self.value = None               # [ir.Value] LLVM value of the identifier, filled in IR codegen
 
 class SymbolTable:
     """
-    Symbol table is a stack of maps, and each map represents a scope
+    Symbol table is one map from lexeme to the innermost visible Symbol of that lexeme, and each
+    Symbol links to the one it shadows, so a lookup is one dict access whatever the depth of scopes
 
-    The key of map is the lexeme (string, not unique) of an identifier, and the value is its type (DataType)
+    Each scope keeps an undo log of the lexemes it declared, and pop_scope unlinks them from the map
 
-    The size of self.scopes and self.scope_ids should always be the same
+    The size of self.undo_logs and self.scope_ids should always be the same
     """
     def __init__(self):
         """
         Initialize the symbol table with no scope inside
         """
         self.id_counter = 0      # Maintain an increment counter for each newly pushed scope
-        self.scopes = []         # map<str, DataType> from lexeme to data type in one scope
+        self.symbols = {}        # map<str, Symbol> from lexeme to its innermost visible declaration
+        self.undo_logs = []      # lexemes declared in each scope, unlinked when it is popped
         self.scope_ids = []      # stores the ID for each scope
-        # self.scopes_llvm = []
-        # self.scope_ids_llvm = []      # stores the ID for each scope for llwm
-        self.index_name = {}
 
     def print(self):
-        for table_idx in range(len(self.scopes) - 1, -1, -1):
-            for x in self.scopes[table_idx]:
-                print(table_idx, x, self.scopes[table_idx][x])
-            
+        for lexeme, symbol in self.symbols.items():
+            while symbol is not None:
+                logger.debug("%s %s %s", symbol.scope_id, lexeme, symbol.datatype)
+                symbol = symbol.shadowed
+
     def push_scope(self):
         """
         Push a new scope to symbol table
@@ -50,8 +142,7 @@ class SymbolTable:
             - (int) the ID of the newly pushed scope
         """
         self.id_counter += 1
-        # self.scopes_llvm.append({})
-        self.scopes.append({})   # push a new table (mimics the behavior of stack)
+        self.undo_logs.append([])
         self.scope_ids.append(self.id_counter)
         return self.id_counter
 
@@ -59,7 +150,12 @@ class SymbolTable:
         """
         Pop a scope out of symbol table, usually called when the semantic analysis for one scope is finished
         """
-        self.scopes.pop()    # pop out the last table (mimics the behavior of stack)
+        for lexeme in self.undo_logs.pop():
+            shadowed = self.symbols[lexeme].shadowed
+            if shadowed is None:
+                del self.symbols[lexeme]
+            else:
+                self.symbols[lexeme] = shadowed
         self.scope_ids.pop()
 
     def unique_name(self, lexeme, scope_id):
@@ -75,31 +171,45 @@ class SymbolTable:
         """
         return lexeme + "-" + str(scope_id)
 
-    def insert(self, lexeme, type, index=-1):
+    def insert(self, lexeme, type):
         """
-        Insert a new symbol to the top scope of symbol table
+        Insert a new symbol to the top scope of symbol table, replacing a symbol of the same lexeme in that scope
 
         Args:
             - lexeme(str): lexeme of the symbol
             - type(DataType): type of the symbol
         
         Returns:
-            - (str): the unique ID of the symbol
+            - (Symbol): the inserted symbol
         """
         # check the size of scopes and scope_id
-        if len(self.scopes) != len(self.scope_ids):
+        if len(self.undo_logs) != len(self.scope_ids):
             raise ValueError("Mismatch size of symbol_table and id_table")
-        scope_idx = len(self.scopes) - 1
-        self.scopes[scope_idx][lexeme] = type
-        # self.scopes_llvm[scope_idx][lexeme] = self.scope_ids[scope_idx]
-        if lexeme == 'main':
-            unique_name = lexeme
+        scope_id = self.scope_ids[-1]
+        shadowed = self.symbols.get(lexeme)
+        if shadowed is not None and shadowed.scope_id == scope_id:
+            shadowed = shadowed.shadowed
         else:
-            unique_name = self.unique_name(lexeme, self.scope_ids[scope_idx])
-        self.index_name[index] = self.scope_ids[scope_idx]
-        return unique_name
-    
-    def lookup_local(self, lexeme, index):
+            self.undo_logs[-1].append(lexeme)
+        symbol = Symbol(lexeme, type, scope_id, shadowed)
+        self.symbols[lexeme] = symbol
+        return symbol
+
+    def lookup(self, lexeme):
+        """
+        Lookup the innermost visible declaration of a lexeme
+        called when we want to search a lexeme or declare a global variable
+
+        Args:
+            - lexeme(str): lexeme of the symbol
+
+        Returns:
+            - Symbol if the symbol is found
+            - None if the symbol is not found
+        """
+        return self.symbols.get(lexeme)
+
+    def lookup_local(self, lexeme):
         """
         Lookup a symbol in the top scope of symbol table only
         called when we want to declare a new local variable
@@ -108,68 +218,364 @@ class SymbolTable:
             - lexeme(str): lexeme of the symbol
 
         Returns:
-            - (str, DataType): 2D tuple of unique_id and data type if the symbol is found
+            - Symbol if the symbol is found in the top scope
             - None if the symbol is not found
         """
-        if len(self.scopes) != len(self.scope_ids):
+        if len(self.undo_logs) != len(self.scope_ids):
             raise ValueError("Mismatch size of symbol_table and id_table")
-        table_idx = len(self.scopes) - 1
-        if lexeme in self.scopes[table_idx]:
-            unique_name = self.unique_name(lexeme, self.scope_ids[table_idx])
-            type = self.scopes[table_idx][lexeme]
-            self.index_name[index] = self.scope_ids[table_idx]
-            return unique_name, type
-        else:
+        symbol = self.symbols.get(lexeme)
+        if symbol is None or symbol.scope_id != self.scope_ids[-1]:
             return None
+        return symbol
 
-    def lookup_global_llvm(self, lexeme, index):
-        if index in self.index_name:
-            return self.index_name[index]
-        else:
-            return 1
-    
-    def lookup_global(self, lexeme, index):
+class PooledString:
+    """
+    One distinct string literal of a StringPool
+    """
+    __slots__ = ("constant", "variable", "uses")
+
+    def __init__(self, constant):
+        self.constant = constant        # [ir.Constant] NUL-terminated i8 array of the literal
+        self.variable = None            # [ir.GlobalVariable] private unnamed_addr constant, made on first use as a pointer
+        self.uses = 0                   # number of times the literal is used in the program
+
+class StringPool:
+    """
+    Constant pool of the string literals of one module
+
+    Each distinct literal is converted to an ir.Constant once, and has at most one global constant
+    (named constant0, constant1, ... in order of first use), shared by every use of the literal
+    """
+    def __init__(self, module):
+        self.module = module
+        self.strings = {}       # map<str, PooledString> from the lexeme of the literal
+        self.counter = 0        # number of global constants made, gives the next name
+        self.lexemes = {}       # map<str, str> lexeme of the literal of each global constant, by its name
+        self.used = None        # when a list, (lexeme, whether its global constant is used) of each use is appended to it (see incremental_codegen)
+
+    def intern(self, lexeme):
         """
-        Lookup a symbol in all the scopes of symbol table (stack)
-        called when we want to search a lexeme or declare a global variable
+        Returns:
+            - PooledString: the entry of a literal, counting one use
+        """
+        entry = self.strings.get(lexeme)
+        if entry is None:
+            s = (lexeme + '\0').replace('\\n', '\n')
+            value = bytearray(s.encode("utf8"))
+            entry = self.strings[lexeme] = PooledString(ir.Constant(ir_type(DataType.STRING, len(value)), value))
+        entry.uses += 1
+        if self.used is not None:
+            self.used.append((lexeme, False))
+        return entry
+
+    def constant(self, lexeme):
+        """
+        Returns:
+            - ir.Constant: the i8 array of a literal
+        """
+        return self.intern(lexeme).constant
 
+    def variable(self, lexeme, count=True):
+        """
         Args:
-            - lexeme(str): lexeme of the symbol
+            - lexeme(str)
+            - count(bool): False when the use was already counted by constant()
 
         Returns:
-            - (str, DataType): 2D tuple of unique_id and data type if the symbol is found
-            - None if the symbol is not found
+            - ir.GlobalVariable: the global constant of a literal
         """
-        if len(self.scopes) != len(self.scope_ids):
-            raise ValueError("Mismatch size of symbol_table and id_table")
-        for table_idx in range(len(self.scopes) - 1, -1, -1):
-            if lexeme in self.scopes[table_idx]:
-                unique_name = self.unique_name(lexeme, self.scope_ids[table_idx])
-                type = self.scopes[table_idx][lexeme]
-                self.index_name[index] = self.scope_ids[table_idx]
-                return unique_name, type
-        return None
+        entry = self.intern(lexeme) if count else self.strings[lexeme]
+        if entry.variable is None:
+            variable = ir.GlobalVariable(self.module, entry.constant.type, name='constant' + str(self.counter))
+            self.counter += 1
+            variable.initializer = entry.constant
+            variable.linkage = "private"
+            variable.unnamed_addr = True
+            variable.global_constant = True
+            entry.variable = variable
+            self.lexemes[variable.name] = lexeme
+        if self.used is not None:
+            self.used.append((lexeme, True))
+        return entry.variable
+
+    def reference(self, variable):
+        """
+        Record a use of a global constant through a global string variable bound to it (see codegen_handler_global_decl),
+        so that incremental_codegen renames it in the cached IR as the uses of literals
+        """
+        if self.used is not None and variable.name in self.lexemes:
+            self.used.append((self.lexemes[variable.name], True))
+
+    def stats(self):
+        """
+        Returns:
+            - (int, int, int): uses of literals, distinct literals, and bytes of constants saved by sharing them
+        """
+        uses = sum(entry.uses for entry in self.strings.values())
+        saved = sum((entry.uses - 1) * len(entry.constant.constant) for entry in self.strings.values())
+        return uses, len(self.strings), saved
+
+def print_string_stats(string_stats, file=sys.stderr):
+    uses, distinct, saved = string_stats
+    print("string pool: %d literals, %d distinct, %d bytes saved" % (uses, distinct, saved), file=file)
 
-# Global Symbol Table for Semantic Analysis
-symbol_table = SymbolTable()
+DEFAULT_VIZ_MAX_NODES = 2000   # nodes drawn by the visualize pass at most, see snapshot_tree()
+
+class CompileOptions:
+    """
+    Options of one compilation, the CLI flags of a4.py map to these attributes
+    """
+    def __init__(self, png_path=None, ll_path=None, print_ir=False, codegen=True, compact=False,
+                 opt_level=None, opt_passes=None, run=False, enable=(), disable=(), incremental=False,
+                 merged_path=None, cache_dir=None, cache_size=None, ssa=False, native=(), viz_depth=None,
+                 viz_subtree=None, viz_functions=(), viz_max_nodes=DEFAULT_VIZ_MAX_NODES, stats=False, trace_path=None,
+                 codegen_jobs=1, analyze_jobs=1, stream=False):
+        self.png_path = png_path        # [str] visualize the AST into this file (.png, .svg, .dot, ...), None to skip
+        self.ll_path = ll_path          # [str] write the LLVM IR into this file, None to skip
+        self.print_ir = print_ir        # [bool] print the LLVM IR to stdout
+        self.codegen = codegen          # [bool] False to only load (and visualize) the parser AST
+        self.compact = compact          # [bool] store the AST in a CompactTree
+        self.opt_level = opt_level      # [str] key of OPT_LEVELS, None to skip optimization
+        self.opt_passes = opt_passes    # [list of str] names in OPT_PASSES, run instead of opt_level
+        self.run = run                  # [bool] JIT-compile and run main
+        self.enable = list(enable)      # [list of str] extra passes to enable
+        self.disable = list(disable)    # [list of str] passes to disable
+        self.incremental = incremental  # [bool] reuse the IR of functions unchanged since an earlier compilation
+        self.merged_path = merged_path  # [str] link the IR with runtime.ll and write it into this file, None to skip
+        self.cache_dir = cache_dir      # [str] directory of the ArtifactCache, None to not cache
+        self.cache_size = cache_size    # [int] bytes the ArtifactCache may use, None for DEFAULT_CACHE_SIZE
+        self.ssa = ssa                  # [bool] keep int/bool locals in SSA values instead of allocas
+        self.native = list(native)      # [list of (str, str, str)] (target in NATIVE_TARGETS, "asm" or "obj", path) to emit
+        self.viz_depth = viz_depth      # [int] limits of the visualization, see snapshot_tree()
+        self.viz_subtree = viz_subtree  # [int]
+        self.viz_functions = list(viz_functions)    # [list of str]
+        self.viz_max_nodes = viz_max_nodes          # [int]
+        self.stats = stats              # [bool] collect the time, peak memory and counters of each pass and handler (CompileStats)
+        self.trace_path = trace_path    # [str] write the passes as Chrome trace events into this .json file, None to skip
+        self.codegen_jobs = codegen_jobs    # [int] lower the function bodies in this many worker processes, 1 for serial codegen (see parallel_codegen)
+        self.analyze_jobs = analyze_jobs    # [int] check the function bodies in this many worker processes, 1 to check them in-process (see parallel_check_functions)
+        self.stream = stream            # [bool] compile and write the IR one function at a time in bounded memory (see pass_stream)
+
+class CompilationContext:
+    """
+    All the state of compiling one program, so that one process can compile many programs,
+    one after another or concurrently in threads
 
-# Global Context of LLVM IR Code Generation
-module = ir.Module()                    # Global LLVM IR Module
-builder = ir.IRBuilder()                # Global LLVM IR Builder
-ir_map = {}                             # Global Map from unique names to its LLVM IR item
+    It is passed to every handler of semantic analysis and IR codegen as ctx
+    """
+    def __init__(self, dot_path, options, out=None):
+        self.dot_path = dot_path
+        self.options = options
+        self.out = out if out is not None else sys.stdout   # file the print pass writes the IR to
+        # Symbol Table for Semantic Analysis
+        self.symbol_table = SymbolTable()
+        # Context of LLVM IR Code Generation
+        self.module = ir.Module()               # LLVM IR Module
+        self.builder = ir.IRBuilder()           # LLVM IR Builder
+        self.ir_map = {}                        # Map from unique names to its LLVM IR item
+        self.builtin_symbols = {}               # Symbol of each built-in function, see declare_builtin_symbols()
+        self.string_pool = StringPool(self.module)  # constants of the string literals
+        self.ssa_defs = {} if options.ssa else None # map<Symbol, ir.Value> current definition of each SSA local at the builder position, None without SSA
+        self.llvm_context = None                # llvm.LLVMContext used to parse the module, private to this compilation
+        self.fragment_cache = None              # FragmentCache of incremental compilation, None to compile everything
+        self.declarations = []                  # list of DeclarationPlan of incremental compilation
+        self.merged_ir = None                   # IR linked with runtime.ll by the link pass
+        self.merged_module = None               # llvm.ModuleRef of merged_ir
+        self.native_artifacts = {}              # map<str, bytes> from artifact name to the assembly/object emitted by the native pass
+        self.visualization = None               # Visualization started by the visualize pass, until it is waited for
+        self.cache_key = None                   # key of the compilation in the ArtifactCache
+        self.skipped_passes = set()             # passes whose results were restored from the ArtifactCache
+        # Results of the passes
+        self.root_node = None
+        self.llvm_module = None                 # llvm.ModuleRef after the optimize pass
+        self.ir_text = None                     # output IR, see output_ir()
+        self.exit_code = 0
+        self.stdout = ""
+        self.timings = []                       # list of (pass name, seconds)
+        self.stats = CompileStats(options.stats) if options.stats or options.trace_path else None   # CompileStats, None unless asked for
+
+    def get_llvm_context(self):
+        if self.llvm_context is None:
+            self.llvm_context = llvm.create_context()
+        return self.llvm_context
+
+class CompilationResult:
+    """
+    What compile_dot() returns, plain data so that it can be sent between processes
+    """
+    def __init__(self, dot_path, ir_text, exit_code=0, stdout="", timings=(), string_stats=(0, 0, 0), stats=None):
+        self.dot_path = dot_path        # [str] input .dot file
+        self.ir_text = ir_text          # [str] output LLVM IR (optimized if requested), None without codegen or when streamed
+        self.exit_code = exit_code      # [int] exit code of main in run mode
+        self.stdout = stdout            # [str] stdout of the program in run mode
+        self.timings = list(timings)    # [list of (str, float)] seconds spent in each pass
+        self.string_stats = string_stats  # [(int, int, int)] StringPool.stats() of the module
+        self.stats = stats              # [CompileStats] with --stats or --trace, None otherwise
 
 class TreeNode:
+    # slots instead of __dict__, so each node only stores the six fields below
+    __slots__ = ("index", "lexeme", "symbol", "nodetype", "datatype", "children")
+
     def __init__(self, index, lexeme):
         self.index = index              # [int] ID of the TreeNode, used for visualization 
         self.lexeme = lexeme            # [str] lexeme of the node (may have naming conflicts, and needs unique name in IR codegen)
-        self.id = ""                    # [str] unique name of the node (used in IR codegen), filled in semantic analysis
+        self.symbol = None              # [Symbol] declaration an ID node refers to, filled in semantic analysis and used in IR codegen
         self.nodetype = NodeType.NONE   # [NodeType] type of node, used to determine which actions to do with the current node in semantic analysis or IR codegen
         self.datatype = DataType.NONE   # [DataType] data type of node, filled in semantic analysis and used in IR codegen
         self.children = []              # Array of childern TreeNodes
 
+    @property
+    def id(self):
+        # [str] unique name of the node (used in IR codegen)
+        return self.symbol.unique_name if self.symbol is not None else ""
+
     def add_child(self, child_node):
         self.children.append(child_node)
 
+class TreeNodeBuilder:
+    """
+    Build an AST of TreeNode objects from the node and edge records of a .dot file
+    """
+    def __init__(self):
+        self.nodes = []
+
+    def add_node(self, index, nodetype, lexeme):
+        tree_node = TreeNode(index, lexeme)
+        tree_node.nodetype = nodetype
+        self.nodes.append(tree_node)
+
+    def add_edge(self, src_id, dst_id):
+        self.nodes[src_id].children.append(self.nodes[dst_id])
+
+    def root(self):
+        # root node should always be the first node
+        return self.nodes[0]
+
+class CompactTree:
+    """
+    Struct-of-arrays storage of the AST, used instead of TreeNode objects for large programs
+
+    Node i is described by nodetypes[i], datatypes[i] and lexemes[lexeme_ids[i]], and its children are
+    child_index[child_start[i]:child_start[i + 1]] (CSR layout). Handlers see the nodes through CompactNode.
+
+    CompactTree is also the builder of itself: add_node/add_edge while reading, then root()
+    """
+    def __init__(self):
+        self.nodetypes = array("B")     # position of the NodeType in NODE_TYPES
+        self.datatypes = array("B")     # value of the DataType
+        self.lexeme_ids = array("I")    # offset of the lexeme in self.lexemes
+        self.lexemes = []               # lexeme table, each distinct lexeme is stored once
+        self.lexeme_table = {}          # map<str, int> from lexeme to its offset in self.lexemes
+        self.symbols = []               # Symbol of each node (None but for ID nodes), filled by root()
+        self.child_start = array("I")   # CSR row offsets, filled by root()
+        self.child_index = array("I")   # CSR column indices, filled by root()
+        self.edge_src = array("I")      # edges in reading order, released by root()
+        self.edge_dst = array("I")
+
+    def __len__(self):
+        return len(self.nodetypes)
+
+    def intern(self, lexeme):
+        lexeme_id = self.lexeme_table.get(lexeme)
+        if lexeme_id is None:
+            lexeme_id = len(self.lexemes)
+            self.lexemes.append(lexeme)
+            self.lexeme_table[lexeme] = lexeme_id
+        return lexeme_id
+
+    def add_node(self, index, nodetype, lexeme):
+        self.nodetypes.append(nodetype.position)
+        self.datatypes.append(DataType.NONE.value)
+        self.lexeme_ids.append(self.intern(lexeme))
+
+    def add_edge(self, src_id, dst_id):
+        self.edge_src.append(src_id)
+        self.edge_dst.append(dst_id)
+
+    def root(self):
+        """
+        Build the CSR child index from the edges read so far (stable counting sort by parent)
+
+        Returns:
+            - CompactNode: view of the root node
+        """
+        size = len(self.nodetypes)
+        child_start = array("I", bytes(4 * (size + 1)))
+        for src_id in self.edge_src:
+            child_start[src_id + 1] += 1
+        for i in range(size):
+            child_start[i + 1] += child_start[i]
+        child_index = array("I", bytes(4 * len(self.edge_dst)))
+        fill = array("I", child_start[:size])
+        for src_id, dst_id in zip(self.edge_src, self.edge_dst):
+            child_index[fill[src_id]] = dst_id
+            fill[src_id] += 1
+        self.child_start, self.child_index = child_start, child_index
+        self.edge_src, self.edge_dst = array("I"), array("I")
+        self.symbols = [None] * size
+        return CompactNode(self, 0)
+
+class CompactNode:
+    """
+    Thin view of one node of a CompactTree with the same attributes as TreeNode
+    """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def lexeme(self):
+        return self.tree.lexemes[self.tree.lexeme_ids[self.index]]
+
+    @lexeme.setter
+    def lexeme(self, lexeme):
+        self.tree.lexeme_ids[self.index] = self.tree.intern(lexeme)
+
+    @property
+    def symbol(self):
+        return self.tree.symbols[self.index]
+
+    @symbol.setter
+    def symbol(self, symbol):
+        self.tree.symbols[self.index] = symbol
+
+    @property
+    def id(self):
+        symbol = self.tree.symbols[self.index]
+        return symbol.unique_name if symbol is not None else ""
+
+    @property
+    def nodetype(self):
+        return NODE_TYPES[self.tree.nodetypes[self.index]]
+
+    @nodetype.setter
+    def nodetype(self, nodetype):
+        self.tree.nodetypes[self.index] = nodetype.position
+
+    @property
+    def datatype(self):
+        return DATA_TYPES[self.tree.datatypes[self.index]]
+
+    @datatype.setter
+    def datatype(self, datatype):
+        self.tree.datatypes[self.index] = datatype.value
+
+    @property
+    def children(self):
+        tree = self.tree
+        return [CompactNode(tree, child) for child in
+                tree.child_index[tree.child_start[self.index]:tree.child_start[self.index + 1]]]
+
+    @children.setter
+    def children(self, children):
+        # handlers may reorder children, but the CSR layout cannot grow or shrink one row
+        start, end = self.tree.child_start[self.index], self.tree.child_start[self.index + 1]
+        if len(children) != end - start:
+            raise ValueError("Cannot change the number of children of a compact node: ", self.index)
+        self.tree.child_index[start:end] = array("I", [child.index for child in children])
+
 def print_tree(node, level = 0):
     print("  " * level + '|' + node.lexeme.replace("\n","\\n") + ", " + node.nodetype.name)
     for child in node.children:
@@ -178,54 +584,425 @@ def print_tree(node, level = 0):
     for child in node.children:
         print_tree(child, level + 1)
 
-def visualize_tree(root_node, output_path):
+# AST visualization
+#
+# The visualize pass takes a snapshot of the nodes to draw (their labels and parents) in the main thread,
+# which is cheap, and renders it in a background thread, so codegen goes on while the image is written.
+# The snapshot can be limited to a depth, a subtree or some functions, and is capped to a number of nodes,
+# so that a huge AST still gives a readable image. .dot and .svg files are written by this module, other
+# formats (e.g. .png) are rendered by Graphviz from the DOT text streamed to its stdin.
+
+def node_label(tree_node):
+    """
+    Returns:
+        - list of str: lines of the label of a node
+    """
+    label = [tree_node.nodetype.name]
+    if len(tree_node.id) > 0:
+        label.append(tree_node.id)
+    elif len(tree_node.lexeme) > 0:
+        label.append(tree_node.lexeme)
+    label.append("type: " + tree_node.datatype.name)
+    return label
+
+def find_node(root_node, index):
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        if node.index == index:
+            return node
+        stack.extend(node.children)
+    raise ValueError("No AST node with index: ", index)
+
+def snapshot_tree(root_node, max_depth=None, subtree=None, functions=(), max_nodes=DEFAULT_VIZ_MAX_NODES):
     """
-    Visulize TreeNode in Graphviz
+    Collect the nodes to draw in pre-order
 
     Args:
         - root_node(TreeNode)
-        - output_path(str): the output path for png file 
-    """
-    # construct pydot Node from TreeNode with label
-    def pydot_node(tree_node):
-        node = pydot.Node(tree_node.index)
-        label = tree_node.nodetype.name
-        if len(tree_node.id) > 0:
-            label += "\n" + tree_node.id.replace("\\n","\/n")
-        elif len(tree_node.lexeme) > 0:
-            label += "\n" + tree_node.lexeme.replace("\\n","\/n")
-        label += "\ntype: " + tree_node.datatype.name
-        node.set("label", label)
-        return node
-    # Recursively visualize node
-    def visualize(node, graph):
-        # Add Root Node Only
-        if node.index == 0:
-            graph.add_node(pydot_node(node))
-        # Add Children Nodes and Edges
-        for child in node.children:
-            graph.add_node(pydot_node(child))
-            graph.add_edge(pydot.Edge(node.index, child.index))
-            visualize(child, graph)
-    # Output visualization png graph
-    graph = pydot.Dot(graph_type="graph")
-    visualize(root_node, graph)
-    graph.write_png(output_path)
-
-def construct_tree_from_dot(dot_filepath):
+        - max_depth(int): draw the nodes up to this depth below the drawn root, None for all
+        - subtree(int): index of the node to draw the subtree of, None for root_node
+        - functions(list of str): draw only these function declarations of the program, empty for all declarations
+        - max_nodes(int): stop after this number of nodes, None or 0 for no limit
+
+    Returns:
+        - list of (str, list of str, str): key, label lines and key of the parent (None for the root) of each node,
+          elided children are drawn as one node saying how many there are
+    """
+    root = find_node(root_node, subtree) if subtree is not None else root_node
+    records = []
+    stack = [(root, None, 0)]
+    while stack:
+        node, parent, depth = stack.pop()
+        if max_nodes and len(records) >= max_nodes:
+            records.append(("truncated", ["... %d more subtrees" % (len(stack) + 1), "(max %d nodes)" % max_nodes], parent))
+            break
+        key = str(node.index)
+        records.append((key, node_label(node), parent))
+        children = node.children
+        if functions and node.nodetype == NodeType.PROGRAM:
+            children = [child for child in children
+                        if child.nodetype == NodeType.FUNC_DECL and child.children[1].lexeme in functions]
+        if max_depth is not None and depth >= max_depth:
+            if children:
+                records.append((key + "_more", ["... %d children" % len(children)], key))
+            continue
+        for child in reversed(children):
+            stack.append((child, key, depth + 1))
+    return records
+
+def dot_escape(label):
+    return "\\n".join(line.replace("\\", "\\\\").replace('"', '\\"') for line in label)
+
+def write_dot(records, f):
+    """
+    Write the nodes of snapshot_tree() as an undirected DOT graph, one line at a time
+    """
+    f.write("graph AST {\n")
+    for key, label, parent in records:
+        f.write('n%s [label="%s"];\n' % (key, dot_escape(label)))
+        if parent is not None:
+            f.write("n%s -- n%s;\n" % (parent, key))
+    f.write("}\n")
+
+def xml_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+def write_svg(records, f, font_size=12):
+    """
+    Lay out the nodes of snapshot_tree() as a top-down tree and write it as SVG, without Graphviz
+
+    Leaves take consecutive columns and each parent is centered above its children
+    """
+    if not records:
+        return
+    children = {}
+    for key, _, parent in records:
+        children.setdefault(parent, []).append(key)
+    char_width, line_height = font_size * 0.6, font_size * 1.25
+    column = max(len(line) for _, label, _ in records for line in label) * char_width + 16
+    row = max(len(label) for _, label, _ in records) * line_height + 40
+    # the records are in pre-order: leaves get their columns from left to right,
+    # then in reverse order every parent comes after its children
+    x, depth = {}, {records[0][0]: 0}
+    leaves = 0
+    for key, _, parent in records:
+        if parent is not None:
+            depth[key] = depth[parent] + 1
+        if key not in children:
+            x[key] = leaves * column + column / 2
+            leaves += 1
+    for key, _, _ in reversed(records):
+        kids = children.get(key)
+        if kids:
+            x[key] = (x[kids[0]] + x[kids[-1]]) / 2
+    width, height = leaves * column, (max(depth.values()) + 1) * row
+    f.write('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="monospace" font-size="%d">\n'
+            % (width, height, font_size))
+    lines = {key: len(label) for key, label, _ in records}
+    for key, _, parent in records:
+        if parent is not None:
+            f.write('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="black"/>\n' % (
+                x[parent], depth[parent] * row + 20 + lines[parent] * line_height, x[key], depth[key] * row + 20))
+    for key, label, parent in records:
+        box_width = max(len(line) for line in label) * char_width + 8
+        left, top = x[key] - box_width / 2, depth[key] * row + 20
+        f.write('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="white" stroke="black"/>\n' % (
+            left, top, box_width, len(label) * line_height))
+        for i, line in enumerate(label):
+            f.write('<text x="%.1f" y="%.1f" text-anchor="middle">%s</text>\n' % (
+                x[key], top + (i + 0.85) * line_height, xml_escape(line)))
+    f.write("</svg>\n")
+
+def render_tree(records, output_path):
+    """
+    Write the nodes of snapshot_tree() into output_path, the format is given by its extension
+    """
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension in (".dot", ".svg"):
+        with open(output_path, "w") as f:
+            (write_dot if extension == ".dot" else write_svg)(records, f)
+        return
+    graphviz = subprocess.Popen(["dot", "-T" + (extension[1:] or "png"), "-o", output_path],
+                                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    dot_text = io.StringIO()
+    write_dot(records, dot_text)
+    # communicate() reads the warnings of dot while writing, a full stderr pipe would block both processes
+    _, errors = graphviz.communicate(dot_text.getvalue().encode("utf8"))
+    if graphviz.returncode != 0:
+        raise ValueError("Graphviz failed to render: ", output_path, errors.decode(errors="replace").strip())
+
+class Visualization:
+    """
+    Rendering of an AST snapshot in a background thread
+    """
+    def __init__(self, records, output_path):
+        self.output_path = output_path
+        self.error = None               # [Exception] raised by the rendering, raised again by wait()
+        self.thread = threading.Thread(target=self.render, args=(records,), name="visualize")
+        self.thread.start()
+
+    def render(self, records):
+        try:
+            render_tree(records, self.output_path)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def visualize_tree(root_node, output_path, **limits):
+    """
+    Visualize the AST into output_path (.dot, .svg, or any format of Graphviz), and wait for it
+
+    Args:
+        - root_node(TreeNode)
+        - output_path(str)
+        - limits: keyword arguments of snapshot_tree()
+    """
+    render_tree(snapshot_tree(root_node, **limits), output_path)
+
+def construct_tree_from_dot(dot_filepath, compact=False):
     """
     Read .dot file, which records the AST from parser
 
+    The file is first read by the streaming reader for the format written by
+    export_parse_tree_to_dot in node.cpp; pydot is only used for hand-written .dot files.
+    A binary AST written by export_parse_tree_to_binary (parser output ending with .ast)
+    is recognized by its magic and loaded by construct_tree_from_binary instead, and
+    an Oat program (.oat) is parsed in-process by parse_oat
+
+    Args:
+        - dot_filepath(str): path of the .dot file (or binary .ast file, or .oat program)
+        - compact(bool): store the AST in a CompactTree instead of TreeNode objects
+
+    Return:
+        - TreeNode (or CompactNode if compact): the root node of the AST
+    """
+    if dot_filepath.endswith(".oat"):
+        with open(dot_filepath, "rb") as f:
+            return parse_oat(f.read(), compact)
+    with open(dot_filepath, "rb") as f:
+        if f.read(len(BINARY_AST_MAGIC)) == BINARY_AST_MAGIC:
+            return construct_tree_from_binary(dot_filepath, compact)
+    tree_builder = CompactTree() if compact else TreeNodeBuilder()
+    if not stream_tree_from_dot(dot_filepath, tree_builder):
+        tree_builder = CompactTree() if compact else TreeNodeBuilder()
+        pydot_tree_from_dot(dot_filepath, tree_builder)
+    return tree_builder.root()
+
+# Binary AST format written by export_parse_tree_to_binary in node.cpp (see node.hpp for the layout):
+# magic, version, label count, node count, edge count, string count, string bytes
+BINARY_AST_MAGIC = b"OAST"
+BINARY_AST_VERSION = 1
+BINARY_AST_HEADER = struct.Struct("<4sHHIIII")
+
+def construct_tree_from_binary(ast_filepath, compact=False):
+    """
+    Load a binary AST written by the parser
+
+    The file is mapped with mmap, and its sections are used in place through memoryview casts: a CompactTree
+    keeps the lexeme ids and the child index of the file as its own arrays (the mapping is copy-on-write,
+    so handlers can still reorder children), only the node types are translated and the distinct strings decoded.
+
+    Args:
+        - ast_filepath(str): path of the .ast file
+        - compact(bool): return a CompactTree instead of TreeNode objects
+
+    Return:
+        - TreeNode (or CompactNode if compact): the root node of the AST
+    """
+    with open(ast_filepath, "rb") as f:
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+    return tree_from_binary(data, compact, ast_filepath)
+
+def tree_from_binary(data, compact=False, source="<memory>"):
+    """
+    Build the AST from the bytes of a binary AST, see construct_tree_from_binary
+
+    Args:
+        - data(memoryview): the binary AST, writable if compact, its sections are used in place
+        - compact(bool): return a CompactTree instead of TreeNode objects
+        - source(str): where data comes from, for error messages
+
+    Return:
+        - TreeNode (or CompactNode if compact): the root node of the AST
+    """
+    if len(data) < BINARY_AST_HEADER.size:
+        raise ValueError("Truncated binary AST: ", source)
+    magic, version, label_count, node_count, edge_count, string_count, string_bytes = BINARY_AST_HEADER.unpack_from(data)
+    if magic != BINARY_AST_MAGIC or version != BINARY_AST_VERSION:
+        raise ValueError("Unsupported binary AST version: ", source, version)
+    label_bytes = (node_count + 3) // 4 * 4
+    sections = {}
+    offset = BINARY_AST_HEADER.size
+    for name, size in (("labels", label_bytes), ("lexemes", 4 * node_count), ("child_start", 4 * (node_count + 1)),
+                       ("child_index", 4 * edge_count), ("string_offsets", 4 * (string_count + 1)), ("strings", string_bytes)):
+        if offset + size > len(data):
+            raise ValueError("Truncated binary AST: ", source)
+        sections[name] = data[offset:offset + size]
+        offset += size
+    for name in ("lexemes", "child_start", "child_index", "string_offsets"):
+        if sys.byteorder == "little":
+            sections[name] = sections[name].cast("I")
+        else:
+            sections[name] = array("I", sections[name])
+            sections[name].byteswap()
+    string_offsets, string_data = sections["string_offsets"], sections["strings"]
+    strings = [str(string_data[string_offsets[i]:string_offsets[i + 1]], "utf8") for i in range(string_count)]
+    # node labels are ids of the first strings, translated into positions in NODE_TYPES with one table lookup per byte
+    translation = bytearray(256)
+    for label_id in range(label_count):
+        translation[label_id] = NODE_TYPE_BY_LABEL.get(strings[label_id], NodeType.NONE).position
+    nodetypes = bytearray(bytes(sections["labels"][:node_count]).translate(translation))
+    lexeme_ids, child_start, child_index = sections["lexemes"], sections["child_start"], sections["child_index"]
+    if compact:
+        tree = CompactTree()
+        tree.nodetypes = nodetypes
+        tree.datatypes = array("B", [DataType.NONE.value]) * node_count
+        tree.lexeme_ids = lexeme_ids
+        tree.lexemes = strings
+        tree.lexeme_table = {lexeme: lexeme_id for lexeme_id, lexeme in enumerate(strings)}
+        tree.child_start, tree.child_index = child_start, child_index
+        tree.symbols = [None] * node_count
+        return CompactNode(tree, 0)
+    nodes = []
+    for index in range(node_count):
+        tree_node = TreeNode(index, strings[lexeme_ids[index]])
+        tree_node.nodetype = NODE_TYPES[nodetypes[index]]
+        nodes.append(tree_node)
+    for index, tree_node in enumerate(nodes):
+        tree_node.children = [nodes[child] for child in child_index[child_start[index]:child_start[index + 1]]]
+    return nodes[0]
+
+# The flex/bison parser built as a shared library next to this file, see parser_binding.cpp
+PARSER_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_SOURCES = ("scanner.cpp", "parser.cpp", "node.cpp", "parser_binding.cpp")
+PARSER_HEADERS = ("parser.hpp", "node.hpp", "parser_binding.hpp")
+PARSER_LIBRARY = os.path.join(PARSER_DIR, "liboatparser.so")
+
+parser_library = None
+parser_lock = threading.Lock()      # the scanner and the parser keep their state in globals
+def load_parser_library(library_path=PARSER_LIBRARY):
+    """
+    Compile the parser into a shared library for the host (only when it is missing or outdated),
+    and load it with ctypes
+
+    Returns:
+        - ctypes.CDLL: the library, loaded once per process
+    """
+    global parser_library
+    with process_lock:
+        if parser_library is not None:
+            return parser_library
+        sources = [os.path.join(PARSER_DIR, name) for name in PARSER_SOURCES]
+        newest = max(os.path.getmtime(path) for path in sources + [os.path.join(PARSER_DIR, name) for name in PARSER_HEADERS])
+        if not os.path.exists(library_path) or os.path.getmtime(library_path) < newest:
+            compiler = os.environ.get("CXX", "g++")
+            subprocess.run([compiler, "-shared", "-fPIC", "-O2", "-w", "-include", os.path.join(PARSER_DIR, "parser_binding.hpp")]
+                           + sources + ["-o", library_path], check=True)
+        library = ctypes.CDLL(library_path)
+        library.oat_parse.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte)),
+                                      ctypes.POINTER(ctypes.c_size_t), ctypes.c_char_p, ctypes.c_size_t]
+        library.oat_parse.restype = ctypes.c_int
+        library.oat_free.argtypes = [ctypes.POINTER(ctypes.c_ubyte)]
+        library.oat_free.restype = None
+        parser_library = library
+        return parser_library
+
+def parse_oat(source, compact=False):
+    """
+    Parse an Oat program in-process with the flex/bison parser
+
+    Args:
+        - source(bytes): the program
+        - compact(bool): return a CompactTree instead of TreeNode objects
+
+    Return:
+        - TreeNode (or CompactNode if compact): the root node of the AST
+
+    Raises:
+        - ValueError: with the messages of the parser, if the program has syntax errors
+    """
+    library = load_parser_library()
+    ast = ctypes.POINTER(ctypes.c_ubyte)()
+    ast_length = ctypes.c_size_t()
+    error = ctypes.create_string_buffer(1024)
+    with parser_lock:
+        status = library.oat_parse(source, len(source), ctypes.byref(ast), ctypes.byref(ast_length), error, len(error))
+    if status != 0:
+        raise ValueError("Syntax error: ", error.value.decode(errors="replace").strip())
+    try:
+        # one copy into Python memory, so that the AST does not depend on the lifetime of the C buffer
+        data = bytearray((ctypes.c_ubyte * ast_length.value).from_address(ctypes.addressof(ast.contents)))
+    finally:
+        library.oat_free(ast)
+    return tree_from_binary(memoryview(data), compact, "<oat>")
+
+# Line formats written by write_parse_tree in node.cpp:
+#   node<i> [label="<label>",lexeme="<lexeme>"];
+#   node<src> -> node<dst>;
+DOT_LINE = re.compile(r'node(\d+) \[label="([^"]*)",lexeme="([^"]*)"\];$|node(\d+) -> node(\d+);$')
+
+def stream_tree_from_dot(dot_filepath, builder):
+    """
+    Read .dot file written by the parser in a single pass, without building a pydot graph
+
+    Nodes are numbered in pre-order by the parser, so node<i> is always the i-th node in the file,
+    and the edges of one parent appear in the left-to-right order of its children.
+
     Args:
         - dot_filepath(str): path of the .dot file
+        - builder(TreeNodeBuilder or CompactTree): receives the nodes and edges
 
     Return:
-        - TreeNode: the root node of the AST
+        - bool: False if the file is not in the format of export_parse_tree_to_dot
+    """
+    node_count = 0
+    node_types = NODE_TYPE_BY_LABEL
+    match_line = DOT_LINE.match
+    add_node, add_edge = builder.add_node, builder.add_edge
+    with open(dot_filepath, "r") as f:
+        if f.readline().strip() != "digraph AST {":
+            return False
+        pending = ""        # node statement whose lexeme contains a raw newline
+        for line in f:
+            if pending:
+                line = pending + line
+                pending = ""
+            match = match_line(line)
+            if match is None:
+                if line.startswith("node") and '"' in line:
+                    pending = line
+                elif line.strip() not in ("}", ""):
+                    return False
+                continue
+            index, label, lexeme, src_id, dst_id = match.groups()
+            if src_id is None:
+                if int(index) != node_count:
+                    return False
+                add_node(node_count, node_types.get(label, NodeType.NONE), lexeme)
+                node_count += 1
+            else:
+                src_id, dst_id = int(src_id), int(dst_id)
+                if src_id >= node_count or dst_id >= node_count:
+                    return False
+                add_edge(src_id, dst_id)
+    return not pending and node_count > 0
+
+def pydot_tree_from_dot(dot_filepath, builder):
+    """
+    Read any .dot file through pydot, used as the fallback of stream_tree_from_dot
+
+    Args:
+        - dot_filepath(str): path of the .dot file
+        - builder(TreeNodeBuilder or CompactTree): receives the nodes and edges
     """
+    import pydot    # only needed for .dot files not written by the parser
     # Extract the first graph from the list (assuming there is only one graph in the file)
     graph = pydot.graph_from_dot_file(dot_filepath)[0]
-    # Initialize Python TreeNode structure
-    nodes = []
     # code_type_map = { member.value: member for member in NodeType }
     # Add nodes
     for node in graph.get_nodes():
@@ -234,19 +1011,13 @@ def construct_tree_from_dot(dot_filepath):
         # print(node.get_attributes(), node.get_attributes()['label'], node.get_attributes()['lexeme'])
         label = node.get_attributes()["label"][1:-1]    # exlcude enclosing quotes
         lexeme = node.get_attributes()['lexeme'][1:-1]  # exclude enclosing quotes
-        tree_node = TreeNode(index, lexeme)
-        tree_node.lexeme = lexeme
-        tree_node.nodetype = { member.value: member for member in NodeType }[label] if any(label == member.value for member in NodeType) else NodeType.NONE
         # if DEBUG: print("Index: ", index, ", lexeme: ", lexeme, ", nodetype: ", tree_node.nodetype)
-
-        nodes.append(tree_node)
+        builder.add_node(index, NODE_TYPE_BY_LABEL.get(label, NodeType.NONE), lexeme)
     # Add Edges
     for edge in graph.get_edges():
         src_id = int(edge.get_source()[4:])
         dst_id = int(edge.get_destination()[4:])
-        nodes[src_id].add_child(nodes[dst_id])
-    # root node should always be the first node
-    return nodes[0]
+        builder.add_edge(src_id, dst_id)
 
 class NodeType(Enum):
     """
@@ -305,6 +1076,14 @@ class NodeType(Enum):
     ID = "ID"
     NONE = "unknown"         # unsupported
 
+# Map from the label written by the parser to NodeType, built once instead of per node
+NODE_TYPE_BY_LABEL = { member.value: member for member in NodeType }
+# NodeType members in definition order, each member knows its position in it, so that CompactTree can store
+# node types as small integers, and dispatch tables can be plain lists indexed without hashing the enum
+NODE_TYPES = tuple(NodeType)
+for position, member in enumerate(NODE_TYPES):
+    member.position = position
+
 class DataType(Enum):
     INT = 1             # INT refers to Int32 type (32-bit Integer)
     BOOL = 2            # BOOL refers to Int1 type (1-bit Integer, 1 for True and 0 for False)
@@ -315,6 +1094,9 @@ class DataType(Enum):
     VOID = 7            # Void, you can choose whether to support it or not
     NONE = 8            # Unknown type, used as initialized value for each TreeNode
 
+# Map from the value of DataType to DataType, used by CompactTree
+DATA_TYPES = { member.value: member for member in DataType }
+
 def ir_type(data_type, array_size = 1):
     map = {
         DataType.INT: ir.IntType(32),       # integer is in 32-bit
@@ -330,7 +1112,7 @@ def ir_type(data_type, array_size = 1):
     else:
         raise ValueError("Unsupported data type: ", data_type)
 
-def declare_runtime_functions():
+def declare_runtime_functions(ctx):
     """
     Declare built-in functions for Oat v.1 Language
     """
@@ -340,139 +1122,207 @@ def declare_runtime_functions():
         [ir.PointerType(ir.IntType(8))])    # args type
     # map function unique name in global scope to the function body
     # the global scope should have scope_id = 1 
-    func = ir.Function(module, func_type, name="array_of_string")
-    ir_map[symbol_table.unique_name(lexeme="array_of_string", scope_id=1)] = func
+    func = ir.Function(ctx.module, func_type, name="array_of_string")
+    ctx.ir_map[ctx.symbol_table.unique_name(lexeme="array_of_string", scope_id=1)] = func
     # char* string_of_array (int32_t *arr)
     func_type = ir.FunctionType(
         ir.PointerType(ir.IntType(8)),      # return type
         [ir.PointerType(ir.IntType(32))])   # args type
-    func = ir.Function(module, func_type, name="string_of_array")
-    ir_map[symbol_table.unique_name("string_of_array", 1)] = func
+    func = ir.Function(ctx.module, func_type, name="string_of_array")
+    ctx.ir_map[ctx.symbol_table.unique_name("string_of_array", 1)] = func
     # int32_t length_of_string (char *str)
     func_type = ir.FunctionType(
         ir.IntType(32),                      # return type
         [ir.PointerType(ir.IntType(8))])    # args type
-    func = ir.Function(module, func_type, name="length_of_string")
-    ir_map[symbol_table.unique_name("length_of_string", 1)] = func
+    func = ir.Function(ctx.module, func_type, name="length_of_string")
+    ctx.ir_map[ctx.symbol_table.unique_name("length_of_string", 1)] = func
     # char* string_of_int(int32_t i)
     func_type = ir.FunctionType(
         ir.PointerType(ir.IntType(8)),      # return type
         [ir.IntType(32)])                   # args type
-    func = ir.Function(module, func_type, name="string_of_int")
-    ir_map[symbol_table.unique_name("string_of_int", 1)] = func
+    func = ir.Function(ctx.module, func_type, name="string_of_int")
+    ctx.ir_map[ctx.symbol_table.unique_name("string_of_int", 1)] = func
     # char* string_cat(char* l, char* r)
     func_type = ir.FunctionType(
         ir.PointerType(ir.IntType(8)),      # return tyoe
         [ir.PointerType(ir.IntType(8)), ir.PointerType(ir.IntType(8))]) # args type
-    func = ir.Function(module, func_type, name="string_cat")
-    ir_map[symbol_table.unique_name("string_cat", 1)] = func
+    func = ir.Function(ctx.module, func_type, name="string_cat")
+    ctx.ir_map[ctx.symbol_table.unique_name("string_cat", 1)] = func
     # void print_string (char* str)
     func_type = ir.FunctionType(
         ir.VoidType(),                      # return type
         [ir.PointerType(ir.IntType(8))])    # args type
-    func = ir.Function(module, func_type, name="print_string")
-    ir_map[symbol_table.unique_name("print_string", 1)] = func
+    func = ir.Function(ctx.module, func_type, name="print_string")
+    ctx.ir_map[ctx.symbol_table.unique_name("print_string", 1)] = func
     # void print_int (int32_t i)
     func_type = ir.FunctionType(
         ir.VoidType(),                      # return type
         [ir.IntType(32)])                   # args type
-    func = ir.Function(module, func_type, name="print_int")
-    ir_map[symbol_table.unique_name("print_int", 1)] = func
+    func = ir.Function(ctx.module, func_type, name="print_int")
+    ctx.ir_map[ctx.symbol_table.unique_name("print_int", 1)] = func
     # void print_bool (int32_t i)
     func_type = ir.FunctionType(
         ir.VoidType(),                      # return type
         [ir.IntType(32)])                   # args type
-    func = ir.Function(module, func_type, name="print_bool")
-    ir_map[symbol_table.unique_name("print_bool", 1)] = func
+    func = ir.Function(ctx.module, func_type, name="print_bool")
+    ctx.ir_map[ctx.symbol_table.unique_name("print_bool", 1)] = func
+    # bind the built-in symbols of semantic analysis to these functions
+    for lexeme, symbol in ctx.builtin_symbols.items():
+        symbol.value = ctx.module.get_global(lexeme)
+
+# Guards the process-wide LLVM state initialized lazily (LLVM itself, runtime library, target machines)
+process_lock = threading.RLock()
+
+llvm_initialized = False
+def initialize_llvm():
+    """
+    Initialize LLVM and the native target once per process
+    """
+    global llvm_initialized
+    with process_lock:
+        if llvm_initialized:
+            return
+        llvm.initialize()
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+        llvm_initialized = True
+
+def walk(ctx, root_node, handler_table):
+    """
+    Visit the AST with an explicit work stack instead of Python recursion
+
+    A handler either returns its result directly (leaf handlers), or is a generator that yields
+    a child node whenever it needs that child visited, and receives the child's result back:
+
+        left = yield node.children[0]
+
+    The code of a generator handler before its first yield runs as the pre-visit of the node
+    (e.g. push_scope), and the code after its last yield as the post-visit (e.g. pop_scope).
+    Only one generator per level of the AST is alive, so the depth is bounded by memory only.
+
+    Args:
+        - root_node(TreeNode)
+        - handler_table(list): handler functions indexed by NodeType.position, see dispatch_table()
+
+    Returns:
+        the result of the handler of root_node
+    """
+    if ctx.stats is not None:
+        return walk_profiled(ctx, root_node, handler_table, ctx.stats.handler_profile())
+    result = handler_table[root_node.nodetype.position](ctx, root_node)
+    if type(result) is not GeneratorType:
+        return result
+    stack = [result]
+    result = None
+    while stack:
+        try:
+            child = stack[-1].send(result)
+        except StopIteration as stop:
+            stack.pop()
+            result = stop.value
+            continue
+        result = handler_table[child.nodetype.position](ctx, child)
+        if type(result) is GeneratorType:
+            stack.append(result)
+            result = None
+    return result
+
+def walk_profiled(ctx, root_node, handler_table, profile):
+    """
+    walk() that also counts the calls of the handler of each NodeType and the time spent in it,
+    not counting the handlers of the children (--stats)
 
-def codegen(node):
+    Args:
+        - profile(dict): map<str, [int, float]> from NodeType name to [calls, seconds], updated in place
     """
-    Recursively do LLVM IR generation
+    clock = time.perf_counter
+
+    def entry(node):
+        calls_seconds = profile.get(node.nodetype.name)
+        if calls_seconds is None:
+            calls_seconds = profile[node.nodetype.name] = [0, 0.0]
+        calls_seconds[0] += 1
+        return calls_seconds
+
+    owner = entry(root_node)
+    start = clock()
+    result = handler_table[root_node.nodetype.position](ctx, root_node)
+    owner[1] += clock() - start
+    if type(result) is not GeneratorType:
+        return result
+    stack = [(result, owner)]
+    result = None
+    while stack:
+        generator, owner = stack[-1]
+        start = clock()
+        try:
+            child = generator.send(result)
+        except StopIteration as stop:
+            owner[1] += clock() - start
+            stack.pop()
+            result = stop.value
+            continue
+        owner[1] += clock() - start
+        owner = entry(child)
+        start = clock()
+        result = handler_table[child.nodetype.position](ctx, child)
+        owner[1] += clock() - start
+        if type(result) is GeneratorType:
+            stack.append((result, owner))
+            result = None
+    return result
+
+def codegen(ctx, node):
+    """
+    Do LLVM IR generation for the subtree of node
 
-    Call corresponding handler function for each NodeType
+    Call corresponding handler function for each NodeType, the traversal is driven by walk()
 
     Different NodeTypes may be mapped to the same handelr function
 
     Args:
         node(TreeNode)
     """
-    codegen_func_map = {
-        NodeType.GLOBAL_DECL: codegen_handler_global_decl,
-        # TODO: add more mappings from NodeType to its handler function of IR generation
-        NodeType.FUNC_DECL: codegen_handler_function_declare,
-        NodeType.VAR_DECL: codegen_handler_variable_declare,
-        # NodeType.TVOID: codegen_handler_void,
-        # NodeType.REF: codegen_handler_string,
-        NodeType.ID: codegen_handler_id,
-        NodeType.FUNC_CALL: codegen_handler_func_call,       
-        NodeType.IF_STMT: codegen_handler_IF,         
-        NodeType.FOR_LOOP: codegen_handler_for,        
-        NodeType.WHILE_LOOP: codegen_handler_while,      
-        NodeType.RETURN: codegen_handler_return,          
-        NodeType.ASSIGN: codegen_handler_assign,         
-        NodeType.EXPS: codegen_handler_exps,     
-        # NodeType.NULL: codegen_handler_void,
-        NodeType.STAR: codegen_handler_binop,
-        NodeType.PLUS: codegen_handler_binop,
-        NodeType.MINUS: codegen_handler_binop,
-        NodeType.INTLITERAL: codegen_handler_int,
-        NodeType.TRUE: codegen_handler_bool,
-        NodeType.FALSE: codegen_handler_bool,
-        NodeType.STRINGLITERAL: codegen_handler_string,
-        NodeType.LSHIFT: codegen_handler_binop,
-        NodeType.RLSHIFT: codegen_handler_binop,
-        NodeType.RASHIFT: codegen_handler_binop,
-        NodeType.LESS: codegen_handler_binop,
-        NodeType.LESSEQ: codegen_handler_binop,
-        NodeType.GREAT: codegen_handler_binop,
-        NodeType.GREATEQ: codegen_handler_binop,
-        NodeType.EQ: codegen_handler_binop,
-        NodeType.NEQ: codegen_handler_binop,
-        NodeType.LAND: codegen_handler_binop,
-        NodeType.LOR: codegen_handler_binop,
-        NodeType.BAND: codegen_handler_binop,
-        NodeType.BOR: codegen_handler_binop,
-        NodeType.TILDE: codegen_handler_uniop,
-        NodeType.NOT: codegen_handler_uniop
-    }
-    codegen_func = codegen_func_map.get(node.nodetype)
-    if codegen_func:
-        return codegen_func(node)
-    else:
-        return codegen_handler_default(node)
+    return walk(ctx, node, CODEGEN_HANDLERS)
 
 # Some sample handler functions for IR codegen
 # TODO: implement more handler functions for various node types
-def codegen_handler_default(node):
+def codegen_handler_default(ctx, node):
+    for child in node.children:
+        yield child
+
+def codegen_handler_program(ctx, node):
+    # global declarations first, the functions may refer to globals declared after them
+    for child in node.children:
+        if child.nodetype != NodeType.FUNC_DECL:
+            yield child
     for child in node.children:
-        codegen(child)
+        if child.nodetype == NodeType.FUNC_DECL:
+            yield child
 
-def codegen_handler_global_decl(node):
+def codegen_handler_global_decl(ctx, node):
     """
     Global variable declaration
     """
     # var_name = node.children[0].lexeme
-    # variable = ir.GlobalVariable(module, typ=ir_type(node.datatype), name=var_name)
+    # variable = ir.GlobalVariable(ctx.module, typ=ir_type(node.datatype), name=var_name)
     # # variable.initializer = ir.Constant(ir_type(node.datatype), )
-    # # ir_map[symbol_table.unique_name(var_name, 1)] = variable
+    # # ctx.ir_map[ctx.symbol_table.unique_name(var_name, 1)] = variable
     # variable = codegen_handler_variable_declare(node)
     # variable.global_constant = True
     # variable.linkage = "private"
     
     
-    var_name = node.children[0].lexeme
-    idx = symbol_table.lookup_global_llvm(var_name, node.children[0].index)
-    identifier = symbol_table.unique_name(var_name, idx)
+    symbol = node.children[0].symbol
+    identifier = symbol.unique_name
     if node.children[0].datatype == DataType.STRING:
-        s = (node.children[1].lexeme + '\0').replace('\\n', '\n')
-        initializer = bytearray(s.encode("utf8"))
-        size = len(initializer)
-    else:
-        size = 1
-    variable = ir.GlobalVariable(module, typ=ir_type(node.children[0].datatype, size), name=identifier)
-    if node.children[0].datatype == DataType.STRING:
-        variable.initializer = ir.Constant(ir_type(node.children[0].datatype, len(initializer)), initializer)
-    elif node.children[0].datatype == DataType.INT:
+        # global strings are constant, so the variable is the pooled constant of the literal
+        variable = ctx.string_pool.variable(node.children[1].lexeme)
+        ctx.ir_map[identifier] = variable
+        symbol.value = variable
+        return variable
+    variable = ir.GlobalVariable(ctx.module, typ=ir_type(node.children[0].datatype), name=identifier)
+    if node.children[0].datatype == DataType.INT:
         variable.initializer = ir.Constant(ir_type(node.children[0].datatype), int(node.children[1].lexeme))
     elif node.childern[0].datatype == DataType.BOOL:
         if node.children[1].nodetype == NodeType.TRUE:
@@ -481,39 +1331,42 @@ def codegen_handler_global_decl(node):
             fg = 0
         variable.initializer = ir.Constant(ir_type(node.children[0].datatype), fg)
     else:
-        print('Var declare to be done:', node.childern[0].datatype)
+        logger.warning("Var declare to be done: %s", node.childern[0].datatype)
         
     variable.linkage = "private"
     variable.global_constant = True    
-    ir_map[identifier] = variable
+    ctx.ir_map[identifier] = variable
+    symbol.value = variable
     return variable
 
-def codegen_handler_variable_declare(node, is_global=0):
+def codegen_handler_variable_declare(ctx, node, is_global=0):
     '''
     Variable Local Declare
     '''
-    var_name = node.children[0].lexeme
-    idx = symbol_table.lookup_global_llvm(var_name, node.children[0].index)
-    identifier = symbol_table.unique_name(var_name, idx)
+    symbol = node.children[0].symbol
+    identifier = symbol.unique_name
+    if ctx.ssa_defs is not None and node.children[0].datatype in SSA_DATATYPES:
+        # no alloca, the initializer is the first definition of the variable
+        initializer = ssa_value(ctx, (yield node.children[1]))
+        ctx.ssa_defs[symbol] = initializer
+        return initializer
     
     if node.children[0].datatype == DataType.STRING:
-        s = (node.children[1].lexeme + '\0').replace('\\n', '\n')
-        initializer = bytearray(s.encode("utf8"))
-        size = len(initializer)
+        initializer = ctx.string_pool.constant(node.children[1].lexeme)
+        size = initializer.type.count
     else:
         size = 1
-    variable = builder.alloca(ir_type(node.children[0].datatype, size), name=identifier)
+    variable = ctx.builder.alloca(ir_type(node.children[0].datatype, size), name=identifier)
     
     
     if node.children[0].datatype == DataType.STRING:
         # LLVM doesn't support initialized as local variables
-        initializer = ir.Constant(ir_type(node.children[0].datatype, size), initializer)
-        builder.store(initializer, variable)
-        ir_map[identifier] = variable
+        ctx.builder.store(initializer, variable)
+        ctx.ir_map[identifier] = variable
     elif node.children[0].datatype == DataType.INT:
         initializer = ir.Constant(ir_type(node.children[0].datatype), int(node.children[1].lexeme))
-        builder.store(initializer, variable)
-        ir_map[identifier] = variable
+        ctx.builder.store(initializer, variable)
+        ctx.ir_map[identifier] = variable
         
     elif node.children[0].datatype == DataType.BOOL:
         if node.children[1].nodetype == NodeType.TRUE:
@@ -521,246 +1374,376 @@ def codegen_handler_variable_declare(node, is_global=0):
         else:
             fg = 0
         initializer = ir.Constant(ir_type(node.children[0].datatype), fg)
-        builder.store(initializer, variable)
-        ir_map[identifier] = variable
+        ctx.builder.store(initializer, variable)
+        ctx.ir_map[identifier] = variable
     else:
-        print('Var declare to be done:', node.childern[0].datatype)
+        logger.warning("Var declare to be done: %s", node.childern[0].datatype)
         
-   
+    symbol.value = variable
     return variable
     
     
 
-def codegen_handler_function_declare(node):
+def codegen_handler_function_declare(ctx, node):
     """
     Function declaration
     """
     ret_type, func_name_str, args, stmts = node.children
     func_name = func_name_str.lexeme
-    idx = symbol_table.lookup_global_llvm(func_name, func_name_str.index)
     if func_name != "main":
-        func_name = symbol_table.unique_name(func_name, idx)
+        func_name = func_name_str.symbol.unique_name
     func_return_type = ir_type(ret_type.datatype)
     func_args_types = [ir_type(arg[0].datatype) for arg in args.children]
     func_type = ir.FunctionType(func_return_type, func_args_types)
     
-    function = ir.Function(module, func_type, name=func_name)
+    function = ir.Function(ctx.module, func_type, name=func_name)
     
     entry_block = function.append_basic_block('entry')
-    builder.position_at_end(entry_block)
+    ctx.builder.position_at_end(entry_block)
+    if ctx.ssa_defs is not None:
+        ctx.ssa_defs = {}
     for i, arg in enumerate(function.args):
         arg.name = args.children[i][1].lexeme
-    codegen(stmts)
-    # builder.ret_void()
-    ir_map[func_name] = function
+    yield stmts
+    # ctx.builder.ret_void()
+    ctx.ir_map[func_name] = function
+    func_name_str.symbol.value = function
 
-def codegen_handler_return(node):
+def codegen_handler_return(ctx, node):
     """
     Handle return 
     """
     if node.children:
-        ret_val = codegen(node.children[0])
+        ret_val = yield node.children[0]
         # ?convert to pointer (bonus)
         # print('return:', ret_val)
-        builder.ret(ret_val)
+        ctx.builder.ret(ret_val)
     else:
-        builder.ret_void()
+        ctx.builder.ret_void()
 
 
-def codegen_handler_id(node, is_lval=0):
+def codegen_handler_id(ctx, node, is_lval=0):
     """
     Handle ID
     """
-    identifier = symbol_table.unique_name(node.lexeme, symbol_table.lookup_global_llvm(node.lexeme, node.index))
-    if identifier in ir_map:
-        ir_entity = ir_map[identifier]
-        print('find id', identifier, ir_entity)
+    symbol = node.symbol
+    if ctx.ssa_defs is not None and symbol in ctx.ssa_defs:
+        return ctx.ssa_defs[symbol]
+    if symbol is not None and symbol.value is not None:
+        identifier = symbol.unique_name
+        ir_entity = symbol.value
+        logger.debug("find id %s %s", identifier, IRReference(ir_entity))
+        if isinstance(ir_entity, ir.GlobalVariable):
+            ctx.string_pool.reference(ir_entity)
         if isinstance(ir_entity, ir.Function) or is_lval:
             return ir_entity
         elif isinstance(ir_entity, ir.GlobalVariable):
             return ir_entity
         else:
-            return builder.load(ir_entity, name=identifier)
+            return ctx.builder.load(ir_entity, name=identifier)
+
+
+# SSA mode (CompileOptions.ssa)
+#
+# Locals of these datatypes live in SSA values instead of allocas: ctx.ssa_defs maps the Symbol of each one
+# to its current definition at the position of the builder. Declarations and assignments replace the
+# definition, IF merge blocks get a phi for each local the branches define differently, and loop headers
+# get a phi for each local assigned in the loop.
+SSA_DATATYPES = (DataType.INT, DataType.BOOL)
 
+def ssa_value(ctx, value):
+    """
+    Returns:
+        - ir.Value: value as the i32 definition of an int/bool local (globals are loaded, comparisons extended)
+    """
+    if isinstance(value.type, ir.PointerType):
+        value = ctx.builder.load(value, name='loadtmp')
+    if value.type == ir.IntType(1):
+        value = ctx.builder.zext(value, ir.IntType(32), name='booltmp')
+    return value
+
+def ssa_merge(ctx, before, incoming):
+    """
+    Merge the definitions at the end of the branches of an IF, the builder is at the start of the merge block
+
+    Args:
+        - before(dict): ctx.ssa_defs before the IF, only these locals are still in scope after it
+        - incoming(list of (dict, ir.Block)): definitions at the end of each branch and its last block
+
+    Returns:
+        - dict: definitions after the IF
+    """
+    defs = {}
+    for symbol in before:
+        values = [branch_defs[symbol] for branch_defs, _ in incoming]
+        if all(value is values[0] for value in values):
+            defs[symbol] = values[0]
+            continue
+        phi = ctx.builder.phi(values[0].type, name=symbol.unique_name)
+        for value, (_, block) in zip(values, incoming):
+            phi.add_incoming(value, block)
+        defs[symbol] = phi
+    return defs
+
+def assigned_symbols(nodes):
+    """
+    Returns:
+        - list of Symbol: locals assigned in the subtrees of nodes, in order of first assignment
+    """
+    assigned = {}
+    stack = list(reversed(nodes))
+    while stack:
+        current = stack.pop()
+        if current.nodetype == NodeType.ASSIGN:
+            assigned[current.children[0].symbol] = None
+        stack.extend(reversed(current.children))
+    return list(assigned)
+
+def ssa_loop_header(ctx, nodes, preheader):
+    """
+    Give each SSA local assigned in the loop a phi at the start of the loop header, the builder is at the start of it
+
+    Args:
+        - nodes(list of TreeNode): subtrees of the loop run after the header (body and increment)
+        - preheader(ir.Block): block entering the loop
 
-def codegen_handler_IF(node):
+    Returns:
+        - list of (Symbol, ir.PhiInstr): phis waiting for their incoming value from the end of the loop
+    """
+    if ctx.ssa_defs is None:
+        return []
+    phis = []
+    for symbol in assigned_symbols(nodes):
+        value = ctx.ssa_defs.get(symbol)
+        if value is None:
+            continue
+        phi = ctx.builder.phi(value.type, name=symbol.unique_name)
+        phi.add_incoming(value, preheader)
+        ctx.ssa_defs[symbol] = phi
+        phis.append((symbol, phi))
+    return phis
+
+def ssa_loop_latch(ctx, phis, header_defs):
+    """
+    Complete the phis of the loop header with the definitions at the end of the loop, which jumps back to the header
+    """
+    if header_defs is None:
+        return
+    for symbol, phi in phis:
+        # nothing formats the phi before this, the debug messages only print references (see IRReference)
+        phi.add_incoming(ctx.ssa_defs[symbol], ctx.builder.block)
+    # the loop exits from the header, where the phis are the definitions
+    ctx.ssa_defs = header_defs
+
+def codegen_condition(ctx, value):
+    """
+    Convert the value of a condition to the i1 taken by cbranch: comparisons are already i1,
+    but bool variables and literals (e.g. folded by fold_constants) are i32
+    """
+    if isinstance(value.type, ir.PointerType):
+        value = ctx.builder.load(value, name='loadtmp')
+    if value.type == ir.IntType(1):
+        return value
+    if isinstance(value, ir.Constant):
+        return ir.Constant(ir.IntType(1), int(value.constant != 0))
+    return ctx.builder.icmp_signed('!=', value, ir.Constant(value.type, 0), name='condtmp')
+
+def codegen_handler_IF(ctx, node):
     """
     Handle if statements 
     """
-    condition = codegen(node.children[0])
+    condition = codegen_condition(ctx, (yield node.children[0]))
     
     
-    if_block = builder.append_basic_block(name="if_block")
+    if_block = ctx.builder.append_basic_block(name="if_block")
     if len(node.children) > 2:
-        else_block = builder.append_basic_block(name="else_block")
+        else_block = ctx.builder.append_basic_block(name="else_block")
     else:
         else_block = None
-    merge_block = builder.append_basic_block(name="merge_block")
-    builder.cbranch(condition, if_block, else_block)
+    merge_block = ctx.builder.append_basic_block(name="merge_block")
+    ctx.builder.cbranch(condition, if_block, else_block)
     
     
-    builder.position_at_end(if_block)
-    codegen(node.children[1])
-    builder.branch(merge_block)
+    before = ctx.ssa_defs
+    incoming = []   # (definitions, block) at the end of each branch, merged with phis in SSA mode
+    ctx.builder.position_at_end(if_block)
+    if before is not None:
+        ctx.ssa_defs = dict(before)
+    yield node.children[1]
+    incoming.append((ctx.ssa_defs, ctx.builder.block))
+    ctx.builder.branch(merge_block)
     
     if else_block:
-        builder.position_at_end(else_block)
-        codegen(node.children[2])
-        builder.branch(merge_block)
-
-    builder.position_at_end(merge_block)
+        ctx.builder.position_at_end(else_block)
+        if before is not None:
+            ctx.ssa_defs = dict(before)
+        yield node.children[2]
+        incoming.append((ctx.ssa_defs, ctx.builder.block))
+        ctx.builder.branch(merge_block)
+
+    ctx.builder.position_at_end(merge_block)
+    if before is not None:
+        ctx.ssa_defs = ssa_merge(ctx, before, incoming)
     
     
 
 
-def codegen_handler_assign(node):
+def codegen_handler_assign(ctx, node):
     """
     Handle assignment 
     """
-    target = codegen_handler_id(node.children[0], 1)  
-    value = codegen(node.children[1])  
-    print('assign: ', target.type, value.type)
-    builder.store(value, target)
+    symbol = node.children[0].symbol
+    if ctx.ssa_defs is not None and symbol in ctx.ssa_defs:
+        ctx.ssa_defs[symbol] = ssa_value(ctx, (yield node.children[1]))
+        return
+    target = codegen_handler_id(ctx, node.children[0], 1)  
+    value = yield node.children[1]
+    logger.debug("assign: %s %s", target.type, value.type)
+    ctx.builder.store(value, target)
 
 
-def codegen_handler_binop(node):
+def codegen_handler_binop(ctx, node):
     """
     Handle binary operators 
     """
-    left = codegen(node.children[0])
-    right = codegen(node.children[1])
+    left = yield node.children[0]
+    right = yield node.children[1]
     if isinstance(left.type, ir.PointerType):
-        left = builder.load(left, name='loadtmp')
+        left = ctx.builder.load(left, name='loadtmp')
     if isinstance(right.type, ir.PointerType):
-        right = builder.load(right, name='loadtmp')
-    print('binop', node, left, right)
+        right = ctx.builder.load(right, name='loadtmp')
+    logger.debug("binop %s %s %s", node.nodetype.name, IRReference(left), IRReference(right))
     if node.nodetype == NodeType.PLUS:
-        return builder.add(left, right, name='addtmp')
+        return ctx.builder.add(left, right, name='addtmp')
     elif node.nodetype == NodeType.MINUS:
-        return builder.sub(left, right, name='subtmp')
+        return ctx.builder.sub(left, right, name='subtmp')
     elif node.nodetype == NodeType.STAR:
-        return builder.mul(left, right, name='multmp')
+        return ctx.builder.mul(left, right, name='multmp')
     elif node.nodetype == NodeType.LSHIFT:
-        return builder.shl(left, right, name='shltmp')
+        return ctx.builder.shl(left, right, name='shltmp')
     elif node.nodetype == NodeType.RLSHIFT:
-        return builder.lshr(left, right, name='lshrtmp')
+        return ctx.builder.lshr(left, right, name='lshrtmp')
     elif node.nodetype == NodeType.RASHIFT:
-        return builder.ashr(left, right, name='ashrtmp')
+        return ctx.builder.ashr(left, right, name='ashrtmp')
     elif node.nodetype == NodeType.LESS:
-        return builder.icmp_signed('<', left, right, name='lesstmp')
+        return ctx.builder.icmp_signed('<', left, right, name='lesstmp')
     elif node.nodetype == NodeType.LESSEQ:
-        return builder.icmp_signed('<=', left, right, name='lesseqtmp')
+        return ctx.builder.icmp_signed('<=', left, right, name='lesseqtmp')
     elif node.nodetype == NodeType.GREAT:
-        return builder.icmp_signed('>', left, right, name='greattmp')
+        return ctx.builder.icmp_signed('>', left, right, name='greattmp')
     elif node.nodetype == NodeType.GREATEQ:
-        return builder.icmp_signed('>=', left, right, name='greateqtmp')
+        return ctx.builder.icmp_signed('>=', left, right, name='greateqtmp')
     elif node.nodetype == NodeType.EQ:
-        return builder.icmp_signed('==', left, right, name='eqtmp')
+        return ctx.builder.icmp_signed('==', left, right, name='eqtmp')
     elif node.nodetype == NodeType.NEQ:
-        return builder.icmp_signed('!=', left, right, name='neqtmp')
+        return ctx.builder.icmp_signed('!=', left, right, name='neqtmp')
     # elif node.nodetype == NodeType.LAND:
     #     codegen_logical_and(left, right)
     # elif node.nodetype == NodeType.LOR:
     #     codegen_logical_or(left, right)
     elif node.nodetype == NodeType.BAND:
-        return builder.and_(left, right, name='bandtmp')
+        return ctx.builder.and_(left, right, name='bandtmp')
     elif node.nodetype == NodeType.BOR:
-        return builder.or_(left, right, name='bortmp')
+        return ctx.builder.or_(left, right, name='bortmp')
         
 
-def codegen_handler_while(node):
+def codegen_handler_while(ctx, node):
     """
     Handle while loops
     """
-    loop_cond_block = builder.append_basic_block('loop_cond')
-    loop_body_block = builder.append_basic_block('loop_body')
-    loop_end_block = builder.append_basic_block('loop_end')
+    loop_cond_block = ctx.builder.append_basic_block('loop_cond')
+    loop_body_block = ctx.builder.append_basic_block('loop_body')
+    loop_end_block = ctx.builder.append_basic_block('loop_end')
 
     # Jump to condition check from current block
-    builder.branch(loop_cond_block)
+    preheader = ctx.builder.block
+    ctx.builder.branch(loop_cond_block)
 
     # Build the condition check
-    builder.position_at_end(loop_cond_block)
-    cond_value = codegen(node.children[0])
-    builder.cbranch(cond_value, loop_body_block, loop_end_block)
+    ctx.builder.position_at_end(loop_cond_block)
+    phis = ssa_loop_header(ctx, node.children[1:], preheader)
+    header_defs = ctx.ssa_defs
+    cond_value = codegen_condition(ctx, (yield node.children[0]))
+    ctx.builder.cbranch(cond_value, loop_body_block, loop_end_block)
 
     # Build the loop body
-    builder.position_at_end(loop_body_block)
-    codegen(node.children[1])  
-    builder.branch(loop_cond_block) 
+    ctx.builder.position_at_end(loop_body_block)
+    if header_defs is not None:
+        ctx.ssa_defs = dict(header_defs)
+    yield node.children[1]
+    ssa_loop_latch(ctx, phis, header_defs)
+    ctx.builder.branch(loop_cond_block) 
 
-    builder.position_at_end(loop_end_block)
+    ctx.builder.position_at_end(loop_end_block)
 
-def codegen_handler_for(node):
+def codegen_handler_for(ctx, node):
     """
     Handle for loops
     """
-    codegen(node.children[0])
-    loop_cond_block = builder.append_basic_block('loop_cond')
-    loop_body_block = builder.append_basic_block('loop_body')
-    loop_increment_block = builder.append_basic_block('loop_inc')
-    loop_end_block = builder.append_basic_block('loop_end')
-
-    builder.branch(loop_cond_block)
-
-    builder.position_at_end(loop_cond_block)
-    cond_value = codegen(node.children[1])
-    builder.cbranch(cond_value, loop_body_block, loop_end_block)
-
-    builder.position_at_end(loop_body_block)
-    codegen(node.children[3])  
-    builder.branch(loop_increment_block)
-
-    builder.position_at_end(loop_increment_block)
-    codegen(node.children[2])  
-    builder.branch(loop_cond_block)
-
-    builder.position_at_end(loop_end_block)
-
-name_idx = 0
-def get_new_name():
-    global name_idx
-    name = 'constant' + str(name_idx)
-    while name in ir_map:
-        name_idx += 1
-        name = 'constant' + str(name_idx)
-    return name
-
-def codegen_handler_func_call(node):
+    yield node.children[0]
+    loop_cond_block = ctx.builder.append_basic_block('loop_cond')
+    loop_body_block = ctx.builder.append_basic_block('loop_body')
+    loop_increment_block = ctx.builder.append_basic_block('loop_inc')
+    loop_end_block = ctx.builder.append_basic_block('loop_end')
+
+    preheader = ctx.builder.block
+    ctx.builder.branch(loop_cond_block)
+
+    ctx.builder.position_at_end(loop_cond_block)
+    phis = ssa_loop_header(ctx, node.children[2:], preheader)
+    header_defs = ctx.ssa_defs
+    cond_value = codegen_condition(ctx, (yield node.children[1]))
+    ctx.builder.cbranch(cond_value, loop_body_block, loop_end_block)
+
+    ctx.builder.position_at_end(loop_body_block)
+    if header_defs is not None:
+        ctx.ssa_defs = dict(header_defs)
+    yield node.children[3]
+    ctx.builder.branch(loop_increment_block)
+
+    ctx.builder.position_at_end(loop_increment_block)
+    yield node.children[2]
+    ssa_loop_latch(ctx, phis, header_defs)
+    ctx.builder.branch(loop_cond_block)
+
+    ctx.builder.position_at_end(loop_end_block)
+
+def codegen_handler_func_call(ctx, node):
     """
     Handle function calls and generate corresponding LLVM IR code.
     """
     func_name = node.children[0].lexeme
-    func = module.get_global(func_name)
+    symbol = node.children[0].symbol
+    func = symbol.value if symbol is not None and symbol.value is not None else ctx.module.get_global(func_name)
     call_args = []
-    for arg in node.children[1].children:
+    arg_nodes = node.children[1].children
+    for arg in arg_nodes:
         if arg.nodetype in [NodeType.STRINGLITERAL, NodeType.INTLITERAL, NodeType.TRUE, NodeType.FALSE]:
-            call_args.append(codegen(arg))
+            call_args.append((yield arg))
         else:
-            call_args.append(codegen_handler_id(arg, 1))
+            call_args.append(codegen_handler_id(ctx, arg, 1))
     expected_type = func.function_type.args
     actual_args = []
     for i, arg in enumerate(call_args):
         expected_type, arg_type = expected_type[i], arg.type
-        print(expected_type, arg_type)
+        logger.debug("argument %s %s", expected_type, arg_type)
         if isinstance(expected_type, ir.PointerType) and isinstance(arg_type, ir.PointerType) and isinstance(arg_type.pointee, ir.ArrayType):
             if expected_type.pointee == ir.IntType(8):
-                print("here", arg)
+                logger.debug("string argument %s", IRReference(arg))
                 zero = ir.Constant(ir.types.IntType(32), 0)
-                variable_pointer = builder.gep(arg, [zero, zero], inbounds=True)
+                variable_pointer = ctx.builder.gep(arg, [zero, zero], inbounds=True)
                 actual_args.append(variable_pointer)
             else:
-                print("To be finish")
+                logger.warning("To be finish: argument of type %s", arg_type)
         elif not isinstance(expected_type, ir.PointerType) and isinstance(arg_type, ir.PointerType):
-            arg = builder.load(arg)
+            arg = ctx.builder.load(arg)
             actual_args.append(arg)
         elif isinstance(expected_type, ir.PointerType) and isinstance(arg_type, ir.ArrayType):
             if expected_type.pointee == ir.IntType(8):
                 # print("goes this way")
-                variable_pointer = ir.GlobalVariable(module, arg_type, name=get_new_name())
-                variable_pointer.initializer = arg
+                variable_pointer = ctx.string_pool.variable(arg_nodes[i].lexeme, count=False)
                 zero = ir.Constant(ir.types.IntType(32), 0)
-                variable_first_pointer = builder.gep(variable_pointer, [zero, zero], inbounds=True)
+                variable_first_pointer = ctx.builder.gep(variable_pointer, [zero, zero], inbounds=True)
                 actual_args.append(variable_first_pointer)
         else:
             actual_args.append(arg)
@@ -768,30 +1751,30 @@ def codegen_handler_func_call(node):
     # print('function:',func)
     # print('actual arguments:',actual_args)
     # print('actual arguments', actual_args)
-    return builder.call(func, actual_args, name='calltmp') 
+    return ctx.builder.call(func, actual_args, name='calltmp') 
  
-def codegen_handler_uniop(node):
+def codegen_handler_uniop(ctx, node):
     """
     Handle logical operators like AND, OR and generate corresponding LLVM IR code.
     """
-    var = codegen(node.children[1])
+    var = yield node.children[1]
     # to be finish
     if node.nodetype == NodeType.TILDE:
-        return builder.not_(var, name='nottmp')
+        return ctx.builder.not_(var, name='nottmp')
     # elif node.nodetype == NodeType.NOT:
     #     return codegen_logical_not(var)    
 
-def codegen_handler_exps(node):
+def codegen_handler_exps(ctx, node):
     ret = []
     for child in node.children:
-        exp = codegen(child)
+        exp = yield child
         if exp:
             ret.append(exp)
     return ret
   
-def semantic_analysis(node):
+def semantic_analysis(ctx, node):
     """
-    Perform semantic analysis on the root_node of AST
+    Perform semantic analysis on the root_node of AST, the traversal is driven by walk()
 
     Args:
         node(TreeNode)
@@ -799,138 +1782,175 @@ def semantic_analysis(node):
     Returns:
         (DataType): datatype of the node
     """
-    handler_map = {
-        NodeType.PROGRAM: semantic_handler_program,
-        NodeType.ID: semantic_handler_id,
-        NodeType.TINT: semantic_handler_int,
-        NodeType.TBOOL: semantic_handler_bool,
-        NodeType.TSTRING: semantic_handler_string,
-        NodeType.INTLITERAL: semantic_handler_int,
-        NodeType.STRINGLITERAL: semantic_handler_string,
-        NodeType.TRUE: semantic_handler_bool,
-        NodeType.FALSE: semantic_handler_bool,
-        NodeType.GLOBAL_DECL: semantic_handler_global_declare,
-        NodeType.FUNC_DECL: semantic_handler_function_declare,
-        NodeType.VAR_DECL: semantic_handler_variable_declare,
-        NodeType.ARG: semantic_handler_arg,
-        NodeType.TVOID: semantic_handler_void,
-        NodeType.REF: semantic_handler_string,
-        # NodeType.GLOBAL_EXPS: semantic_handler_global_exps,
-        NodeType.STMTS: semantic_handler_stmts,
-        NodeType.FUNC_CALL: semantic_handler_func_call,       
-        NodeType.IF_STMT: semantic_handler_IF,         
-        # NodeType.ELSE_STMT: semantic_handler_ELSE,
-        NodeType.FOR_LOOP: semantic_handler_FOR,        
-        NodeType.WHILE_LOOP: semantic_handler_WHILE,      
-        NodeType.RETURN: semantic_handler_return,          
-        NodeType.ASSIGN: semantic_handler_assign,         
-        NodeType.EXP: semantic_handler_exp,     
-        NodeType.NULL: semantic_handler_void,
-        NodeType.STAR: semantic_handler_binop,
-        NodeType.PLUS: semantic_handler_binop,
-        NodeType.MINUS: semantic_handler_binop,
-        NodeType.LSHIFT: semantic_handler_binop,
-        NodeType.RLSHIFT: semantic_handler_binop,
-        NodeType.RASHIFT: semantic_handler_binop,
-        NodeType.LESS: semantic_handler_binop,
-        NodeType.LESSEQ: semantic_handler_binop,
-        NodeType.GREAT: semantic_handler_binop,
-        NodeType.GREATEQ: semantic_handler_binop,
-        NodeType.EQ: semantic_handler_binop,
-        NodeType.NEQ: semantic_handler_binop,
-        NodeType.LAND: semantic_handler_binop,
-        NodeType.LOR: semantic_handler_binop,
-        NodeType.BAND: semantic_handler_binop,
-        NodeType.BOR: semantic_handler_binop,
-        # TODO: add more mapping from NodeType to its corresponding handler functions here
-    }
-    handler = handler_map.get(node.nodetype)
-    # print(node.lexeme, str(handler))
-    if handler:
-        handler(node)
-    else:
-        default_handler(node)
+    walk(ctx, node, SEMANTIC_HANDLERS)
     return node.datatype
 
-def codegen_handler_int(node):
+def codegen_handler_int(ctx, node):
     return ir.Constant(ir_type(node.datatype), int(node.lexeme))
 
-def codegen_handler_string(node):
-    s = (node.lexeme + '\0').replace('\\n', '\n')
-    val = bytearray(s.encode("utf8"))
-    return ir.Constant(ir_type(node.datatype, len(val)), val)
+def codegen_handler_string(ctx, node):
+    return ctx.string_pool.constant(node.lexeme)
 
-def codegen_handler_bool(node):
+def codegen_handler_bool(ctx, node):
     if node.nodetype == NodeType.TRUE:
         fg = 1
     else:
         fg = 0
     return ir.Constant(ir_type(node.datatype), fg)
 
-def semantic_handler_program(node):
-    symbol_table.push_scope()
-    # insert built-in function names in global scope symbol table
-    symbol_table.insert("array_of_string", DataType.INT_ARRAY)
-    symbol_table.insert("string_of_array", DataType.STRING)
-    symbol_table.insert("length_of_string", DataType.INT)
-    symbol_table.insert("string_of_int", DataType.STRING)
-    symbol_table.insert("string_cat", DataType.STRING)
-    symbol_table.insert("print_string", DataType.VOID)
-    symbol_table.insert("print_int", DataType.VOID)
-    symbol_table.insert("print_bool", DataType.BOOL)
-    # recursively do semantic analysis in left-to-right order for all children nodes
-    for child in node.children:
-        semantic_analysis(child)
-    symbol_table.pop_scope()
+# Built-in functions of runtime.c and their return types
+BUILTIN_SYMBOLS = (
+    ("array_of_string", DataType.INT_ARRAY),
+    ("string_of_array", DataType.STRING),
+    ("length_of_string", DataType.INT),
+    ("string_of_int", DataType.STRING),
+    ("string_cat", DataType.STRING),
+    ("print_string", DataType.VOID),
+    ("print_int", DataType.VOID),
+    ("print_bool", DataType.BOOL),
+)
+
+def declare_builtin_symbols(ctx):
+    """
+    Push the global scope and insert built-in function names in it
+    """
+    ctx.symbol_table.push_scope()
+    for lexeme, datatype in BUILTIN_SYMBOLS:
+        ctx.builtin_symbols[lexeme] = ctx.symbol_table.insert(lexeme, datatype)
+
+def declaration_label(node):
+    """
+    Returns:
+        - str: the kind and name of a top-level declaration, to tell where a semantic error is
+    """
+    if node.nodetype == NodeType.FUNC_DECL:
+        return "function " + node.children[1].lexeme
+    return "global " + node.children[0].lexeme
+
+def declare_top_level(ctx, node, errors):
+    """
+    First phase of semantic analysis: analyze the global declarations and insert the name of every function
+    into the global scope, in order, so that each function body only depends on the global scope
+
+    Args:
+        - node(TreeNode): the PROGRAM node
+        - errors(list): (position in the program, label, ValueError) of each declaration failing is appended to it
+
+    Returns:
+        - list of (int, TreeNode): the FUNC_DECL nodes and their positions, the bodies are left to check_function_body()
+    """
+    functions = []
+    for position, child in enumerate(node.children):
+        try:
+            if child.nodetype != NodeType.FUNC_DECL:
+                semantic_analysis(ctx, child)
+                continue
+            functions.append((position, child))
+            _type, _id, args, stmts = child.children
+            semantic_analysis(ctx, _type)
+            if ctx.symbol_table.lookup(_id.lexeme) is not None:
+                raise ValueError("Function already defined: ", _id.lexeme)
+            _id.symbol = ctx.symbol_table.insert(_id.lexeme, _type.datatype)
+        except ValueError as error:
+            errors.append((position, declaration_label(child), error))
+    return functions
+
+def check_function_body(ctx, node):
+    """
+    Second phase of semantic analysis: analyze one FUNC_DECL, leaving the symbol table as it was even if it fails
+
+    Returns:
+        - ValueError: the semantic error of the function, None if there is none
+    """
+    depth = len(ctx.symbol_table.scope_ids)
+    try:
+        semantic_analysis(ctx, node)
+    except ValueError as error:
+        while len(ctx.symbol_table.scope_ids) > depth:
+            ctx.symbol_table.pop_scope()
+        return error
+    return None
+
+def raise_semantic_errors(errors):
+    """
+    Raise the errors gathered by semantic analysis: a single error as it is, several ones together in source order
+
+    Args:
+        - errors(list of (int, str, ValueError)): position of the declaration in the program, its label and its error
+    """
+    if len(errors) == 1:
+        raise errors[0][2]
+    if errors:
+        lines = []
+        for position, label, error in sorted(errors, key=lambda entry: entry[0]):
+            message = "".join(map(str, error.args[:1])) + ", ".join(map(str, error.args[1:]))
+            lines.append("%s: %s" % (label, message))
+        raise ValueError("%d semantic errors:\n%s" % (len(errors), "\n".join(lines)))
+
+def semantic_handler_program(ctx, node):
+    declare_builtin_symbols(ctx)
+    errors = []
+    functions = declare_top_level(ctx, node, errors)
+    # the function bodies are independent once all the signatures are known
+    if ctx.options.analyze_jobs > 1:
+        errors.extend(parallel_check_functions(ctx, functions))
+    else:
+        for position, function in functions:
+            error = check_function_body(ctx, function)
+            if error is not None:
+                errors.append((position, declaration_label(function), error))
+    ctx.symbol_table.pop_scope()
+    raise_semantic_errors(errors)
 
 # Some Sample handler functions
 # TODO: define more hanlder functions for various node types
-def semantic_handler_id(node):
-    # symbol_table.print()
-    if symbol_table.lookup_global(node.lexeme, node.index) is None:
+def semantic_handler_id(ctx, node):
+    # ctx.symbol_table.print()
+    symbol = ctx.symbol_table.lookup(node.lexeme)
+    if symbol is None:
         raise ValueError("Variable not defined: ", node.lexeme)
-    else:
-        node.id, node.datatype = symbol_table.lookup_global(node.lexeme, node.index)
+    node.symbol, node.datatype = symbol, symbol.datatype
 
-def semantic_handler_global_declare(node):
+def semantic_handler_global_declare(ctx, node):
     var, val = node.children
-    semantic_analysis(val)
+    yield val
     # var.datatype = val.datatype
     
-    if symbol_table.lookup_global(var.lexeme, var.index) is not None:
+    if ctx.symbol_table.lookup(var.lexeme) is not None:
         raise ValueError("Variable already defined: ", var.lexeme)
-    symbol_table.insert(var.lexeme, val.datatype, var.index)
-    semantic_analysis(var)
+    ctx.symbol_table.insert(var.lexeme, val.datatype)
+    yield var
     node.children = [var, val]
     node.datatype = node.children[0].datatype
     
-def semantic_handler_IF(node):
+def semantic_handler_IF(ctx, node):
     exp, stmt, else_stmt = node.children
-    semantic_analysis(exp)
-    semantic_analysis(stmt)
-    semantic_analysis(else_stmt)
+    yield exp
+    yield stmt
+    yield else_stmt
    
-def semantic_handler_WHILE(node):   
+def semantic_handler_WHILE(ctx, node):   
     exp, stmts = node.children
-    semantic_analysis(exp)
-    default_handler(stmts)
+    yield exp
+    yield from default_handler(ctx, stmts)
     node.children = [exp, stmts]
     
-def semantic_handler_FOR(node):
-    symbol_table.push_scope()
-    default_handler(node.children[0]) # declare variables
-    semantic_analysis(node.children[1]) # condition
-    semantic_analysis(node.children[2]) # increment
-    semantic_analysis(node.children[3]) # stmts
-    symbol_table.pop_scope()
+def semantic_handler_FOR(ctx, node):
+    ctx.symbol_table.push_scope()
+    yield from default_handler(ctx, node.children[0]) # declare variables
+    yield node.children[1] # condition
+    yield node.children[2] # increment
+    yield node.children[3] # stmts
+    ctx.symbol_table.pop_scope()
     
-def semantic_handler_function_declare(node):
+def semantic_handler_function_declare(ctx, node):
+    # the function name is already in the global scope, see declare_top_level()
     _type, _id, args, stmts = node.children
-    scope_id = symbol_table.push_scope()
+    scope_id = ctx.symbol_table.push_scope()
     
-    semantic_analysis(_type)
-    semantic_analysis(args)
-    semantic_analysis(stmts)
+    yield _type
+    yield args
+    yield stmts
     func_name = _id.lexeme
     
     # for ch in args.children:
@@ -938,124 +1958,2128 @@ def semantic_handler_function_declare(node):
     func_type = _type.datatype
     # print("Declare function", func_name)
     # arguments are valid?
-    if symbol_table.lookup_global(func_name, _id.index) is not None:
-        raise ValueError("Function already defined: ", func_name)
     if func_type != stmts.datatype:
         raise ValueError("Function return type does not match: ", func_name, func_type, stmts.datatype)
-    symbol_table.insert(func_name, func_type, _id.index)
-    symbol_table.pop_scope()
+    ctx.symbol_table.pop_scope()
     
-def semantic_handler_func_call(node):
-    default_handler(node)
+def semantic_handler_func_call(ctx, node):
+    yield from default_handler(ctx, node)
     func_name_node, args = node.children
     func_name = func_name_node.lexeme
     # for child in node.children:
     #     func_name += str(child.datatype)
     # print("Call function", func_name)
-    if symbol_table.lookup_global(func_name, func_name_node.index) is None:
+    func_name_node.symbol = ctx.symbol_table.lookup(func_name)
+    if func_name_node.symbol is None:
         raise ValueError("Function not defined")
-    func = symbol_table.lookup_global(func_name, func_name_node.index)
     
-def semantic_handler_arg(node):
+def semantic_handler_arg(ctx, node):
     _type, _id = node.children
-    if symbol_table.lookup_local(_id.lexeme, _id.index) is not None:
+    if ctx.symbol_table.lookup_local(_id.lexeme) is not None:
         raise ValueError("Variable already defined: ", _id.lexeme)
     
-    semantic_analysis(_type)
-    symbol_table.insert(_id.lexeme, _type.datatype, _id.index)
-    semantic_analysis(_id)
+    yield _type
+    ctx.symbol_table.insert(_id.lexeme, _type.datatype)
+    yield _id
     node.children = [_id, _type]
     
-def semantic_handler_assign(node):
-    default_handler(node)
+def semantic_handler_assign(ctx, node):
+    yield from default_handler(ctx, node)
     left, right = node.children
     if left.datatype != right.datatype:
         raise ValueError("Binary operator type mismatch: ", node.lexeme, left.lexeme, right.lexeme)
         
-def semantic_handler_variable_declare(node):
+def semantic_handler_variable_declare(ctx, node):
     var, val = node.children
-    semantic_analysis(val)
+    yield val
     # var.datatype = val.datatype
     
-    if symbol_table.lookup_local(var.lexeme, var.index) is not None:
+    if ctx.symbol_table.lookup_local(var.lexeme) is not None:
         raise ValueError("Variable already defined: ", var.lexeme)
-    symbol_table.insert(var.lexeme, val.datatype, var.index)
-    semantic_analysis(var)
+    ctx.symbol_table.insert(var.lexeme, val.datatype)
+    yield var
     node.children = [var, val]
     node.datatype = val.datatype
 
-def semantic_handler_stmts(node):
-    symbol_table.push_scope()
+def semantic_handler_stmts(ctx, node):
+    ctx.symbol_table.push_scope()
     for child in node.children:
-        semantic_analysis(child)
+        yield child
         if child.nodetype == NodeType.RETURN:
             node.datatype = child.datatype
-    symbol_table.pop_scope()
+    ctx.symbol_table.pop_scope()
     
 
-def semantic_handler_exp(node):    
+def semantic_handler_exp(ctx, node):    
     return None
 
-def semantic_handler_return(node):
+def semantic_handler_return(ctx, node):
     if node.children:
-        semantic_analysis(node.children[0])
+        yield node.children[0]
         node.datatype = node.children[0].datatype
     else:
         node.datatype = DataType.VOID
 
-def semantic_handler_int(node):
+def semantic_handler_int(ctx, node):
     node.datatype = DataType.INT
 
-def semantic_handler_bool(node):
+def semantic_handler_bool(ctx, node):
     node.datatype = DataType.BOOL
 
-def semantic_handler_string(node):
+def semantic_handler_string(ctx, node):
     node.datatype = DataType.STRING
 
-def semantic_handler_void(node):
+def semantic_handler_void(ctx, node):
     node.datatype = DataType.VOID
   
-def semantic_handler_binop(node):
+def semantic_handler_binop(ctx, node):
     left, right = node.children
-    semantic_analysis(left)
-    semantic_analysis(right)
+    yield left
+    yield right
     if left.datatype != right.datatype:
         raise ValueError("Binary operator type mismatch: ", node.lexeme, left.lexeme, left.datatype, right.lexeme, right.datatype)
     node.datatype = left.datatype
 
-def default_handler(node):
+def default_handler(ctx, node):
     for child in node.children:
-        semantic_analysis(child)
-
-
-if len(sys.argv) == 3:
-    # visualize AST before semantic analysis
-    dot_path = sys.argv[1]
-    ast_png_before_semantic_analysis = sys.argv[2]
-    root_node = construct_tree_from_dot(dot_path)
-    if DEBUG: print_tree(root_node)
-    visualize_tree(root_node, ast_png_before_semantic_analysis)
-elif len(sys.argv) == 4:
-#     # visualize AST after semantic analysis
-# if __name__ == "__main__":
-    # dot_path, ast_png_before_semantic_analysis, ast_png_after_semantics_analysis, llvm_ir = 'testcases/ast/test3.dot', 'testcases/ast/test3-before.png', 'testcases/output/test3-after.png', './llvm_ir/test3-self.ll'
-    dot_path = sys.argv[1]
-    ast_png_after_semantics_analysis = sys.argv[2]
-    llvm_ir = sys.argv[3]
-    root_node = construct_tree_from_dot(dot_path)
-    semantic_analysis(root_node)
-    visualize_tree(root_node, ast_png_after_semantics_analysis)
-    ## Uncomment the following when you are trying the do IR generation
-    # # init llvm
-    llvm.initialize()
-    llvm.initialize_native_target()
-    llvm.initialize_native_asmprinter()
-    declare_runtime_functions()
-    
-    codegen(root_node)
-    # # print LLVM IR
-    with open(llvm_ir, 'w') as f:
-        f.write(str(module))
-    print(module)
-else:
-    raise SyntaxError("Usage: python3 a4.py <.dot> <.png before>\nUsage: python3 ./a4.py <.dot> <.png after> <.ll>")
+        yield child
+
+
+# Map from NodeType to its handler function of semantic analysis
+# Different NodeTypes may be mapped to the same handler function
+SEMANTIC_HANDLER_MAP = {
+    NodeType.PROGRAM: semantic_handler_program,
+    NodeType.ID: semantic_handler_id,
+    NodeType.TINT: semantic_handler_int,
+    NodeType.TBOOL: semantic_handler_bool,
+    NodeType.TSTRING: semantic_handler_string,
+    NodeType.INTLITERAL: semantic_handler_int,
+    NodeType.STRINGLITERAL: semantic_handler_string,
+    NodeType.TRUE: semantic_handler_bool,
+    NodeType.FALSE: semantic_handler_bool,
+    NodeType.GLOBAL_DECL: semantic_handler_global_declare,
+    NodeType.FUNC_DECL: semantic_handler_function_declare,
+    NodeType.VAR_DECL: semantic_handler_variable_declare,
+    NodeType.ARG: semantic_handler_arg,
+    NodeType.TVOID: semantic_handler_void,
+    NodeType.REF: semantic_handler_string,
+    # NodeType.GLOBAL_EXPS: semantic_handler_global_exps,
+    NodeType.STMTS: semantic_handler_stmts,
+    NodeType.FUNC_CALL: semantic_handler_func_call,       
+    NodeType.IF_STMT: semantic_handler_IF,         
+    # NodeType.ELSE_STMT: semantic_handler_ELSE,
+    NodeType.FOR_LOOP: semantic_handler_FOR,        
+    NodeType.WHILE_LOOP: semantic_handler_WHILE,      
+    NodeType.RETURN: semantic_handler_return,          
+    NodeType.ASSIGN: semantic_handler_assign,         
+    NodeType.EXP: semantic_handler_exp,     
+    NodeType.NULL: semantic_handler_void,
+    NodeType.STAR: semantic_handler_binop,
+    NodeType.PLUS: semantic_handler_binop,
+    NodeType.MINUS: semantic_handler_binop,
+    NodeType.LSHIFT: semantic_handler_binop,
+    NodeType.RLSHIFT: semantic_handler_binop,
+    NodeType.RASHIFT: semantic_handler_binop,
+    NodeType.LESS: semantic_handler_binop,
+    NodeType.LESSEQ: semantic_handler_binop,
+    NodeType.GREAT: semantic_handler_binop,
+    NodeType.GREATEQ: semantic_handler_binop,
+    NodeType.EQ: semantic_handler_binop,
+    NodeType.NEQ: semantic_handler_binop,
+    NodeType.LAND: semantic_handler_binop,
+    NodeType.LOR: semantic_handler_binop,
+    NodeType.BAND: semantic_handler_binop,
+    NodeType.BOR: semantic_handler_binop,
+    # TODO: add more mapping from NodeType to its corresponding handler functions here
+}
+
+# Map from NodeType to its handler function of IR generation
+CODEGEN_FUNC_MAP = {
+    NodeType.PROGRAM: codegen_handler_program,
+    NodeType.GLOBAL_DECL: codegen_handler_global_decl,
+    # TODO: add more mappings from NodeType to its handler function of IR generation
+    NodeType.FUNC_DECL: codegen_handler_function_declare,
+    NodeType.VAR_DECL: codegen_handler_variable_declare,
+    # NodeType.TVOID: codegen_handler_void,
+    # NodeType.REF: codegen_handler_string,
+    NodeType.ID: codegen_handler_id,
+    NodeType.FUNC_CALL: codegen_handler_func_call,       
+    NodeType.IF_STMT: codegen_handler_IF,         
+    NodeType.FOR_LOOP: codegen_handler_for,        
+    NodeType.WHILE_LOOP: codegen_handler_while,      
+    NodeType.RETURN: codegen_handler_return,          
+    NodeType.ASSIGN: codegen_handler_assign,         
+    NodeType.EXPS: codegen_handler_exps,     
+    # NodeType.NULL: codegen_handler_void,
+    NodeType.STAR: codegen_handler_binop,
+    NodeType.PLUS: codegen_handler_binop,
+    NodeType.MINUS: codegen_handler_binop,
+    NodeType.INTLITERAL: codegen_handler_int,
+    NodeType.TRUE: codegen_handler_bool,
+    NodeType.FALSE: codegen_handler_bool,
+    NodeType.STRINGLITERAL: codegen_handler_string,
+    NodeType.LSHIFT: codegen_handler_binop,
+    NodeType.RLSHIFT: codegen_handler_binop,
+    NodeType.RASHIFT: codegen_handler_binop,
+    NodeType.LESS: codegen_handler_binop,
+    NodeType.LESSEQ: codegen_handler_binop,
+    NodeType.GREAT: codegen_handler_binop,
+    NodeType.GREATEQ: codegen_handler_binop,
+    NodeType.EQ: codegen_handler_binop,
+    NodeType.NEQ: codegen_handler_binop,
+    NodeType.LAND: codegen_handler_binop,
+    NodeType.LOR: codegen_handler_binop,
+    NodeType.BAND: codegen_handler_binop,
+    NodeType.BOR: codegen_handler_binop,
+    NodeType.TILDE: codegen_handler_uniop,
+    NodeType.NOT: codegen_handler_uniop
+}
+
+def dispatch_table(handler_map, default):
+    """
+    Build the dispatch table used by walk() once, instead of a map lookup per visited node
+
+    Args:
+        - handler_map(dict): map from NodeType to its handler function
+        - default(function): handler of node types missing in handler_map
+
+    Returns:
+        - list: handler functions indexed by NodeType.position
+    """
+    return [handler_map.get(member, default) for member in NODE_TYPES]
+
+SEMANTIC_HANDLERS = dispatch_table(SEMANTIC_HANDLER_MAP, default_handler)
+CODEGEN_HANDLERS = dispatch_table(CODEGEN_FUNC_MAP, codegen_handler_default)
+
+# Constant folding
+#
+# fold_constants runs on the analyzed AST before codegen. Each fold handler returns the node standing in
+# for the visited one, which is the node itself or one of its descendants (a literal child rewritten
+# with the folded value, the operand of an identity, the taken branch of an IF). Parents only swap
+# children, never add or drop them, so the pass works on CompactTrees as well.
+
+def wrap_int32(value):
+    """
+    Returns:
+        - int: value wrapped around to a signed 32-bit integer, as the i32 arithmetic of the IR
+    """
+    return (value + 0x80000000) % 0x100000000 - 0x80000000
+
+def constant_value(node):
+    """
+    Returns:
+        - int: value of an INTLITERAL/TRUE/FALSE node, None for any other node
+    """
+    nodetype = node.nodetype
+    if nodetype == NodeType.INTLITERAL:
+        return wrap_int32(int(node.lexeme))
+    if nodetype == NodeType.TRUE:
+        return 1
+    if nodetype == NodeType.FALSE:
+        return 0
+    return None
+
+def make_literal(node, value, datatype):
+    """
+    Rewrite a literal node into the literal of value, TRUE/FALSE for a BOOL and INTLITERAL otherwise
+    """
+    if datatype == DataType.BOOL:
+        node.nodetype, node.lexeme = (NodeType.TRUE, "true") if value else (NodeType.FALSE, "false")
+    else:
+        node.nodetype, node.lexeme = NodeType.INTLITERAL, str(value)
+    node.datatype = datatype
+    return node
+
+def fold_shift(nodetype, value, amount):
+    # shifting an i32 by 32 or more is poison in LLVM, such shifts are left to codegen
+    if not 0 <= amount < 32:
+        return None
+    if nodetype == NodeType.LSHIFT:
+        return wrap_int32(value << amount)
+    if nodetype == NodeType.RLSHIFT:
+        return wrap_int32((value & 0xffffffff) >> amount)
+    return value >> amount
+
+# Map from NodeType of a binary operator to the function folding its operands
+FOLD_OPERATORS = {
+    NodeType.PLUS: lambda a, b: wrap_int32(a + b),
+    NodeType.MINUS: lambda a, b: wrap_int32(a - b),
+    NodeType.STAR: lambda a, b: wrap_int32(a * b),
+    NodeType.BAND: lambda a, b: a & b,
+    NodeType.BOR: lambda a, b: a | b,
+    NodeType.LESS: lambda a, b: int(a < b),
+    NodeType.LESSEQ: lambda a, b: int(a <= b),
+    NodeType.GREAT: lambda a, b: int(a > b),
+    NodeType.GREATEQ: lambda a, b: int(a >= b),
+    NodeType.EQ: lambda a, b: int(a == b),
+    NodeType.NEQ: lambda a, b: int(a != b),
+    NodeType.LAND: lambda a, b: int(bool(a and b)),
+    NodeType.LOR: lambda a, b: int(bool(a or b)),
+}
+SHIFT_OPERATORS = (NodeType.LSHIFT, NodeType.RLSHIFT, NodeType.RASHIFT)
+
+def simplify_binop(node, left, right, a, b):
+    """
+    Algebraic identities of a binary operator with one constant operand (a or b, the other one is None)
+
+    Returns:
+        - TreeNode: the node standing in for node, node itself if no identity applies
+    """
+    nodetype = node.nodetype
+    if nodetype in (NodeType.PLUS, NodeType.BOR) or (nodetype == NodeType.LOR and node.datatype == DataType.BOOL):
+        # x + 0, x | 0, x || false
+        if b == 0:
+            return left
+        if a == 0:
+            return right
+    elif nodetype == NodeType.MINUS or nodetype in SHIFT_OPERATORS:
+        # x - 0, x << 0
+        if b == 0:
+            return left
+    elif nodetype == NodeType.STAR:
+        # x * 1, and x * 0 when x has no side effects
+        if b == 1:
+            return left
+        if a == 1:
+            return right
+        if b == 0 and left.nodetype == NodeType.ID:
+            return right
+        if a == 0 and right.nodetype == NodeType.ID:
+            return left
+    elif nodetype == NodeType.BAND and node.datatype == DataType.INT:
+        # x & -1
+        if b == -1:
+            return left
+        if a == -1:
+            return right
+    elif nodetype in (NodeType.BAND, NodeType.LAND) and node.datatype == DataType.BOOL:
+        # x && true
+        if b == 1:
+            return left
+        if a == 1:
+            return right
+    return node
+
+def fold_handler_default(ctx, node):
+    children = node.children
+    changed = False
+    for i, child in enumerate(children):
+        folded = yield child
+        if folded is not child:
+            children[i] = folded
+            changed = True
+    if changed:
+        node.children = children
+    return node
+
+def fold_handler_leaf(ctx, node):
+    return node
+
+def fold_handler_binop(ctx, node):
+    left, right = node.children
+    folded_left = yield left
+    folded_right = yield right
+    if folded_left is not left or folded_right is not right:
+        left, right = folded_left, folded_right
+        node.children = [left, right]
+    a, b = constant_value(left), constant_value(right)
+    if a is None and b is None:
+        return node
+    if a is None or b is None:
+        return simplify_binop(node, left, right, a, b)
+    if node.nodetype in SHIFT_OPERATORS:
+        value = fold_shift(node.nodetype, a, b)
+        if value is None:
+            return node
+        return make_literal(left, value, node.datatype)
+    fold = FOLD_OPERATORS.get(node.nodetype)
+    if fold is None:
+        return node
+    # the literal keeps the datatype semantic analysis gave the operator, which its parent was checked against
+    return make_literal(left, fold(a, b), node.datatype)
+
+def fold_handler_uniop(ctx, node):
+    yield from fold_handler_default(ctx, node)
+    if len(node.children) != 1:
+        return node
+    operand = node.children[0]
+    value = constant_value(operand)
+    if value is None:
+        return node
+    if node.nodetype == NodeType.TILDE and operand.datatype == DataType.INT:
+        return make_literal(operand, ~value, DataType.INT)
+    if node.nodetype == NodeType.NOT and operand.datatype == DataType.BOOL:
+        return make_literal(operand, int(not value), DataType.BOOL)
+    return node
+
+def fold_handler_IF(ctx, node):
+    yield from fold_handler_default(ctx, node)
+    value = constant_value(node.children[0])
+    if value is None:
+        return node
+    # the taken branch stands in for the IF: the block, or the ELSE node holding the else branch (maybe empty)
+    return node.children[1] if value else node.children[2]
+
+def fold_handler_WHILE(ctx, node):
+    yield from fold_handler_default(ctx, node)
+    condition = node.children[0]
+    if constant_value(condition) == 0:
+        # the loop never runs, the false literal stands in for it and generates no code
+        return condition
+    return node
+
+def fold_constants(ctx, node):
+    """
+    Fold the constant expressions, simplify the algebraic identities and prune the IF/WHILE branches
+    with a constant condition in the analyzed subtree of node, the traversal is driven by walk()
+
+    Args:
+        node(TreeNode)
+
+    Returns:
+        (TreeNode): the node standing in for node
+    """
+    return walk(ctx, node, FOLD_HANDLERS)
+
+# Map from NodeType to its handler function of constant folding
+FOLD_HANDLER_MAP = {
+    NodeType.ID: fold_handler_leaf,
+    NodeType.INTLITERAL: fold_handler_leaf,
+    NodeType.STRINGLITERAL: fold_handler_leaf,
+    NodeType.TRUE: fold_handler_leaf,
+    NodeType.FALSE: fold_handler_leaf,
+    NodeType.IF_STMT: fold_handler_IF,
+    NodeType.WHILE_LOOP: fold_handler_WHILE,
+    NodeType.TILDE: fold_handler_uniop,
+    NodeType.NOT: fold_handler_uniop,
+}
+for member in tuple(FOLD_OPERATORS) + SHIFT_OPERATORS:
+    FOLD_HANDLER_MAP[member] = fold_handler_binop
+
+FOLD_HANDLERS = dispatch_table(FOLD_HANDLER_MAP, fold_handler_default)
+
+# Incremental compilation
+#
+# Every function declaration of the program is fingerprinted by its subtree and the global symbols it
+# refers to, with the initializers of the global variables. The IR generated for it is cached under the fingerprint, and when a later compilation sees the
+# same fingerprint it skips semantic analysis and codegen of the function and stitches the cached IR into
+# its module instead. Global variable declarations are always compiled, they are cheap and later functions
+# need their IR values.
+#
+# Unique names embed scope IDs (see SymbolTable.unique_name), which depend on the declarations before the
+# function, and string constants are shared through the StringPool of the module, so the cached IR is
+# renumbered on reuse and the stitched module is the same as the one of a full compilation.
+
+class IRFragment:
+    """
+    IR generated for one function declaration
+    """
+    def __init__(self, lines, names, constants, scope_base, scope_count):
+        self.lines = lines              # [list of str] IR of each global value the declaration added to the module, but the string constants
+        self.names = names              # [list of str] names of these global values
+        self.constants = constants      # [list of (str, str)] (name of its global constant or None, lexeme) of each string literal used, in order
+        self.scope_base = scope_base    # [int] SymbolTable.id_counter before the declaration
+        self.scope_count = scope_count  # [int] number of scopes the declaration pushed
+
+class StitchedFragment:
+    """
+    Stands in the module for the global values of a reused IRFragment, printed as its IR
+    """
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+class FragmentCache:
+    """
+    In-memory cache of IRFragment by fingerprint, shared by the compilations of one process
+    (e.g. the requests of the compile server), least recently used entries are evicted first
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.fragments = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, fingerprint):
+        with self.lock:
+            fragment = self.fragments.get(fingerprint)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.fragments.move_to_end(fingerprint)
+            self.hits += 1
+            return fragment
+
+    def put(self, fingerprint, fragment):
+        with self.lock:
+            self.fragments[fingerprint] = fragment
+            self.fragments.move_to_end(fingerprint)
+            while len(self.fragments) > self.max_entries:
+                self.fragments.popitem(last=False)
+
+# Cache used by compilations with CompileOptions.incremental
+FRAGMENT_CACHE = FragmentCache()
+
+class DeclarationPlan:
+    """
+    What incremental compilation does with one top-level declaration
+    """
+    def __init__(self, node, fingerprint=None, fragment=None, scope_base=0, scope_count=0):
+        self.node = node                # [TreeNode] GLOBAL_DECL or FUNC_DECL
+        self.fingerprint = fingerprint  # [str] None for declarations that are not cached
+        self.fragment = fragment        # [IRFragment] cached IR to reuse, None to compile the declaration
+        self.scope_base = scope_base    # [int] SymbolTable.id_counter before the declaration
+        self.scope_count = scope_count  # [int] number of scopes the declaration pushed
+
+def fingerprint_declaration(ctx, node, global_declarations):
+    """
+    Hash the subtree of a top-level declaration, the global symbols it refers to and the options changing its IR
+
+    Node indices are left out, so that editing another declaration (which renumbers the nodes after it)
+    does not change the fingerprint
+
+    Args:
+        - node(TreeNode): FUNC_DECL
+        - global_declarations(dict): map<str, TreeNode> GLOBAL_DECL of each global variable by lexeme
+
+    Returns:
+        - str: hex digest
+    """
+    # options changing the IR generated for the same declaration
+    parts = [repr((ctx.options.ssa, "fold" in ctx.options.disable))]
+    lexemes = set()
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        children = current.children
+        parts.append("%s\0%s\0%d" % (current.nodetype.value, current.lexeme, len(children)))
+        if current.nodetype is NodeType.ID:
+            lexemes.add(current.lexeme)
+        stack.extend(reversed(children))
+    # only the global scope is pushed when a top-level declaration starts
+    for lexeme in sorted(lexemes):
+        symbol = ctx.symbol_table.lookup(lexeme)
+        if symbol is not None:
+            parts.append("%s\0%s" % (lexeme, symbol.datatype.value))
+            declaration = global_declarations.get(lexeme)
+            if declaration is not None:
+                # the initializer gives the IR type of a global string (its length) and the constant it is pooled into
+                initializer = declaration.children[1]
+                parts.append("%s\0%s" % (initializer.nodetype.value, initializer.lexeme))
+    return hashlib.blake2b("\1".join(parts).encode("utf8"), digest_size=20).hexdigest()
+
+def incremental_semantic_analysis(ctx, root_node):
+    """
+    Semantic analysis of the declarations whose IR is not cached, fills ctx.declarations for incremental_codegen
+    """
+    symbol_table = ctx.symbol_table
+    ctx.declarations = []
+    declare_builtin_symbols(ctx)
+    errors = []
+    declare_top_level(ctx, root_node, errors)
+    global_declarations = {node.children[0].lexeme: node for node in root_node.children if node.nodetype == NodeType.GLOBAL_DECL}
+    for position, node in enumerate(root_node.children):
+        scope_base = symbol_table.id_counter
+        if node.nodetype != NodeType.FUNC_DECL:
+            ctx.declarations.append(DeclarationPlan(node))
+            continue
+        fingerprint = fingerprint_declaration(ctx, node, global_declarations)
+        fragment = ctx.fragment_cache.get(fingerprint)
+        if fragment is not None:
+            # skip the function, but use up the scope IDs it would have pushed
+            symbol_table.id_counter += fragment.scope_count
+            ctx.declarations.append(DeclarationPlan(node, fingerprint, fragment, scope_base, fragment.scope_count))
+            continue
+        error = check_function_body(ctx, node)
+        if error is not None:
+            errors.append((position, declaration_label(node), error))
+        ctx.declarations.append(DeclarationPlan(node, fingerprint, None, scope_base, symbol_table.id_counter - scope_base))
+    symbol_table.pop_scope()
+    raise_semantic_errors(errors)
+    # globals are lowered first, as codegen_handler_program does
+    ctx.declarations.sort(key=lambda plan: plan.node.nodetype == NodeType.FUNC_DECL)
+
+# Names of global values and local variables carrying a scope ID, e.g. @"foo-2" and %"y-5.1"
+SCOPED_NAME = re.compile(r'([%@]")([a-zA-Z][a-zA-Z0-9_]*)-(\d+)')
+# Names of the global constants of StringPool
+CONSTANT_NAME = re.compile(r'constant\d+')
+CONSTANT_REFERENCE = re.compile(r'@"(constant\d+)"')
+
+def stitch_fragment(ctx, plan):
+    """
+    Add the IR of a cached fragment to the module, renumbered for the scope IDs and string constants of this compilation
+    """
+    fragment = plan.fragment
+    shift = plan.scope_base - fragment.scope_base
+    first, last = fragment.scope_base + 1, fragment.scope_base + fragment.scope_count
+
+    def rename_scoped(match):
+        scope_id = int(match.group(3))
+        if shift and first <= scope_id <= last:
+            scope_id += shift
+        return "%s%s-%d" % (match.group(1), match.group(2), scope_id)
+
+    # rename as references and strip the @" again
+    names = [SCOPED_NAME.sub(rename_scoped, '@"' + name)[2:] for name in fragment.names] if shift else fragment.names
+    # the fragment goes first, the string constants it adds to the pool come after it as in a full compilation
+    stitched = StitchedFragment(names[0], "")
+    ctx.module.add_global(stitched)
+    for name in names[1:]:
+        ctx.module.scope.register(name)
+    renames = {}
+    for name, lexeme in fragment.constants:
+        if name is None:
+            ctx.string_pool.intern(lexeme)
+        else:
+            renames[name] = ctx.string_pool.variable(lexeme, count=False).name
+    if not shift and all(old == new for old, new in renames.items()):
+        stitched.text = "\n".join(fragment.lines)
+        return
+
+    def rename_constant(match):
+        return '@"%s"' % renames.get(match.group(1), match.group(1))
+
+    lines = []
+    for line in fragment.lines:
+        if shift:
+            line = SCOPED_NAME.sub(rename_scoped, line)
+        if renames:
+            line = CONSTANT_REFERENCE.sub(rename_constant, line)
+        lines.append(line)
+    stitched.text = "\n".join(lines)
+
+def incremental_codegen(ctx):
+    """
+    Codegen of the declarations planned by incremental_semantic_analysis: cached fragments are stitched into
+    the module, the others are compiled and their fragments cached
+    """
+    pool = ctx.string_pool
+    for plan in ctx.declarations:
+        if plan.fragment is not None:
+            stitch_fragment(ctx, plan)
+            continue
+        before = len(ctx.module.globals)
+        used = pool.used = [] if plan.fingerprint is not None else None
+        codegen(ctx, plan.node)
+        pool.used = None
+        if plan.fingerprint is None:
+            continue
+        added = [value for value in list(ctx.module.globals.values())[before:] if not CONSTANT_NAME.fullmatch(value.name)]
+        constants = []
+        for lexeme, is_variable in used:
+            variable = pool.strings[lexeme].variable
+            constants.append((variable.name if is_variable else None, lexeme))
+        fragment = IRFragment([str(value) for value in added], [value.name for value in added],
+                              constants, plan.scope_base, plan.scope_count)
+        ctx.fragment_cache.put(plan.fingerprint, fragment)
+
+def declaration_spec(value):
+    """
+    Returns:
+        - tuple: (name, type, is function, unnamed_addr) of a global value, enough to declare it in another module
+    """
+    if isinstance(value, ir.Function):
+        return (value.name, value.function_type, True, False)
+    return (value.name, value.value_type, False, value.unnamed_addr)
+
+def flatten_subtree(node):
+    """
+    Returns:
+        - list of TreeNode: the nodes of a subtree in pre-order, listed iteratively so deep trees do not recurse
+    """
+    nodes = []
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        nodes.append(current)
+        stack.extend(reversed(current.children))
+    return nodes
+
+def encode_function(ctx, node):
+    """
+    Flatten a FUNC_DECL subtree (after semantic analysis) into plain data for a codegen worker process,
+    iteratively, so deep trees do not hit the recursion limit of pickle
+
+    Returns:
+        - tuple: (nodes, symbols, declarations) where nodes are (NodeType position, DataType value, lexeme,
+          index in symbols or -1, number of children) in pre-order, symbols are (lexeme, DataType value, scope_id,
+          name of the global value it is bound to or None), and declarations are the declaration_spec of the
+          global values the function refers to
+    """
+    nodes = []
+    symbols = []
+    symbol_index = {}
+    declarations = {}
+    for current in flatten_subtree(node):
+        symbol = current.symbol
+        index = -1
+        if symbol is not None:
+            index = symbol_index.get(symbol)
+            if index is None:
+                index = symbol_index[symbol] = len(symbols)
+                name = None
+                if symbol.value is not None:
+                    name = symbol.value.name
+                    declarations[name] = declaration_spec(symbol.value)
+                symbols.append((symbol.lexeme, symbol.datatype.value, symbol.scope_id, name))
+        if current.nodetype == NodeType.FUNC_CALL:
+            # calls of a callee without a value look it up by lexeme in the module (see codegen_handler_func_call)
+            callee = ctx.module.globals.get(current.children[0].lexeme)
+            if callee is not None:
+                declarations[callee.name] = declaration_spec(callee)
+        nodes.append((current.nodetype.position, current.datatype.value, current.lexeme, index, len(current.children)))
+    return nodes, symbols, list(declarations.values())
+
+def decode_function(nodes, symbols, module):
+    """
+    Rebuild the subtree flattened by encode_function, binding the symbols of global values to their declarations in module
+
+    Returns:
+        - TreeNode: the FUNC_DECL node
+    """
+    decoded_symbols = []
+    for lexeme, datatype, scope_id, name in symbols:
+        symbol = Symbol(lexeme, DATA_TYPES[datatype], scope_id)
+        if name is not None:
+            symbol.value = module.globals.get(name)
+        decoded_symbols.append(symbol)
+    root = None
+    stack = []  # list of [TreeNode, children still to attach]
+    for index, (position, datatype, lexeme, symbol, child_count) in enumerate(nodes):
+        tree_node = TreeNode(index, lexeme)
+        tree_node.nodetype = NODE_TYPES[position]
+        tree_node.datatype = DATA_TYPES[datatype]
+        if symbol >= 0:
+            tree_node.symbol = decoded_symbols[symbol]
+        if stack:
+            parent = stack[-1]
+            parent[0].children.append(tree_node)
+            parent[1] -= 1
+            if parent[1] == 0:
+                stack.pop()
+        else:
+            root = tree_node
+        if child_count:
+            stack.append([tree_node, child_count])
+    return root
+
+def codegen_function_task(task):
+    """
+    Body of a codegen worker process: codegen one function into a module of its own
+
+    Args:
+        - task(tuple): (name of the function, encode_function() of it, whether to use SSA locals,
+          number of string constants of the main module, the names of the ones made here start after them)
+
+    Returns:
+        - str: IR of the module, with the function defined and the global values it uses declared
+    """
+    name, (nodes, symbols, declarations), ssa, constants = task
+    ctx = CompilationContext(None, CompileOptions(ssa=ssa))
+    ctx.string_pool.counter = constants
+    declare_runtime_functions(ctx)
+    for declared_name, typ, is_function, unnamed_addr in declarations:
+        if declared_name == name or declared_name in ctx.module.globals:
+            continue
+        if is_function:
+            ir.Function(ctx.module, typ, name=declared_name)
+        else:
+            variable = ir.GlobalVariable(ctx.module, typ, name=declared_name)
+            variable.global_constant = True
+            variable.unnamed_addr = unnamed_addr
+    codegen(ctx, decode_function(nodes, symbols, ctx.module))
+    return str(ctx.module)
+
+# Process pools of parallel_check_functions and parallel_codegen, kept between compilations, by number of workers
+worker_executors = {}
+worker_executors_lock = threading.Lock()
+
+def worker_pool(jobs):
+    """
+    Returns:
+        - ProcessPoolExecutor: the pool of jobs worker processes, started on first use
+    """
+    with worker_executors_lock:
+        executor = worker_executors.get(jobs)
+        if executor is None:
+            # forkserver: forking a process whose other threads may hold locks (visualization, compile server) is unsafe
+            context = multiprocessing.get_context("forkserver")
+            executor = worker_executors[jobs] = ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+        return executor
+
+def check_functions_task(task):
+    """
+    Body of a semantic analysis worker process: check function bodies against the global scope
+
+    Args:
+        - task(tuple): (global_symbols, functions) where global_symbols are the (lexeme, DataType value)
+          of the global scope and functions are FUNC_DECL subtrees flattened as in encode_function()
+
+    Returns:
+        - list of tuple: (error, annotations, symbols, scope_count) of each function, see parallel_check_functions()
+    """
+    global_symbols, functions = task
+    ctx = CompilationContext(None, CompileOptions())
+    symbol_table = ctx.symbol_table
+    symbol_table.push_scope()
+    symbol_index = {}
+    for lexeme, datatype in global_symbols:
+        symbol_index[symbol_table.insert(lexeme, DATA_TYPES[datatype])] = len(symbol_index)
+    results = []
+    for records in functions:
+        node = decode_function(records, (), None)
+        nodes = flatten_subtree(node)
+        scope_base = symbol_table.id_counter
+        error = check_function_body(ctx, node)
+        local_index = {}
+        symbols = []        # (lexeme, DataType value, scope ID relative to scope_base) of each local symbol
+        annotations = []    # (DataType value, index of the symbol or -1, new order of the children or None) of each node
+        for tree_node in nodes:
+            symbol = tree_node.symbol
+            index = -1
+            if symbol is not None:
+                index = symbol_index.get(symbol)
+                if index is None:
+                    index = local_index.get(symbol)
+                if index is None:
+                    index = local_index[symbol] = len(global_symbols) + len(symbols)
+                    symbols.append((symbol.lexeme, symbol.datatype.value, symbol.scope_id - scope_base))
+            order = [child.index for child in tree_node.children]
+            annotations.append((tree_node.datatype.value, index, order if order != sorted(order) else None))
+        results.append((error.args if error is not None else None, annotations, symbols, symbol_table.id_counter - scope_base))
+    return results
+
+def parallel_check_functions(ctx, functions):
+    """
+    Second phase of semantic analysis with the function bodies checked concurrently in a process pool
+
+    Each worker gets the global scope and chunks of flattened function bodies, and sends back the data type,
+    symbol and children order of every node, which are set on the nodes here. Scope IDs are given to the functions
+    in source order, as the serial analysis would.
+
+    Args:
+        - functions(list of (int, TreeNode)): returned by declare_top_level()
+
+    Returns:
+        - list of (int, str, ValueError): the errors of the functions, as gathered by semantic_handler_program()
+    """
+    jobs = ctx.options.analyze_jobs
+    symbol_table = ctx.symbol_table
+    global_symbols = list(symbol_table.symbols.values())
+    flattened = [flatten_subtree(function) for position, function in functions]
+    records = [[(node.nodetype.position, node.datatype.value, node.lexeme, -1, len(node.children)) for node in nodes]
+               for nodes in flattened]
+    chunk = max(1, -(-len(records) // (jobs * 4)))
+    spec = [(symbol.lexeme, symbol.datatype.value) for symbol in global_symbols]
+    tasks = [(spec, records[start:start + chunk]) for start in range(0, len(records), chunk)]
+    with trace_span(ctx, "check workers"):
+        results = [result for results in worker_pool(jobs).map(check_functions_task, tasks) for result in results]
+    errors = []
+    for (position, function), nodes, (error, annotations, symbols, scope_count) in zip(functions, flattened, results):
+        scope_base = symbol_table.id_counter
+        symbol_table.id_counter += scope_count
+        if error is not None:
+            errors.append((position, declaration_label(function), ValueError(*error)))
+            continue
+        symbols = global_symbols + [Symbol(lexeme, DATA_TYPES[datatype], scope_base + scope_id)
+                                    for lexeme, datatype, scope_id in symbols]
+        for node, (datatype, index, order) in zip(nodes, annotations):
+            node.datatype = DATA_TYPES[datatype]
+            if index >= 0:
+                node.symbol = symbols[index]
+            if order is not None:
+                node.children = [nodes[position] for position in order]
+    if ctx.stats is not None:
+        ctx.stats.count("parallel functions", len(functions))
+    return errors
+
+def parallel_codegen(ctx):
+    """
+    Codegen with the function bodies lowered concurrently in a process pool
+
+    Global declarations are lowered here and every function is declared, in source order. Then each function
+    body is lowered by a worker into a module of its own, declaring the global values it uses, and the modules
+    are linked into this one in source order, so the functions keep the order and the meaning of serial codegen.
+    String literals are pooled per module, the linker renames the private constants of different workers apart.
+    The module is replaced by the IR of the linked module.
+
+    Returns:
+        - llvm.ModuleRef: the linked module
+    """
+    jobs = ctx.options.codegen_jobs
+    functions = []  # list of (name, FUNC_DECL node)
+    for node in ctx.root_node.children:
+        if node.nodetype != NodeType.FUNC_DECL:
+            codegen(ctx, node)
+            continue
+        ret_type, func_name_str, args, stmts = node.children
+        name = func_name_str.lexeme if func_name_str.lexeme == "main" else func_name_str.symbol.unique_name
+        func_type = ir.FunctionType(ir_type(ret_type.datatype), [ir_type(arg[0].datatype) for arg in args.children])
+        func_name_str.symbol.value = ctx.ir_map[name] = ir.Function(ctx.module, func_type, name=name)
+        functions.append((name, node))
+    with trace_span(ctx, "encode functions"):
+        tasks = [(name, encode_function(ctx, node), ctx.options.ssa, ctx.string_pool.counter) for name, node in functions]
+    with trace_span(ctx, "codegen workers"):
+        chunksize = max(1, len(tasks) // (jobs * 4))
+        function_irs = list(worker_pool(jobs).map(codegen_function_task, tasks, chunksize=chunksize))
+    with trace_span(ctx, "link functions"):
+        context = ctx.get_llvm_context()
+        linked = llvm.parse_assembly(str(ctx.module), context=context)
+        # private global values cannot be referenced from the other modules, make them external while linking
+        private = []
+        for variable in linked.global_variables:
+            if variable.linkage == llvm.Linkage.private:
+                private.append(variable.name)
+                variable.linkage = llvm.Linkage.external
+        for function_ir in function_irs:
+            linked.link_in(llvm.parse_assembly(function_ir, context=context))
+        private = set(private)
+        for variable in linked.global_variables:
+            if variable.name in private:
+                variable.linkage = llvm.Linkage.private
+    if ctx.stats is not None:
+        ctx.stats.count("parallel functions", len(tasks))
+    # keep only the global values of the linked IR, the module prints its own header
+    text = str(linked)
+    body = text[text.index("\n\n") + 2:] if "\n\n" in text else ""
+    module = ir.Module(name=ctx.module.name)
+    module.add_global(StitchedFragment("linked", body))
+    ctx.module = module
+    return linked
+
+class Pass:
+    """
+    One step of the compiler pipeline
+
+    A pass is a function taking the CompilationContext and reading/writing its attributes,
+    e.g. "load" writes ctx.root_node and "analyze" reads it
+    """
+    def __init__(self, name, run, requires=(), enabled=True, description=""):
+        self.name = name                # [str] name used by --enable/--disable
+        self.run = run                  # [function] run(ctx)
+        self.requires = requires        # [tuple of str] passes that must have run before this one
+        self.enabled = enabled          # [bool] optional passes are registered but disabled
+        self.description = description  # [str] shown by --list-passes
+
+class PassManager:
+    """
+    Ordered list of registered passes, run with dependency checks and per-pass timing
+    """
+    def __init__(self):
+        self.passes = []        # registered passes in pipeline order
+
+    def get(self, name):
+        for compiler_pass in self.passes:
+            if compiler_pass.name == name:
+                return compiler_pass
+        raise ValueError("Unknown pass: ", name)
+
+    def register(self, compiler_pass, after=None, before=None):
+        """
+        Register a pass at the end of the pipeline, or right after/before an already registered pass
+        """
+        if after is not None:
+            position = self.passes.index(self.get(after)) + 1
+        elif before is not None:
+            position = self.passes.index(self.get(before))
+        else:
+            position = len(self.passes)
+        self.passes.insert(position, compiler_pass)
+        return compiler_pass
+
+    def enable(self, name):
+        self.get(name).enabled = True
+
+    def disable(self, name):
+        self.get(name).enabled = False
+
+    def pipeline(self):
+        """
+        Returns:
+            - list of Pass: enabled passes in order, after checking that dependencies run before them
+        """
+        enabled = [compiler_pass for compiler_pass in self.passes if compiler_pass.enabled]
+        done = set()
+        for compiler_pass in enabled:
+            for required in compiler_pass.requires:
+                if required not in done:
+                    raise ValueError("Pass " + compiler_pass.name + " requires pass " + required + " to run before it")
+            done.add(compiler_pass.name)
+        return enabled
+
+    def run(self, ctx):
+        """
+        Run the enabled passes on ctx, the time of each pass is recorded in ctx.timings
+        """
+        ctx.timings = []
+        if ctx.stats is not None:
+            ctx.stats.start()
+        try:
+            for compiler_pass in self.pipeline():
+                if compiler_pass.name in ctx.skipped_passes:
+                    continue
+                start = time.perf_counter()
+                if ctx.stats is not None:
+                    with ctx.stats.pass_span(compiler_pass.name):
+                        compiler_pass.run(ctx)
+                else:
+                    compiler_pass.run(ctx)
+                ctx.timings.append((compiler_pass.name, time.perf_counter() - start))
+        finally:
+            if ctx.stats is not None:
+                ctx.stats.stop()
+        return ctx
+
+def print_timings(timings, file=sys.stderr):
+    total = sum(seconds for _, seconds in timings)
+    print("===  Pass execution timing report  ===", file=file)
+    for name, seconds in timings:
+        percent = 100.0 * seconds / total if total > 0 else 0.0
+        print("%10.4fs (%5.1f%%)  %s" % (seconds, percent, name), file=file)
+    print("%10.4fs (100.0%%)  Total" % total, file=file)
+
+class PassStats:
+    """
+    What CompileStats measured in one pass
+    """
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start      # [float] perf_counter() when the pass started
+        self.seconds = 0.0      # [float] wall time
+        self.peak_bytes = None  # [int] peak of the memory traced by tracemalloc during the pass, None without memory tracing
+        self.counters = {}      # map<str, int> e.g. "ast nodes", "ir instructions"
+        self.handlers = {}      # map<str, [int, float]> from NodeType name to [calls, seconds] of its handler, see walk_profiled()
+
+class CompileStats:
+    """
+    Time, peak memory and counters of the passes and of the AST handlers of one compilation (--stats),
+    and the spans exported as Chrome trace events (--trace)
+
+    Nothing is collected unless a CompileStats is set in ctx.stats, the compiler only checks for None
+    """
+    def __init__(self, memory=True):
+        self.memory = memory    # [bool] trace the peak memory of each pass with tracemalloc, which slows Python down
+        self.passes = []        # list of PassStats in pipeline order
+        self.spans = []         # list of (name, start, seconds): other timed parts, e.g. str(module)
+        self.origin = None      # [float] perf_counter() of the start of the compilation
+        self.started_tracing = False    # [bool] tracemalloc was started by this CompileStats, and is stopped by it
+
+    def start(self):
+        self.origin = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    @contextmanager
+    def pass_span(self, name):
+        """
+        Measure the pass name, its counters and handlers are recorded until it exits
+        """
+        if self.memory:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        current = PassStats(name, time.perf_counter())
+        self.passes.append(current)
+        try:
+            yield current
+        finally:
+            current.seconds = time.perf_counter() - current.start
+            if self.memory:
+                current.peak_bytes = tracemalloc.get_traced_memory()[1] - memory_before
+
+    @contextmanager
+    def span(self, name):
+        """
+        Time a part of a pass, exported as its own trace event
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.perf_counter() - start))
+
+    def count(self, name, value):
+        """
+        Add value to the counter name of the current pass
+        """
+        counters = self.passes[-1].counters
+        counters[name] = counters.get(name, 0) + value
+
+    def handler_profile(self):
+        return self.passes[-1].handlers
+
+def trace_span(ctx, name):
+    """
+    Returns:
+        - context manager timing name in ctx.stats, doing nothing when the stats are off
+    """
+    return ctx.stats.span(name) if ctx.stats is not None else nullcontext()
+
+def count_nodes(root_node):
+    count = 0
+    stack = [root_node]
+    while stack:
+        count += 1
+        stack.extend(stack.pop().children)
+    return count
+
+def count_instructions(module):
+    """
+    Returns:
+        - (int, int, int): functions with a body, basic blocks and instructions of an ir.Module or llvm.ModuleRef
+    """
+    functions = blocks = instructions = 0
+    for function in module.functions:
+        function_blocks = list(function.blocks)
+        if function_blocks:
+            functions += 1
+        for block in function_blocks:
+            blocks += 1
+            instructions += sum(1 for _ in block.instructions)
+    return functions, blocks, instructions
+
+def print_stats(stats, file=sys.stderr, top_handlers=8):
+    total = sum(pass_stats.seconds for pass_stats in stats.passes)
+    print("===  Compilation statistics  ===", file=file)
+    for pass_stats in stats.passes:
+        percent = 100.0 * pass_stats.seconds / total if total > 0 else 0.0
+        peak = "%8.2f MiB" % (pass_stats.peak_bytes / 2**20) if pass_stats.peak_bytes is not None else "           -"
+        counters = ", ".join("%s: %d" % item for item in pass_stats.counters.items())
+        print("%10.4fs (%5.1f%%) %s  %-10s %s" % (pass_stats.seconds, percent, peak, pass_stats.name, counters), file=file)
+        handlers = sorted(pass_stats.handlers.items(), key=lambda item: -item[1][1])
+        for nodetype, (calls, seconds) in handlers[:top_handlers]:
+            print("%38s %-16s %8d calls %10.4fs" % ("", nodetype, calls, seconds), file=file)
+    for name, _, seconds in stats.spans:
+        print("%10.4fs          %14s  %s" % (seconds, "", name), file=file)
+    print("%10.4fs (100.0%%)  Total" % total, file=file)
+
+def write_chrome_trace(stats, trace_path):
+    """
+    Write the passes and spans as complete ("X") events of the Chrome trace event format, for chrome://tracing or Perfetto,
+    with the counters, peak memory and handler profile of each pass in its args
+    """
+    pid, tid = os.getpid(), threading.get_ident()
+
+    def microseconds(start):
+        return (start - stats.origin) * 1e6
+
+    events = []
+    for pass_stats in stats.passes:
+        args = dict(pass_stats.counters)
+        if pass_stats.peak_bytes is not None:
+            args["peak bytes"] = pass_stats.peak_bytes
+        for nodetype, (calls, seconds) in pass_stats.handlers.items():
+            args["handler " + nodetype] = "%d calls, %.6fs" % (calls, seconds)
+        events.append({"name": pass_stats.name, "cat": "pass", "ph": "X", "pid": pid, "tid": tid,
+                       "ts": microseconds(pass_stats.start), "dur": pass_stats.seconds * 1e6, "args": args})
+    for name, start, seconds in stats.spans:
+        events.append({"name": name, "cat": "span", "ph": "X", "pid": pid, "tid": tid,
+                       "ts": microseconds(start), "dur": seconds * 1e6})
+    with open(trace_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def pass_load(ctx):
+    # streaming keeps the AST in flat arrays, e.g. over the mapped binary AST, instead of one object per node
+    ctx.root_node = construct_tree_from_dot(ctx.dot_path, compact=ctx.options.compact or ctx.options.stream)
+    if ctx.stats is not None:
+        ctx.stats.count("ast nodes", count_nodes(ctx.root_node))
+    if logger.isEnabledFor(logging.DEBUG):
+        print_tree(ctx.root_node)
+
+def pass_analyze(ctx):
+    if ctx.options.incremental and ctx.root_node.nodetype == NodeType.PROGRAM:
+        ctx.fragment_cache = FRAGMENT_CACHE
+        incremental_semantic_analysis(ctx, ctx.root_node)
+    else:
+        semantic_analysis(ctx, ctx.root_node)
+
+def pass_visualize(ctx):
+    options = ctx.options
+    records = snapshot_tree(ctx.root_node, options.viz_depth, options.viz_subtree, options.viz_functions, options.viz_max_nodes)
+    ctx.visualization = Visualization(records, options.png_path)
+
+def wait_visualization(ctx):
+    """
+    Wait for the image of the visualize pass to be written
+    """
+    if ctx.visualization is not None:
+        visualization, ctx.visualization = ctx.visualization, None
+        visualization.wait()
+
+def pass_fold(ctx):
+    if ctx.fragment_cache is not None:
+        # only the declarations compiled again, the cached ones are stitched from their folded IR
+        for plan in ctx.declarations:
+            if plan.fragment is None:
+                plan.node = fold_constants(ctx, plan.node)
+    else:
+        ctx.root_node = fold_constants(ctx, ctx.root_node)
+
+def pass_codegen(ctx):
+    initialize_llvm()
+    declare_runtime_functions(ctx)
+    built = None    # module to count the IR of, ctx.module unless it was replaced by linked IR
+    if ctx.fragment_cache is not None:
+        incremental_codegen(ctx)
+    elif ctx.options.codegen_jobs > 1 and ctx.root_node.nodetype == NodeType.PROGRAM:
+        built = parallel_codegen(ctx)
+    else:
+        codegen(ctx, ctx.root_node)
+    if ctx.stats is not None:
+        functions, blocks, instructions = count_instructions(built if built is not None else ctx.module)
+        ctx.stats.count("ir functions", functions)
+        ctx.stats.count("ir blocks", blocks)
+        ctx.stats.count("ir instructions", instructions)
+
+def pass_verify(ctx):
+    llvm.parse_assembly(str(ctx.module), context=ctx.get_llvm_context()).verify()
+
+# -O level -> (speed level, size level, inlining threshold), the thresholds are the ones of clang
+OPT_LEVELS = {
+    "0": (0, 0, None),
+    "1": (1, 0, None),
+    "2": (2, 0, 225),
+    "3": (3, 0, 275),
+    "s": (2, 1, 75),
+    "z": (2, 2, 25),
+}
+
+# --passes name -> (method of llvm.ModulePassManager, arguments)
+OPT_PASSES = {
+    "mem2reg": ("add_sroa_pass", ()),       # llvmlite exposes promotion of allocas through SROA
+    "sroa": ("add_sroa_pass", ()),
+    "instcombine": ("add_instruction_combining_pass", ()),
+    "reassociate": ("add_reassociate_expressions_pass", ()),
+    "gvn": ("add_gvn_pass", ()),
+    "sccp": ("add_sccp_pass", ()),
+    "dce": ("add_dead_code_elimination_pass", ()),
+    "adce": ("add_aggressive_dead_code_elimination_pass", ()),
+    "dse": ("add_dead_store_elimination_pass", ()),
+    "simplifycfg": ("add_cfg_simplification_pass", ()),
+    "jump-threading": ("add_jump_threading_pass", ()),
+    "loop-simplify": ("add_loop_simplification_pass", ()),
+    "loop-rotate": ("add_loop_rotate_pass", ()),
+    "licm": ("add_licm_pass", ()),
+    "loop-unroll": ("add_loop_unroll_pass", ()),
+    "loop-deletion": ("add_loop_deletion_pass", ()),
+    "loop-reduce": ("add_loop_strength_reduce_pass", ()),
+    "inline": ("add_function_inlining_pass", (225,)),
+    "always-inline": ("add_always_inliner_pass", ()),
+    "ipsccp": ("add_ipsccp_pass", ()),
+    "globalopt": ("add_global_optimizer_pass", ()),
+    "globaldce": ("add_global_dce_pass", ()),
+    "constmerge": ("add_constant_merge_pass", ()),
+    "tailcallelim": ("add_tail_call_elimination_pass", ()),
+}
+
+def optimize_module(ir_module, opt_level="2", passes=None, context=None):
+    """
+    Optimize the generated module in-process, instead of running opt on the written .ll file
+
+    Args:
+        - ir_module(ir.Module): module built by codegen
+        - opt_level(str): one of OPT_LEVELS, used when passes is None
+        - passes(list of str): names in OPT_PASSES to run in this order, instead of the -O pipeline
+        - context(llvm.LLVMContext): context to parse the module into, None for the global context
+
+    Returns:
+        - llvm.ModuleRef: the verified and optimized module
+    """
+    initialize_llvm()
+    llvm_module = llvm.parse_assembly(str(ir_module), context=context)
+    llvm_module.verify()
+    if passes is not None:
+        module_pass_manager = llvm.create_module_pass_manager()
+        for name in passes:
+            if name not in OPT_PASSES:
+                raise ValueError("Unknown optimization pass: ", name)
+            method, args = OPT_PASSES[name]
+            getattr(module_pass_manager, method)(*args)
+        module_pass_manager.run(llvm_module)
+        return llvm_module
+    if opt_level not in OPT_LEVELS:
+        raise ValueError("Unknown optimization level: ", opt_level)
+    speed_level, size_level, inlining_threshold = OPT_LEVELS[opt_level]
+    if speed_level == 0:
+        return llvm_module
+    pass_manager_builder = llvm.create_pass_manager_builder()
+    pass_manager_builder.opt_level = speed_level
+    pass_manager_builder.size_level = size_level
+    if inlining_threshold is not None:
+        pass_manager_builder.inlining_threshold = inlining_threshold
+    pass_manager_builder.loop_vectorize = speed_level >= 2 and size_level == 0
+    pass_manager_builder.slp_vectorize = speed_level >= 2 and size_level == 0
+    # function passes first (per function), then the module pipeline, same order as opt
+    function_pass_manager = llvm.create_function_pass_manager(llvm_module)
+    pass_manager_builder.populate(function_pass_manager)
+    function_pass_manager.initialize()
+    for function in llvm_module.functions:
+        function_pass_manager.run(function)
+    function_pass_manager.finalize()
+    module_pass_manager = llvm.create_module_pass_manager()
+    pass_manager_builder.populate(module_pass_manager)
+    module_pass_manager.run(llvm_module)
+    return llvm_module
+
+def pass_optimize(ctx):
+    opt_level = ctx.options.opt_level if ctx.options.opt_level is not None else "2"
+    ctx.llvm_module = optimize_module(ctx.module, opt_level, ctx.options.opt_passes, ctx.get_llvm_context())
+    ctx.ir_text = None
+
+def output_ir(ctx):
+    """
+    Returns:
+        - str: the optimized IR if the optimize pass ran, otherwise the IR built by codegen,
+          converted to text only once for all the passes that need it
+    """
+    if ctx.ir_text is None:
+        with trace_span(ctx, "str(module)"):
+            ctx.ir_text = str(ctx.llvm_module if ctx.llvm_module is not None else ctx.module)
+    return ctx.ir_text
+
+# runtime.c next to this file, compiled for the host to back the builtins in JIT mode
+RUNTIME_C = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runtime.c")
+RUNTIME_LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runtime.so")
+
+runtime_library_loaded = False
+def load_runtime_library(runtime_c=RUNTIME_C, library_path=RUNTIME_LIBRARY):
+    """
+    Compile runtime.c into a shared library for the host (only when it is missing or outdated),
+    and load it into the process, so that JIT code calling print_int, string_cat, ... binds to it
+
+    Args:
+        - runtime_c(str): path of runtime.c
+        - library_path(str): path of the shared library to build
+    """
+    global runtime_library_loaded
+    with process_lock:
+        if runtime_library_loaded:
+            return
+        if not os.path.exists(library_path) or os.path.getmtime(library_path) < os.path.getmtime(runtime_c):
+            compiler = os.environ.get("CC", "cc")
+            subprocess.run([compiler, "-shared", "-fPIC", "-O2", runtime_c, "-o", library_path], check=True)
+        llvm.load_library_permanently(library_path)
+        runtime_library_loaded = True
+
+host_machine = None
+def host_target_machine():
+    """
+    Returns:
+        - llvm.TargetMachine: target machine of the host, created once per process
+    """
+    global host_machine
+    initialize_llvm()
+    with process_lock:
+        if host_machine is None:
+            host_machine = llvm.Target.from_default_triple().create_target_machine()
+    return host_machine
+
+def jit_run(ir_text, capture=True, context=None):
+    """
+    JIT-compile the module for the host with MCJIT and run its main function in-process
+
+    Args:
+        - ir_text(str): LLVM IR of the program, the target triple of the module is replaced by the host's
+        - capture(bool): capture what the program writes to stdout (fd 1) instead of letting it through,
+          fd 1 is shared by the whole process, so captured runs are serialized by jit_lock
+        - context(llvm.LLVMContext): context to parse the module into, None for the global context
+
+    Returns:
+        - (int, str): exit code returned by main, and the captured stdout ("" if not captured)
+    """
+    load_runtime_library()
+    target_machine = host_target_machine()
+    llvm_module = llvm.parse_assembly(ir_text, context=context)
+    llvm_module.triple = target_machine.triple
+    llvm_module.data_layout = str(target_machine.target_data)
+    llvm_module.verify()
+    # the engine owns the target machine it is given and frees it with itself, so it cannot be the shared host_machine
+    engine = llvm.create_mcjit_compiler(llvm_module, llvm.Target.from_default_triple().create_target_machine())
+    engine.finalize_object()
+    engine.run_static_constructors()
+    main_function = ctypes.CFUNCTYPE(ctypes.c_int32)(engine.get_function_address("main"))
+    if not capture:
+        exit_code = main_function()
+        libc.fflush(None)
+        return exit_code, ""
+    # the runtime prints with printf, so redirect fd 1 itself rather than sys.stdout
+    with jit_lock, tempfile.TemporaryFile() as captured:
+        sys.stdout.flush()
+        saved_stdout = os.dup(1)
+        os.dup2(captured.fileno(), 1)
+        try:
+            exit_code = main_function()
+            libc.fflush(None)
+        finally:
+            os.dup2(saved_stdout, 1)
+            os.close(saved_stdout)
+        captured.seek(0)
+        output = captured.read().decode("utf8", errors="replace")
+    return exit_code, output
+
+# C library of the process, used to flush the stdio buffers written by the runtime
+libc = ctypes.CDLL(None)
+# Serializes the redirection of fd 1 in jit_run()
+jit_lock = threading.Lock()
+
+# LLVM IR of runtime.c for RISC-V, built by verify.sh
+RUNTIME_IR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runtime.ll")
+
+def pass_link(ctx):
+    llvm_context = ctx.get_llvm_context()
+    llvm_module = llvm.parse_assembly(output_ir(ctx), context=llvm_context)
+    with open(RUNTIME_IR) as f:
+        runtime_module = llvm.parse_assembly(f.read(), context=llvm_context)
+    # take the target of the runtime, which is the target of the linked program
+    llvm_module.triple = runtime_module.triple
+    llvm_module.data_layout = runtime_module.data_layout
+    llvm_module.link_in(runtime_module)
+    ctx.merged_module = llvm_module
+    ctx.merged_ir = str(llvm_module)
+    with open(ctx.options.merged_path, 'w') as f:
+        f.write(ctx.merged_ir)
+
+# Native code emission
+#
+# Assembly and object files are emitted in-process by llvmlite target machines, instead of llc and the
+# cross gcc on the written .ll file. A target machine is created once per process and optimization level,
+# and the program is parsed once for all the targets of a compilation.
+
+# Target name -> (triple, cpu, features, ABI name, whether runtime.ll is linked in when the link pass ran)
+# the RISC-V features and ABI are the ones runtime.ll was compiled with
+NATIVE_TARGETS = {
+    "riscv64": ("riscv64-unknown-linux-gnu", "generic-rv64", "+m,+a,+c", "lp64", True),
+    "x86-64": ("x86_64-unknown-linux-gnu", "x86-64", "", "", False),
+}
+NATIVE_KINDS = ("asm", "obj")
+
+all_targets_initialized = False
+target_machines = {}    # map<(str, int), (llvm.TargetMachine, threading.Lock)> by target name and optimization level
+
+def target_machine(name, opt=2):
+    """
+    Args:
+        - name(str): key of NATIVE_TARGETS
+        - opt(int): codegen optimization level, 0 to 3
+
+    Returns:
+        - (llvm.TargetMachine, threading.Lock): target machine created once per process, and the lock
+          serializing its use by the threads of the compile server
+    """
+    global all_targets_initialized
+    if name not in NATIVE_TARGETS:
+        raise ValueError("Unknown target: ", name)
+    initialize_llvm()
+    with process_lock:
+        if not all_targets_initialized:
+            llvm.initialize_all_targets()
+            llvm.initialize_all_asmprinters()
+            all_targets_initialized = True
+        machine = target_machines.get((name, opt))
+        if machine is None:
+            triple, cpu, features, abi_name, _ = NATIVE_TARGETS[name]
+            machine = target_machines[(name, opt)] = (llvm.Target.from_triple(triple).create_target_machine(
+                cpu=cpu, features=features, opt=opt, reloc="pic", codemodel="default", abiname=abi_name), threading.Lock())
+    return machine
+
+def emit_native(llvm_module, name, kind, opt=2):
+    """
+    Emit the assembly or object file of a module for a target, the module is retargeted and consumed by codegen
+
+    Returns:
+        - bytes
+    """
+    if kind not in NATIVE_KINDS:
+        raise ValueError("Unknown output kind: ", kind)
+    machine, lock = target_machine(name, opt)
+    llvm_module.triple = machine.triple
+    llvm_module.data_layout = str(machine.target_data)
+    with lock:
+        if kind == "asm":
+            return machine.emit_assembly(llvm_module).encode("utf8")
+        return machine.emit_object(llvm_module)
+
+def native_artifact_name(target, kind):
+    return "%s.%s" % (target, "s" if kind == "asm" else "o")
+
+def pass_native(ctx):
+    options = ctx.options
+    opt = OPT_LEVELS[options.opt_level][0] if options.opt_level is not None else 2
+    program = ctx.llvm_module
+    for target, kind, path in options.native:
+        if NATIVE_TARGETS.get(target, (None,) * 5)[4] and ctx.merged_module is not None:
+            source = ctx.merged_module
+        else:
+            if program is None:
+                program = llvm.parse_assembly(output_ir(ctx), context=ctx.get_llvm_context())
+            source = program
+        # codegen changes the module it runs on, each target gets a copy of the parsed one
+        data = emit_native(source.clone(), target, kind, opt)
+        ctx.native_artifacts[native_artifact_name(target, kind)] = data
+        with open(path, 'wb') as f:
+            f.write(data)
+
+# Persistent compilation cache
+#
+# Artifacts of a compilation (self IR, optimized IR, merged IR, AST png) are stored on disk under a key
+# hashing the input .dot file, the compiler version and the options that change the artifacts, so that
+# compiling an unchanged program again restores them instead of running the passes that made them.
+#
+# Layout of the cache directory:
+#     objects/<key[:2]>/<key>/<artifact>   one directory per entry, its mtime is the last use
+#     tmp/                                 entries being written, renamed into objects/ when complete
+#     lock                                 flock() serializing the updates of size and stats.json
+#     size                                 bytes used by objects/, approximately
+#     stats.json                           hits, misses, stores and evictions of all the processes
+
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+# Bumped when the layout of cache entries changes
+CACHE_FORMAT = "1"
+
+# Passes whose results are artifacts, skipped on a cache hit
+CACHED_PASSES = ("load", "analyze", "visualize", "fold", "codegen", "verify", "optimize", "link", "native")
+
+class ArtifactCache:
+    """
+    Content-addressed on-disk cache of compilation artifacts, shared by concurrent processes
+
+    Entries are written into tmp/ and renamed into place, so a reader never sees a partial entry.
+    When the cache grows over max_bytes the least recently used entries are evicted.
+    """
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes if max_bytes is not None else DEFAULT_CACHE_SIZE
+        self.objects = os.path.join(directory, "objects")
+        self.tmp = os.path.join(directory, "tmp")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def get(self, key, names):
+        """
+        Args:
+            - key(str)
+            - names(list of str): artifacts needed, the entry is a miss if one of them is missing
+
+        Returns:
+            - dict: from artifact name to bytes, None on a miss
+        """
+        entry = self.entry_path(key)
+        artifacts = {}
+        try:
+            for name in names:
+                with open(os.path.join(entry, name), "rb") as f:
+                    artifacts[name] = f.read()
+            os.utime(entry)
+        except FileNotFoundError:
+            # not cached, or evicted while reading
+            self.update_stats(misses=1)
+            return None
+        self.update_stats(hits=1)
+        return artifacts
+
+    def put(self, key, artifacts):
+        """
+        Store the artifacts (dict from name to bytes) of key, replacing an older entry
+        """
+        staging = tempfile.mkdtemp(dir=self.tmp)
+        size = 0
+        for name, data in artifacts.items():
+            with open(os.path.join(staging, name), "wb") as f:
+                f.write(data)
+            size += len(data)
+        entry = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # an entry is already there (e.g. written by a concurrent worker), move it away and retry once
+            self.remove(entry)
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                self.remove(staging)
+                return
+        self.update_stats(stores=1, size=size)
+
+    def remove(self, path):
+        """
+        Remove an entry (or staging directory): renamed into tmp/ first, so readers see all of it or nothing
+        """
+        trash = tempfile.mkdtemp(dir=self.tmp)
+        try:
+            os.rename(path, os.path.join(trash, "entry"))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def update_stats(self, size=0, **counts):
+        """
+        Add to the counters of stats.json and to the size, and evict entries if the cache is too big
+        """
+        with open(os.path.join(self.directory, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = self.read_stats()
+            for name, count in counts.items():
+                stats[name] = stats.get(name, 0) + count
+            total = self.read_size() + size
+            if total > self.max_bytes:
+                total, evicted = self.evict()
+                stats["evictions"] = stats.get("evictions", 0) + evicted
+            self.write_file("stats.json", json.dumps(stats))
+            self.write_file("size", str(total))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache uses 3/4 of max_bytes, called under the lock
+
+        Returns:
+            - (int, int): bytes used and number of entries evicted
+        """
+        entries = []
+        total = 0
+        for shard in os.scandir(self.objects):
+            for entry in os.scandir(shard.path):
+                size = sum(artifact.stat().st_size for artifact in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+                total += size
+        entries.sort()
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes * 3 // 4:
+                break
+            self.remove(path)
+            total -= size
+            evicted += 1
+        return total, evicted
+
+    def read_stats(self):
+        try:
+            with open(os.path.join(self.directory, "stats.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def read_size(self):
+        try:
+            with open(os.path.join(self.directory, "size")) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_file(self, name, text):
+        # written aside and renamed, so that a process reading without the lock never sees half a file
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def print_stats(self, file=sys.stderr):
+        stats = self.read_stats()
+        hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+        print("===  Compilation cache  ===", file=file)
+        print("%s: %d hits, %d misses (%.1f%% hit rate), %d stores, %d evictions, %.1f MiB of %.1f MiB" % (
+            self.directory, hits, misses, 100.0 * hits / (hits + misses) if hits + misses else 0.0,
+            stats.get("stores", 0), stats.get("evictions", 0), self.read_size() / 2**20, self.max_bytes / 2**20), file=file)
+
+compiler_digest = None
+def compiler_version():
+    """
+    Returns:
+        - str: hash of this compiler, its LLVM and the runtime IR it links, part of every cache key
+    """
+    global compiler_digest
+    if compiler_digest is None:
+        digest = hashlib.sha256(CACHE_FORMAT.encode())
+        digest.update(".".join(map(str, llvm.llvm_version_info)).encode())
+        for path in (os.path.abspath(__file__), RUNTIME_IR) + tuple(os.path.join(PARSER_DIR, name) for name in PARSER_SOURCES):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+        compiler_digest = digest.hexdigest()
+    return compiler_digest
+
+def cache_key(dot_path, options):
+    """
+    Key of a compilation in the ArtifactCache: the input, the compiler and the options changing the artifacts
+    """
+    digest = hashlib.sha256(compiler_version().encode())
+    with open(dot_path, "rb") as f:
+        digest.update(hashlib.sha256(f.read()).digest())
+    digest.update(repr((options.opt_level, options.opt_passes, sorted(options.enable), sorted(options.disable), options.ssa,
+                          options.codegen_jobs > 1, options.merged_path is not None, os.path.splitext(options.png_path or "")[1].lower(),
+                          sorted((target, kind) for target, kind, _ in options.native), options.viz_depth, options.viz_subtree, sorted(options.viz_functions), options.viz_max_nodes)).encode())
+    return digest.hexdigest()
+
+def cached_artifact_names(options):
+    """
+    Returns:
+        - list of str: artifacts the compilation makes with these options
+    """
+    names = ["self.ll"]
+    if options.opt_level is not None or options.opt_passes is not None:
+        names.append("opt.ll")
+    if options.merged_path is not None:
+        names.append("merged.ll")
+    if options.png_path is not None and "visualize" not in options.disable:
+        names.append("ast.png")
+    for target, kind, _ in options.native:
+        names.append(native_artifact_name(target, kind))
+    return names
+
+def artifact_cache(options):
+    return ArtifactCache(options.cache_dir, options.cache_size)
+
+def pass_restore(ctx):
+    options = ctx.options
+    ctx.cache_key = cache_key(ctx.dot_path, options)
+    names = cached_artifact_names(options)
+    artifacts = artifact_cache(options).get(ctx.cache_key, names)
+    if artifacts is None:
+        return
+    ctx.ir_text = artifacts["opt.ll" if "opt.ll" in artifacts else "self.ll"].decode("utf8")
+    if "merged.ll" in artifacts:
+        ctx.merged_ir = artifacts["merged.ll"].decode("utf8")
+        with open(options.merged_path, 'wb') as f:
+            f.write(artifacts["merged.ll"])
+    if "ast.png" in artifacts:
+        with open(options.png_path, 'wb') as f:
+            f.write(artifacts["ast.png"])
+    for target, kind, path in options.native:
+        with open(path, 'wb') as f:
+            f.write(artifacts[native_artifact_name(target, kind)])
+    ctx.skipped_passes.update(CACHED_PASSES)
+    ctx.skipped_passes.add("store")
+
+def pass_store(ctx):
+    options = ctx.options
+    if ctx.llvm_module is not None:
+        artifacts = {"self.ll": str(ctx.module).encode("utf8"), "opt.ll": output_ir(ctx).encode("utf8")}
+    else:
+        artifacts = {"self.ll": output_ir(ctx).encode("utf8")}
+    if ctx.merged_ir is not None:
+        artifacts["merged.ll"] = ctx.merged_ir.encode("utf8")
+    artifacts.update(ctx.native_artifacts)
+    wait_visualization(ctx)
+    if "ast.png" in cached_artifact_names(options) and os.path.exists(options.png_path):
+        with open(options.png_path, 'rb') as f:
+            artifacts["ast.png"] = f.read()
+    artifact_cache(options).put(ctx.cache_key, artifacts)
+
+def pass_run(ctx):
+    ctx.exit_code, ctx.stdout = jit_run(output_ir(ctx), context=ctx.get_llvm_context())
+
+def pass_emit(ctx):
+    with open(ctx.options.ll_path, 'w') as f:
+        f.write(output_ir(ctx))
+
+def pass_print(ctx):
+    print(output_ir(ctx), file=ctx.out)
+
+def stream_globals(ctx, outputs):
+    """
+    Write the global values added to the module since the last call and drop them from the module,
+    function bodies are dropped too, so that only their declarations stay referenced by the symbols
+
+    The text written over all the calls is the one str(module) would have made
+    """
+    module = ctx.module
+    for value in module.globals.values():
+        text = "\n" + str(value)
+        for output in outputs:
+            output.write(text)
+        if isinstance(value, ir.Function):
+            # the local names are registered in the scope of the function
+            value.blocks = []
+            value.scope = type(value.scope)()
+    # the names stay registered in module.scope, so later values cannot take them
+    module.globals.clear()
+    ctx.ir_map = {}
+    ctx.builder = ir.IRBuilder()
+
+def release_declaration(root, position, node):
+    """
+    Drop what the AST keeps of a compiled top-level declaration: a TreeNode subtree is unlinked from the
+    root, the nodes of a CompactTree (flat arrays) only lose their symbols
+    """
+    if isinstance(node, CompactNode):
+        for compact_node in flatten_subtree(node):
+            compact_node.symbol = None
+    else:
+        root.children[position] = None
+
+def pass_stream(ctx):
+    """
+    Streaming compilation: analyze the globals and the function signatures, then analyze, fold and lower one
+    function at a time, writing its IR to the .ll file (and stdout) and releasing its subtree before the next one,
+    so that the memory does not grow with the size of the functions
+
+    It replaces analyze/fold/codegen/emit/print, and keeps no IR in memory for the passes needing the whole module.
+    The output is the same as the one of these passes, but for a program failing semantic analysis,
+    the IR of the functions before the first error is already printed.
+    """
+    options = ctx.options
+    root = ctx.root_node
+    outputs = [ctx.out] if options.print_ir else []
+    ll_file = open(options.ll_path, "w") if options.ll_path is not None else None
+    if ll_file is not None:
+        outputs.append(ll_file)
+    try:
+        module = ctx.module
+        header = '; ModuleID = "%s"\ntarget triple = "%s"\ntarget datalayout = "%s"\n' % (
+            module.name, module.triple, module.data_layout)
+        for output in outputs:
+            output.write(header)
+        declare_builtin_symbols(ctx)
+        errors = []
+        functions = declare_top_level(ctx, root, errors)
+        declare_runtime_functions(ctx)
+        if not errors:
+            for child in root.children:
+                if child.nodetype != NodeType.FUNC_DECL:
+                    codegen(ctx, child)
+            stream_globals(ctx, outputs)
+        functions.reverse()
+        while functions:
+            position, function = functions.pop()
+            error = check_function_body(ctx, function)
+            if error is not None:
+                errors.append((position, declaration_label(function), error))
+            elif not errors:
+                folded = fold_constants(ctx, function) if "fold" not in options.disable else function
+                codegen(ctx, folded)
+                folded = None
+                stream_globals(ctx, outputs)
+                if ctx.stats is not None:
+                    ctx.stats.count("streamed functions", 1)
+            release_declaration(root, position, function)
+        ctx.symbol_table.pop_scope()
+        raise_semantic_errors(errors)
+        if options.print_ir:
+            ctx.out.write("\n")
+    except BaseException:
+        if ll_file is not None:
+            ll_file.close()
+            ll_file = None
+            os.remove(options.ll_path)
+        raise
+    finally:
+        if ll_file is not None:
+            ll_file.close()
+
+def default_pass_manager(with_codegen=True):
+    """
+    Build the default pipeline: load -> analyze -> visualize -> fold -> codegen -> emit -> print
+
+    Args:
+        - with_codegen(bool): False for the <.dot> <.png before> usage, which only visualizes the parser AST
+    """
+    pass_manager = PassManager()
+    pass_manager.register(Pass("load", pass_load, description="read the AST from the .dot file"))
+    if not with_codegen:
+        pass_manager.register(Pass("visualize", pass_visualize, ("load",), description="draw the AST in the background (--visualize)"))
+        return pass_manager
+    pass_manager.register(Pass("analyze", pass_analyze, ("load",), description="semantic analysis"))
+    pass_manager.register(Pass("visualize", pass_visualize, ("analyze",), description="draw the analyzed AST in the background (--visualize)"))
+    pass_manager.register(Pass("fold", pass_fold, ("analyze",), description="fold constants and prune constant branches in the AST"))
+    pass_manager.register(Pass("codegen", pass_codegen, ("analyze",), description="LLVM IR generation"))
+    pass_manager.register(Pass("stream", pass_stream, ("load",), enabled=False, description="analyze, lower and write the IR one function at a time (--stream)"))
+    pass_manager.register(Pass("verify", pass_verify, ("codegen",), enabled=False, description="verify the LLVM IR module"))
+    pass_manager.register(Pass("optimize", pass_optimize, ("codegen",), enabled=False, description="optimize the LLVM IR in-process (-O, --passes)"))
+    pass_manager.register(Pass("link", pass_link, ("codegen",), enabled=False, description="link the LLVM IR with runtime.ll in-process (--merged-ll)"))
+    pass_manager.register(Pass("emit", pass_emit, ("codegen",), description="write the LLVM IR to the .ll file"))
+    pass_manager.register(Pass("print", pass_print, ("codegen",), description="print the LLVM IR to stdout"))
+    pass_manager.register(Pass("run", pass_run, ("codegen",), enabled=False, description="JIT-compile for the host and run main (--run)"))
+    pass_manager.register(Pass("native", pass_native, ("codegen",), enabled=False, description="emit RISC-V64/x86-64 assembly and objects in-process (--emit-asm, --emit-obj)"), after="link")
+    pass_manager.register(Pass("restore", pass_restore, enabled=False, description="restore the artifacts from the cache (--cache-dir)"), before="load")
+    pass_manager.register(Pass("store", pass_store, ("codegen",), enabled=False, description="store the artifacts in the cache (--cache-dir)"), before="emit")
+    return pass_manager
+
+def build_pass_manager(options):
+    """
+    Build the pipeline for the given CompileOptions
+
+    Returns:
+        - PassManager
+    """
+    pass_manager = default_pass_manager(with_codegen=options.codegen)
+    if options.png_path is None:
+        pass_manager.disable("visualize")
+    if not options.codegen:
+        return pass_manager
+    if options.ll_path is None:
+        pass_manager.disable("emit")
+    if not options.print_ir:
+        pass_manager.disable("print")
+    if options.stream:
+        # the passes needing the whole IR in memory are left to fail on their dependency on codegen
+        for name in ("analyze", "fold", "codegen", "emit", "print"):
+            pass_manager.disable(name)
+        pass_manager.enable("stream")
+    if options.opt_level is not None or options.opt_passes is not None:
+        pass_manager.enable("optimize")
+    if options.run:
+        pass_manager.enable("run")
+    if options.merged_path is not None:
+        pass_manager.enable("link")
+    if options.native:
+        pass_manager.enable("native")
+    if options.cache_dir is not None:
+        pass_manager.enable("restore")
+        pass_manager.enable("store")
+    for name in options.enable:
+        pass_manager.enable(name)
+    for name in options.disable:
+        pass_manager.disable(name)
+    return pass_manager
+
+class Compiler:
+    """
+    Compile many programs in one warm process: LLVM is initialized once, and every
+    compile_dot() gets a fresh CompilationContext, so concurrent calls from threads do not share state
+    """
+    def __init__(self, options=None):
+        self.options = options if options is not None else CompileOptions()
+
+    def compile_dot(self, dot_path, options=None, out=None):
+        """
+        Compile the AST in a .dot file
+
+        Args:
+            - dot_path(str): .dot file written by the parser
+            - options(CompileOptions): None to use the options of the compiler
+            - out(file): where the print pass writes the IR, None for sys.stdout
+
+        Returns:
+            - CompilationResult
+        """
+        options = options if options is not None else self.options
+        ctx = CompilationContext(dot_path, options, out)
+        try:
+            build_pass_manager(options).run(ctx)
+        finally:
+            wait_visualization(ctx)
+        ir_text = output_ir(ctx) if options.codegen and not options.stream else None
+        return CompilationResult(dot_path, ir_text, ctx.exit_code, ctx.stdout, ctx.timings, ctx.string_pool.stats(), ctx.stats)
+
+def compile_dot(dot_path, options=None, out=None):
+    """
+    Compile the AST in a .dot file with a new Compiler, see Compiler.compile_dot
+    """
+    return Compiler(options).compile_dot(dot_path, out=out)
+
+# Arguments of parse_args() naming files, the compile server resolves them against the cwd of the client
+PATH_ARGS = ("dot_path", "png_path", "ll_path", "merged_path", "cache_dir", "trace_path")
+
+def parse_args(argv):
+    """
+    Parse the command line of a4.py, also used by the compile server for the argv sent by a4client.py
+    """
+    parser = argparse.ArgumentParser(
+        usage="python3 a4.py <.dot> <.png before> [options]\n       python3 ./a4.py <.dot> <.png after> <.ll> [options]\n"
+              "       python3 ./a4.py <.dot> <.png after> --run [options]")
+    parser.add_argument("dot_path", help="AST written by the parser (.dot or .ast), or an Oat program (.oat) parsed in-process")
+    parser.add_argument("png_path", help="image of the AST, written with --visualize (.png, .svg, .dot or any format of Graphviz)")
+    parser.add_argument("ll_path", nargs="?")
+    parser.add_argument("--enable", action="append", default=[], metavar="PASS", help="enable an optional pass")
+    parser.add_argument("--disable", action="append", default=[], metavar="PASS", help="disable a pass")
+    parser.add_argument("--list-passes", action="store_true", help="list the passes of the pipeline and exit")
+    parser.add_argument("--visualize", action="store_true", help="draw the AST into the png path (in the background)")
+    parser.add_argument("--viz-depth", type=int, metavar="N", help="draw the AST up to depth N")
+    parser.add_argument("--viz-subtree", type=int, metavar="INDEX", help="draw the subtree of the node with this index")
+    parser.add_argument("--viz-function", dest="viz_functions", action="append", default=[], metavar="NAME", help="draw only this function, repeat for more")
+    parser.add_argument("--viz-max-nodes", type=int, default=DEFAULT_VIZ_MAX_NODES, metavar="N", help="draw at most N nodes, 0 for no limit (default %(default)s)")
+    parser.add_argument("--time-passes", action="store_true", help="report the time spent in each pass")
+    parser.add_argument("--stats", action="store_true", help="report the time, peak memory (tracemalloc) and counters of each pass and AST handler")
+    parser.add_argument("--trace", dest="trace_path", metavar="PATH", help="write the passes as Chrome trace events (JSON) into PATH")
+    parser.add_argument("--log-level", default="warning", choices=("debug", "info", "warning", "error"), help="level of the debug messages of the compiler on stderr")
+    parser.add_argument("--compact-ast", action="store_true", help="store the AST in a CompactTree")
+    parser.add_argument("-O", dest="opt_level", choices=sorted(OPT_LEVELS), help="optimize the LLVM IR in-process")
+    parser.add_argument("--passes", help="comma separated optimization passes to run instead of -O, e.g. mem2reg,instcombine,gvn")
+    parser.add_argument("--ssa", action="store_true", help="generate SSA values with phis for int/bool locals instead of alloca/load/store")
+    parser.add_argument("--run", action="store_true", help="run the program with the JIT instead of printing the IR, exit with its exit code")
+    parser.add_argument("--incremental", action="store_true", help="reuse the IR of functions unchanged since an earlier compilation in this process (e.g. the compile server)")
+    parser.add_argument("--stream", action="store_true", help="compile and write the IR one function at a time in bounded memory, without the passes needing the whole IR")
+    parser.add_argument("--analyze-jobs", type=int, default=1, metavar="N", help="check the function bodies in N worker processes")
+    parser.add_argument("--codegen-jobs", type=int, default=1, metavar="N", help="lower the function bodies in N worker processes and link their modules")
+    parser.add_argument("--merged-ll", dest="merged_path", help="link the LLVM IR with runtime.ll in-process and write it into this file")
+    parser.add_argument("--emit-asm", action="append", default=[], metavar="TARGET=PATH",
+                        help="write the assembly for a target (%s) into PATH, repeat for more targets" % ", ".join(NATIVE_TARGETS))
+    parser.add_argument("--emit-obj", action="append", default=[], metavar="TARGET=PATH", help="write the object file for a target into PATH")
+    parser.add_argument("--cache-dir", default=os.environ.get("A4_CACHE_DIR"), help="cache the artifacts of compilations in this directory (default $A4_CACHE_DIR)")
+    parser.add_argument("--cache-size", type=int, metavar="MB", help="size bound of the cache in MiB (default %d)" % (DEFAULT_CACHE_SIZE // 2**20))
+    parser.add_argument("--cache-stats", action="store_true", help="report the hits and misses of the cache")
+    parser.add_argument("--string-stats", action="store_true", help="report the string literals shared by the constant pool")
+    return parser.parse_args(argv)
+
+def run_args(args, out=None, err=None):
+    """
+    Compile as asked by the parsed command line
+
+    Args:
+        - args(argparse.Namespace): returned by parse_args()
+        - out(file): stdout of the compilation, None for sys.stdout
+        - err(file): stderr of the compilation, None for sys.stderr
+
+    Returns:
+        - int: exit code
+    """
+    out = out if out is not None else sys.stdout
+    err = err if err is not None else sys.stderr
+    options = options_from_args(args)
+    with request_logging(logging.getLevelName(args.log_level.upper()), err):
+        if args.list_passes:
+            for compiler_pass in build_pass_manager(options).passes:
+                print("%-10s %-8s %s" % (compiler_pass.name, "on" if compiler_pass.enabled else "off", compiler_pass.description), file=out)
+            return 0
+        result = compile_dot(args.dot_path, options, out)
+        if options.run:
+            out.write(result.stdout)
+            out.flush()
+        if args.time_passes:
+            print_timings(result.timings, err)
+        if args.stats:
+            print_stats(result.stats, err)
+        if options.trace_path is not None:
+            write_chrome_trace(result.stats, options.trace_path)
+        if args.cache_stats and options.cache_dir is not None:
+            artifact_cache(options).print_stats(err)
+        if args.string_stats:
+            print_string_stats(result.string_stats, err)
+        return result.exit_code
+
+def main(argv):
+    if argv[:1] == ["--serve"]:
+        return serve_main(argv[1:])
+    return run_args(parse_args(argv))
+
+def options_from_args(args):
+    """
+    Map parsed CLI arguments of main() to CompileOptions
+    """
+    native = []
+    for kind, values in (("asm", args.emit_asm), ("obj", args.emit_obj)):
+        for value in values:
+            target, separator, path = value.partition("=")
+            if not separator or target not in NATIVE_TARGETS:
+                raise ValueError("Expected TARGET=PATH with TARGET in %s: " % ", ".join(NATIVE_TARGETS), value)
+            native.append((target, kind, path))
+    codegen = args.ll_path is not None or args.run or bool(native)
+    return CompileOptions(
+        png_path=args.png_path if args.visualize else None,
+        ll_path=args.ll_path,
+        print_ir=args.ll_path is not None and not args.run,
+        codegen=codegen,
+        compact=args.compact_ast,
+        opt_level=args.opt_level,
+        opt_passes=args.passes.split(",") if args.passes else None,
+        run=args.run,
+        enable=args.enable,
+        disable=args.disable,
+        incremental=args.incremental,
+        merged_path=args.merged_path,
+        cache_dir=args.cache_dir if codegen and not args.stream else None,
+        cache_size=args.cache_size * 2**20 if args.cache_size is not None else None,
+        ssa=args.ssa,
+        native=native,
+        viz_depth=args.viz_depth,
+        viz_subtree=args.viz_subtree,
+        viz_functions=args.viz_functions,
+        viz_max_nodes=args.viz_max_nodes,
+        stats=args.stats,
+        trace_path=args.trace_path,
+        codegen_jobs=args.codegen_jobs,
+        analyze_jobs=args.analyze_jobs,
+        stream=args.stream,
+    )
+
+# Unix domain socket of the compile server, shared with a4client.py
+DEFAULT_SOCKET = os.environ.get("A4_SOCKET", os.path.join(tempfile.gettempdir(), "a4-%d.sock" % os.getuid()))
+
+class CompileRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one request of a4client.py: a JSON line {"argv": [...], "cwd": ...}, answered with
+    a JSON line {"exit_code": int, "stdout": str, "stderr": str, "seconds": float}
+    """
+    def handle(self):
+        start = time.perf_counter()
+        request = json.loads(self.rfile.readline())
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            exit_code = self.server.compile_request(request["argv"], request["cwd"], out, err)
+        except Exception:
+            exit_code = 1
+            err.write(traceback.format_exc())
+        seconds = time.perf_counter() - start
+        response = {"exit_code": exit_code, "stdout": out.getvalue(), "stderr": err.getvalue(), "seconds": seconds}
+        self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
+        if self.server.verbose:
+            print("%8.2fms  exit %d  %s" % (seconds * 1000, exit_code, " ".join(request["argv"])), file=sys.stderr)
+
+class CompileServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Compile server keeping LLVM initialized and the target machine cached between requests,
+    each request is handled in its own thread with its own CompilationContext
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, verbose=False):
+        self.verbose = verbose      # [bool] log the latency of each request to stderr
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, CompileRequestHandler)
+
+    def compile_request(self, argv, cwd, out, err):
+        try:
+            args = parse_args(argv)
+        except SystemExit as error:
+            err.write("a4.py: invalid arguments %s, see python3 a4.py --help\n" % " ".join(argv))
+            return error.code if isinstance(error.code, int) else 2
+        # the server is shared by clients in different directories, so resolve their paths here instead of chdir
+        for name in PATH_ARGS:
+            if getattr(args, name) is not None:
+                setattr(args, name, os.path.join(cwd, getattr(args, name)))
+        for name in ("emit_asm", "emit_obj"):
+            # TARGET=PATH, a value without = is reported by options_from_args
+            resolved = []
+            for value in getattr(args, name):
+                target, separator, path = value.partition("=")
+                resolved.append(target + separator + os.path.join(cwd, path) if separator else value)
+            setattr(args, name, resolved)
+        return run_args(args, out, err)
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(usage="python3 a4.py --serve [--socket PATH] [--verbose]")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix domain socket to listen on")
+    parser.add_argument("--verbose", action="store_true", help="log the latency of each request")
+    args = parser.parse_args(argv)
+    # pay LLVM initialization, the runtime library and the target machine before the first request
+    initialize_llvm()
+    host_target_machine()
+    load_runtime_library()
+    server = CompileServer(args.socket, args.verbose)
+    print("a4.py: serving on " + args.socket, file=sys.stderr)
+    # stop on kill as on Ctrl-C, so that the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,59 @@
+"""
+Thin client of the compile server started by `python3 a4.py --serve`
+
+Drop-in for a4.py: takes the same arguments, e.g.
+    python3 a4client.py <.dot> <.png after> <.ll>
+and sends them to the server, which keeps LLVM initialized between requests. It only imports
+the standard library, so it starts fast. If no server is listening, it compiles in-process with a4.py.
+
+Set A4_SOCKET to use another socket than the default one of the server,
+and A4_CLIENT_LATENCY=1 to print the latency of each request to stderr.
+"""
+import sys
+import os
+import socket
+import json
+import time
+import tempfile
+
+DEFAULT_SOCKET = os.environ.get("A4_SOCKET", os.path.join(tempfile.gettempdir(), "a4-%d.sock" % os.getuid()))
+
+def request_compile(argv, socket_path=DEFAULT_SOCKET):
+    """
+    Send one compilation to the server
+
+    Args:
+        - argv(list of str): arguments of a4.py
+        - socket_path(str): Unix domain socket of the server
+
+    Returns:
+        - dict: {"exit_code": int, "stdout": str, "stderr": str, "seconds": float}
+
+    Raises:
+        - OSError: if no server is listening on socket_path
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        request = {"argv": argv, "cwd": os.getcwd()}
+        connection.sendall(json.dumps(request).encode("utf8") + b"\n")
+        with connection.makefile("rb") as response:
+            return json.loads(response.readline())
+
+def main(argv):
+    start = time.perf_counter()
+    try:
+        response = request_compile(argv)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no server, fall back to compiling in this process
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import a4
+        return a4.main(argv)
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    if os.environ.get("A4_CLIENT_LATENCY"):
+        print("compile server: %.2fms in server, %.2fms round trip" % (
+            response["seconds"] * 1000, (time.perf_counter() - start) * 1000), file=sys.stderr)
+    return response["exit_code"]
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
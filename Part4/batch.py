@@ -0,0 +1,312 @@
+"""
+Batch driver of the Oat compiler: compile a whole corpus of programs across a process pool
+
+Each worker imports a4 and initializes LLVM once, then compiles many inputs, so the
+interpreter startup, imports and LLVM initialization are paid once per worker instead of once per file.
+A failing input is reported and does not stop the batch, and results are reported in input order.
+
+An input taking longer than the timeout (e.g. a program looping forever in --run) gets its worker killed
+and is reported as timed out.
+
+Usage:
+    python3 batch.py <dir|manifest|file>... [-o OUT_DIR] [-j JOBS] [-O LEVEL] [--run] [--timeout SECONDS] [--report report.json]
+"""
+import sys
+import os
+import argparse
+import json
+import signal
+import time
+import subprocess
+import tempfile
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import a4
+
+INPUT_SUFFIXES = (".dot", ".ast", ".oat")
+DEFAULT_TIMEOUT = 60.0
+
+class BatchInput:
+    """
+    One program of the batch
+    """
+    def __init__(self, index, path, name):
+        self.index = index      # [int] position in the batch, results are reported in this order
+        self.path = path        # [str] .dot or .oat file
+        self.name = name        # [str] path relative to the input root, without the suffix, names the outputs
+
+class BatchResult:
+    """
+    Outcome of compiling one BatchInput, plain data sent back from the workers
+    """
+    def __init__(self, index, path, ok, seconds=0.0, ir_size=0, exit_code=0, error=None):
+        self.index = index
+        self.path = path
+        self.ok = ok                # [bool] False if compiling raised or the worker crashed
+        self.seconds = seconds      # [float] wall time spent on this input in the worker
+        self.ir_size = ir_size      # [int] characters of output IR
+        self.exit_code = exit_code  # [int] exit code of main in run mode
+        self.error = error          # [str] error message (last line of the traceback) if not ok
+        self.details = None         # [str] full traceback if not ok
+
+def collect_inputs(paths):
+    """
+    Expand the command line inputs into the list of programs to compile
+
+    Args:
+        - paths(list of str): each one is a directory (searched recursively for .dot/.ast/.oat files),
+          a manifest (any other file listing one input per line, relative to the manifest, # for comments)
+          or a .dot/.ast/.oat file
+
+    Returns:
+        - list of BatchInput, in a deterministic order
+    """
+    found = []  # list of (path, name)
+    for path in paths:
+        if os.path.isdir(path):
+            matches = []
+            for directory, subdirectories, filenames in os.walk(path):
+                subdirectories.sort()
+                for filename in filenames:
+                    if filename.endswith(INPUT_SUFFIXES):
+                        matches.append(os.path.join(directory, filename))
+            for match in sorted(matches):
+                found.append((match, os.path.splitext(os.path.relpath(match, path))[0]))
+        elif path.endswith(INPUT_SUFFIXES):
+            found.append((path, os.path.splitext(os.path.basename(path))[0]))
+        elif os.path.isfile(path):
+            base = os.path.dirname(path)
+            with open(path) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    found.append((os.path.join(base, line), os.path.splitext(line)[0]))
+        else:
+            raise ValueError("no such input: " + path)
+    return [BatchInput(index, path, name) for index, (path, name) in enumerate(found)]
+
+# State of a worker process, set by init_worker
+worker_compiler = None
+worker_parser = None
+worker_out_dir = None
+worker_started = None   # shared array, worker_started[index] is the time.time() a worker started on an input, 0 before
+worker_timeout = None
+
+def init_worker(options, parser, out_dir, started, timeout):
+    global worker_compiler, worker_parser, worker_out_dir, worker_started, worker_timeout
+    # the compiler reports progress on stdout, keep the workers quiet so the summary stays readable
+    sys.stdout = open(os.devnull, "w")
+    a4.initialize_llvm()
+    if options.run:
+        a4.load_runtime_library()
+    worker_compiler = a4.Compiler(options)
+    worker_parser = parser
+    worker_out_dir = out_dir
+    worker_started = started
+    worker_timeout = timeout
+
+def parse_oat(oat_path, dot_path, parser):
+    """
+    Run the parser executable to turn a .oat program into an AST, binary if dot_path ends with .ast
+    """
+    completed = subprocess.run([parser, oat_path, dot_path], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    if completed.returncode != 0:
+        raise ValueError("parser failed on %s: %s" % (oat_path, completed.stderr.decode(errors="replace").strip()))
+
+def compile_input(batch_input):
+    """
+    Compile one input in a worker, never raises: failures are returned in the BatchResult
+    """
+    worker_started[batch_input.index] = time.time()
+    if worker_timeout is not None:
+        # the JIT runs the program in this process, where a Python exception cannot interrupt native code:
+        # SIGALRM keeps its default action and kills the worker, run_batch reports the input as timed out
+        signal.setitimer(signal.ITIMER_REAL, worker_timeout)
+    start = time.perf_counter()
+    try:
+        if batch_input.path.endswith(".oat") and worker_parser is not None:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                dot_path = os.path.join(temp_dir, "program.ast")
+                parse_oat(batch_input.path, dot_path, worker_parser)
+                result = worker_compiler.compile_dot(dot_path)
+        else:
+            result = worker_compiler.compile_dot(batch_input.path)
+        if worker_out_dir is not None:
+            output_base = os.path.join(worker_out_dir, batch_input.name)
+            os.makedirs(os.path.dirname(output_base), exist_ok=True)
+            with open(output_base + ".ll", "w") as f:
+                f.write(result.ir_text)
+            if worker_compiler.options.run:
+                with open(output_base + ".txt", "w") as f:
+                    f.write(result.stdout)
+        return BatchResult(batch_input.index, batch_input.path, True, time.perf_counter() - start,
+                           len(result.ir_text), result.exit_code)
+    except Exception as error:
+        failed = BatchResult(batch_input.index, batch_input.path, False, time.perf_counter() - start,
+                             error="%s: %s" % (type(error).__name__, error))
+        failed.details = traceback.format_exc()
+        return failed
+    finally:
+        if worker_timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def timed_out(started, timeout):
+    """
+    Returns:
+        - bool: True if a worker started on an input at time started and died after the timeout, so it was killed by it
+    """
+    return timeout is not None and started != 0 and time.time() - started >= timeout
+
+def run_batch(inputs, options, jobs=None, parser=None, out_dir=None, on_result=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Compile the inputs across a pool of warm worker processes
+
+    Args:
+        - inputs(list of BatchInput)
+        - options(a4.CompileOptions): options of every compilation, ll_path/png_path are ignored
+        - jobs(int): number of worker processes, None for the number of CPUs
+        - parser(str): parser executable for .oat inputs, None to parse them in the workers (a4.parse_oat)
+        - out_dir(str): write <name>.ll (and <name>.txt in run mode) of each input here, None to discard them
+        - on_result(function): called with each BatchResult as soon as it is done, in completion order
+        - timeout(float): seconds an input may take in a worker before it is killed and reported as timed out,
+          None to wait for every input
+
+    Returns:
+        - list of BatchResult, in input order
+    """
+    options.ll_path = None
+    options.png_path = None
+    options.print_ir = False
+    options.codegen = True
+    if parser is None and any(batch_input.path.endswith(".oat") for batch_input in inputs):
+        # build the parser library once here, instead of in every worker at the same time
+        a4.load_parser_library()
+    started = multiprocessing.Array("d", max((batch_input.index for batch_input in inputs), default=0) + 1, lock=False)
+    results = {}
+    pending = list(inputs)
+    suspects = []
+    while pending or suspects:
+        # a worker that dies (e.g. a crash in LLVM) breaks the pool and fails every unfinished input,
+        # the ones a worker had started on are suspects and are retried alone in a pool of their own,
+        # so only the input that really crashes is reported as crashed
+        isolated = bool(suspects)
+        if isolated:
+            batch = [suspects.pop(0)]
+        else:
+            batch, pending = pending, []
+        finished = len(results)
+        for batch_input in batch:
+            started[batch_input.index] = 0
+        with ProcessPoolExecutor(max_workers=1 if isolated else jobs, initializer=init_worker,
+                                 initargs=(options, parser, out_dir, started, timeout)) as executor:
+            futures = {}
+            for position, batch_input in enumerate(batch):
+                try:
+                    futures[executor.submit(compile_input, batch_input)] = batch_input
+                except BrokenProcessPool:
+                    # the pool broke while submitting, none of the rest has started
+                    pending.extend(batch[position:])
+                    break
+            for future in as_completed(futures):
+                batch_input = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    if timed_out(started[batch_input.index], timeout):
+                        result = BatchResult(batch_input.index, batch_input.path, False, time.time() - started[batch_input.index],
+                                             error="timed out after %gs" % timeout)
+                    elif isolated:
+                        result = BatchResult(batch_input.index, batch_input.path, False, error="worker process crashed")
+                    else:
+                        (suspects if started[batch_input.index] else pending).append(batch_input)
+                        continue
+                results[batch_input.index] = result
+                if on_result is not None:
+                    on_result(result)
+        if not isolated and not suspects and len(results) == finished:
+            # the pool broke before any worker got to an input, isolate all of them to make progress
+            suspects, pending = pending, []
+        suspects.sort(key=lambda batch_input: batch_input.index)
+        pending.sort(key=lambda batch_input: batch_input.index)
+    return [results[batch_input.index] for batch_input in inputs]
+
+def print_summary(results, wall_seconds, jobs, file=sys.stderr, slowest=5):
+    failed = [result for result in results if not result.ok]
+    compile_seconds = sum(result.seconds for result in results)
+    print("===  Batch compilation report  ===", file=file)
+    for result in failed:
+        print("FAILED  %s: %s" % (result.path, result.error), file=file)
+    print("%d inputs, %d succeeded, %d failed" % (len(results), len(results) - len(failed), len(failed)), file=file)
+    print("%.3fs wall, %.3fs compile time in %d workers (%.1fx)" % (
+        wall_seconds, compile_seconds, jobs, compile_seconds / wall_seconds if wall_seconds > 0 else 0.0), file=file)
+    for result in sorted(results, key=lambda result: -result.seconds)[:slowest]:
+        print("%10.4fs  %s" % (result.seconds, result.path), file=file)
+
+def write_report(results, wall_seconds, jobs, report_path):
+    """
+    Write the results as JSON, for tracking the nightly corpus
+    """
+    report = {
+        "jobs": jobs,
+        "wall_seconds": wall_seconds,
+        "succeeded": sum(1 for result in results if result.ok),
+        "failed": sum(1 for result in results if not result.ok),
+        "results": [{
+            "path": result.path,
+            "ok": result.ok,
+            "seconds": result.seconds,
+            "ir_size": result.ir_size,
+            "exit_code": result.exit_code,
+            "error": result.error,
+        } for result in results],
+    }
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+def main(argv):
+    parser = argparse.ArgumentParser(usage="python3 batch.py <dir|manifest|file>... [options]")
+    parser.add_argument("inputs", nargs="+", help="directories of .dot/.ast/.oat files, manifests or files")
+    parser.add_argument("-o", "--out-dir", help="write the IR of each input into this directory")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-O", dest="opt_level", choices=sorted(a4.OPT_LEVELS), help="optimize the LLVM IR in-process")
+    parser.add_argument("--run", action="store_true", help="also run each program with the JIT, its stdout goes to <name>.txt")
+    parser.add_argument("--compact-ast", action="store_true", help="store the ASTs in CompactTrees")
+    parser.add_argument("--ssa", action="store_true", help="generate SSA values for int/bool locals instead of allocas")
+    parser.add_argument("--cache-dir", default=os.environ.get("A4_CACHE_DIR"), help="cache the artifacts of compilations in this directory (default $A4_CACHE_DIR)")
+    parser.add_argument("--cache-size", type=int, metavar="MB", help="size bound of the cache in MiB")
+    parser.add_argument("--parser", help="parser executable for .oat inputs (default: parse them in-process)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, metavar="SECONDS",
+                        help="kill an input taking longer and report it as timed out, 0 for no limit (default %(default)s)")
+    parser.add_argument("--report", help="write a JSON report of every input to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print each result as it completes and full tracebacks")
+    args = parser.parse_args(argv)
+
+    inputs = collect_inputs(args.inputs)
+    options = a4.CompileOptions(compact=args.compact_ast, opt_level=args.opt_level, run=args.run, cache_dir=args.cache_dir,
+                                cache_size=args.cache_size * 2**20 if args.cache_size is not None else None, ssa=args.ssa)
+
+    def on_result(result):
+        print("%-6s %8.4fs  %s" % ("ok" if result.ok else "FAILED", result.seconds, result.path), file=sys.stderr)
+
+    start = time.perf_counter()
+    results = run_batch(inputs, options, args.jobs, args.parser, args.out_dir, on_result if args.verbose else None,
+                        args.timeout or None)
+    wall_seconds = time.perf_counter() - start
+    if args.verbose:
+        for result in results:
+            if result.details:
+                print(result.details, file=sys.stderr)
+    print_summary(results, wall_seconds, args.jobs)
+    if args.report:
+        write_report(results, wall_seconds, args.jobs, args.report)
+    if args.cache_dir is not None:
+        a4.artifact_cache(options).print_stats()
+    return 0 if all(result.ok for result in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,299 @@
+"""
+Throughput benchmark of the Oat compiler on synthetic programs
+
+Generates syntactically valid Oat programs of a given shape at controlled scales (10^3 to 10^6 AST nodes),
+runs them through the parser executable (binary .ast handoff, or .dot with --format dot) and every pass of a4.py,
+and appends the time and peak memory
+of each phase to a history file (one JSON object per line), so that a regression in load
+(construct_tree_from_dot), analyze (semantic_analysis) or codegen shows up against the previous run.
+The times come from compilations without --stats, whose memory tracing and handler profiling slow the passes down,
+the peak memory and counters from one more compilation with it.
+
+Shapes:
+    long        one function with a long list of statements
+    deep        nested if/else and while blocks, in chains of bounded depth
+    functions   many functions
+    strings     many string literals, a few hundred of them distinct
+
+The parser has right-recursive lists (declarations, statements), so a list of about 10000 items overflows
+the stack of bison ("memory exhausted"): long lists of statements are split into blocks of LIST_CHUNK
+statements, and functions have bodies of FUNCTION_STATEMENTS statements to stay below that many declarations.
+
+Usage:
+    python3 bench.py [--shapes long,deep] [--scales 1e3,1e4,1e5,1e6] [--repeat N] [--history FILE]
+"""
+import sys
+import os
+import argparse
+import json
+import copy
+import time
+import platform
+import subprocess
+import tempfile
+
+import a4
+
+SHAPES = ("long", "deep", "functions", "strings")
+DEFAULT_SCALES = "1e3,1e4,1e5"
+DEFAULT_PARSER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiler")
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_history.jsonl")
+# nesting depth of one chain of the deep shape, deeper chains overflow the stack of the bison parser
+DEEP_CHAIN = 200
+# statements of one block of the long and strings shapes
+LIST_CHUNK = 1000
+# statements of each function of the functions shape, 10^6 nodes make about 5000 functions
+FUNCTION_STATEMENTS = 32
+# distinct literals of the strings shape, the others repeat them and are shared by the string pool
+DISTINCT_STRINGS = 256
+# programs of CALIBRATION and twice as many units of a shape are parsed to find how many units give the wanted number of nodes
+CALIBRATION = 100
+
+def write_program(shape, units, f):
+    """
+    Write an Oat program of the given shape
+
+    Args:
+        - shape(str): one of SHAPES
+        - units(int): number of repeated parts (statements, nesting levels, functions or literals), the size grows linearly with it
+        - f(file): where the program is written
+    """
+    if shape == "functions":
+        for i in range(units):
+            f.write("int f%d() {\n    var a = %d;\n" % (i, i))
+            for j in range(FUNCTION_STATEMENTS):
+                f.write("    a = a * 2 + %d;\n" % j)
+            f.write("    return a;\n}\n")
+        f.write("int main() {\n    return 0;\n}\n")
+        return
+    f.write("int main() {\n    var v = 0;\n")
+    if shape in ("long", "strings"):
+        for i in range(units):
+            if i % LIST_CHUNK == 0:
+                f.write("if (v >= 0) {\n" if i == 0 else "} else {\nv = 0;\n}\nif (v >= 0) {\n")
+            if shape == "strings":
+                f.write('    print_string("literal %d");\n' % (i % DISTINCT_STRINGS))
+            else:
+                f.write("    v = v + %d * 3;\n" % i)
+                if i % 8 == 7:
+                    f.write("    print_int(v);\n")
+        if units > 0:
+            f.write("} else {\nv = 0;\n}\n")
+    elif shape == "deep":
+        for chain in range(0, units, DEEP_CHAIN):
+            levels = range(chain, min(units, chain + DEEP_CHAIN))
+            for i in levels:
+                if i % 2 == 0:
+                    f.write("if (v < %d) {\nv = v + 1;\n" % i)
+                else:
+                    f.write("while (v > %d) {\nv = v - 1;\n" % i)
+            for i in reversed(levels):
+                f.write("} else {\nv = v - 1;\n}\n" if i % 2 == 0 else "}\n")
+    else:
+        raise ValueError("Unknown shape: ", shape)
+    f.write("    return v;\n}\n")
+
+def parse_oat(oat_path, dot_path, parser=DEFAULT_PARSER):
+    """
+    Run the parser executable (its token listing is discarded), it exits with 0 even on syntax errors,
+    so they are found in its stderr
+
+    Returns:
+        - float: wall time of the parser
+    """
+    start = time.perf_counter()
+    completed = subprocess.run([parser, oat_path, dot_path], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    if completed.returncode != 0 or b"Syntax Error" in completed.stderr:
+        raise ValueError("parser failed on %s: %s" % (oat_path, completed.stderr.decode(errors="replace").strip()))
+    return time.perf_counter() - start
+
+def count_ast_nodes(dot_path):
+    return a4.count_nodes(a4.construct_tree_from_dot(dot_path))
+
+def units_for_nodes(shape, nodes, work_dir, parser=DEFAULT_PARSER):
+    """
+    Returns:
+        - int: number of units of write_program() giving about nodes AST nodes
+    """
+    # calibrate with whole blocks of the shape
+    calibration = {"long": LIST_CHUNK, "strings": LIST_CHUNK, "deep": DEEP_CHAIN}.get(shape, CALIBRATION)
+    sizes = []
+    for units in (calibration, 2 * calibration):
+        oat_path = os.path.join(work_dir, "calibrate.oat")
+        dot_path = os.path.join(work_dir, "calibrate.ast")
+        with open(oat_path, "w") as f:
+            write_program(shape, units, f)
+        parse_oat(oat_path, dot_path, parser)
+        sizes.append(count_ast_nodes(dot_path))
+    per_unit = (sizes[1] - sizes[0]) / calibration
+    fixed = sizes[0] - per_unit * calibration
+    return max(1, round((nodes - fixed) / per_unit))
+
+def run_benchmark(shape, scale, options, work_dir, parser=DEFAULT_PARSER, repeat=1, ast_format="ast"):
+    """
+    Generate, parse and compile one program
+
+    Args:
+        - shape(str): one of SHAPES
+        - scale(int): wanted number of AST nodes
+        - options(a4.CompileOptions): options of the compilations
+        - repeat(int): timed compilations of the program, the fastest time of each pass is kept
+        - ast_format(str): "ast" for the binary AST of the parser, "dot" for its .dot output
+
+    Returns:
+        - dict: record of the history file
+    """
+    units = units_for_nodes(shape, scale, work_dir, parser)
+    oat_path = os.path.join(work_dir, "%s-%d.oat" % (shape, scale))
+    dot_path = os.path.join(work_dir, "%s-%d.%s" % (shape, scale, ast_format))
+    start = time.perf_counter()
+    with open(oat_path, "w") as f:
+        write_program(shape, units, f)
+    generate_seconds = time.perf_counter() - start
+    parse_seconds = parse_oat(oat_path, dot_path, parser)
+    options.stats = False
+    compiler = a4.Compiler(options)
+    phases = {}
+    for _ in range(repeat):
+        result = compiler.compile_dot(dot_path)
+        for name, seconds in result.timings:
+            phase = phases.setdefault(name, {"seconds": seconds})
+            phase["seconds"] = min(phase["seconds"], seconds)
+    # tracemalloc and the handler profile would distort the times, so they only run in this compilation
+    stats_options = copy.copy(options)
+    stats_options.stats = True
+    counters = {}
+    result = compiler.compile_dot(dot_path, stats_options)
+    for pass_stats in result.stats.passes:
+        phases.setdefault(pass_stats.name, {"seconds": pass_stats.seconds})["peak_bytes"] = pass_stats.peak_bytes
+        counters.update(pass_stats.counters)
+    return {
+        "shape": shape,
+        "scale": scale,
+        "units": units,
+        "oat_bytes": os.path.getsize(oat_path),
+        "ast_bytes": os.path.getsize(dot_path),
+        "generate_seconds": generate_seconds,
+        "parse_seconds": parse_seconds,
+        "phases": phases,
+        "compile_seconds": sum(phase["seconds"] for phase in phases.values()),
+        "counters": counters,
+    }
+
+def git_commit():
+    """
+    Returns:
+        - str: commit of the working tree, None outside of a git repository
+    """
+    try:
+        completed = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return completed.stdout.strip() or None
+
+def load_history(history_path):
+    """
+    Returns:
+        - list of dict: records of the history file, oldest first
+    """
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def find_regressions(record, history, threshold, noise_seconds=0.002):
+    """
+    Compare a record with the latest earlier record of the same shape and scale
+
+    Args:
+        - threshold(float): a phase regresses when it takes more than threshold times its earlier time
+        - noise_seconds(float): differences below it are ignored
+
+    Returns:
+        - list of (str, float, float): phase, earlier seconds and new seconds of the regressed phases
+    """
+    earlier = [old for old in history if old["shape"] == record["shape"] and old["scale"] == record["scale"]]
+    if not earlier:
+        return []
+    previous = earlier[-1]
+    timings = {name: phase["seconds"] for name, phase in record["phases"].items()}
+    timings["parser"] = record["parse_seconds"]
+    old_timings = {name: phase["seconds"] for name, phase in previous["phases"].items()}
+    old_timings["parser"] = previous["parse_seconds"]
+    regressions = []
+    for name, seconds in timings.items():
+        old_seconds = old_timings.get(name)
+        if old_seconds is not None and seconds > old_seconds * threshold and seconds - old_seconds > noise_seconds:
+            regressions.append((name, old_seconds, seconds))
+    return regressions
+
+def print_record(record, regressions, file=sys.stdout):
+    phases = "  ".join("%s %.4fs/%.1fMiB" % (name, phase["seconds"], phase["peak_bytes"] / 2**20)
+                       for name, phase in record["phases"].items())
+    print("%-9s %8d nodes  parser %.4fs  %s" % (record["shape"], record["counters"].get("ast nodes", 0),
+                                                 record["parse_seconds"], phases), file=file)
+    for name, old_seconds, seconds in regressions:
+        print("    REGRESSION %s: %.4fs -> %.4fs (%.2fx)" % (name, old_seconds, seconds, seconds / old_seconds), file=file)
+
+def parse_scales(text):
+    return [int(float(scale)) for scale in text.split(",")]
+
+def main(argv):
+    parser = argparse.ArgumentParser(usage="python3 bench.py [options]")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="comma separated shapes among %s" % ", ".join(SHAPES))
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="comma separated numbers of AST nodes, e.g. 1e3,1e6 (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1, help="compilations of each program, the fastest is kept")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON lines file the results are appended to (default %(default)s)")
+    parser.add_argument("--no-history", action="store_true", help="do not append the results to the history")
+    parser.add_argument("--threshold", type=float, default=1.25, help="report a phase slower than this times its previous time")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with 1 if a phase regressed")
+    parser.add_argument("--parser", default=DEFAULT_PARSER, help="parser executable")
+    parser.add_argument("--keep", metavar="DIR", help="keep the generated .oat and AST files in DIR")
+    parser.add_argument("--format", choices=("ast", "dot"), default="ast", help="AST handed from the parser to a4.py (default %(default)s)")
+    parser.add_argument("-O", dest="opt_level", choices=sorted(a4.OPT_LEVELS), help="also optimize the LLVM IR")
+    parser.add_argument("--ssa", action="store_true", help="generate SSA values for int/bool locals")
+    parser.add_argument("--compact-ast", action="store_true", help="store the ASTs in CompactTrees")
+    parser.add_argument("--analyze-jobs", type=int, default=1, metavar="N", help="check the function bodies in N worker processes")
+    parser.add_argument("--codegen-jobs", type=int, default=1, metavar="N", help="lower the function bodies in N worker processes")
+    parser.add_argument("--stream", action="store_true", help="compile one function at a time in bounded memory (phase stream)")
+    args = parser.parse_args(argv)
+
+    shapes = args.shapes.split(",")
+    for shape in shapes:
+        if shape not in SHAPES:
+            raise ValueError("Unknown shape: ", shape)
+    history = load_history(args.history)
+    run = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(),
+           "python": platform.python_version(), "machine": platform.machine()}
+    records = []
+    regressed = False
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.keep if args.keep is not None else temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        for shape in shapes:
+            for scale in parse_scales(args.scales):
+                options = a4.CompileOptions(opt_level=args.opt_level, ssa=args.ssa, compact=args.compact_ast,
+                                            analyze_jobs=args.analyze_jobs, codegen_jobs=args.codegen_jobs, stream=args.stream)
+                record = dict(run, **run_benchmark(shape, scale, options, work_dir, args.parser, args.repeat, args.format))
+                record["options"] = {"opt_level": args.opt_level, "ssa": args.ssa, "format": args.format, "compact": args.compact_ast}
+                # serial records before these options existed stay comparable
+                if args.analyze_jobs > 1:
+                    record["options"]["analyze_jobs"] = args.analyze_jobs
+                if args.codegen_jobs > 1:
+                    record["options"]["codegen_jobs"] = args.codegen_jobs
+                if args.stream:
+                    record["options"]["stream"] = True
+                regressions = find_regressions(record, [old for old in history if old.get("options") == record["options"]], args.threshold)
+                regressed = regressed or bool(regressions)
+                print_record(record, regressions)
+                records.append(record)
+    if not args.no_history:
+        with open(args.history, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    return 1 if regressed and args.fail_on_regression else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
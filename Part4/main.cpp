@@ -24,13 +24,31 @@ extern int yylex();
 
 extern Node* root_node;
 
+/**
+ * Write the AST in the binary format if the filename ends with .ast, otherwise as a Dot file
+ */
+void export_parse_tree(Node* root, const std::string& filename) {
+    auto suffix = std::string(".ast");
+    if (filename.size() >= suffix.size() && filename.compare(filename.size() - suffix.size(), suffix.size(), suffix) == 0) {
+        export_parse_tree_to_binary(root, filename);
+    } else {
+        export_parse_tree_to_dot(root, filename);
+    }
+}
+
+/**
+ * Usage: compiler <source.oat> <output.ast|output.dot> [<debug.dot>]
+ */
 int main(int argc, char const *argv[]) {
-    if (argc == 3) {
+    if (argc == 3 || argc == 4) {
         auto source_filename = std::string(argv[1]);
-        auto dot_filename = std::string(argv[2]);
+        auto output_filename = std::string(argv[2]);
         freopen(source_filename.c_str(), "r", stdin);
         yyparse();
-        export_parse_tree_to_dot(root_node, dot_filename);
+        export_parse_tree(root_node, output_filename);
+        if (argc == 4) {
+            export_parse_tree(root_node, std::string(argv[3]));
+        }
         return 0;
     } else {
         std::cerr << "Error: invalid number of arguments\n";
@@ -14,6 +14,8 @@
 
 #include "node.hpp"
 
+#include <unordered_map>
+
 std::string symbol_class_to_str(const SymbolClass &symbol_class) {
     switch (symbol_class) {
         /* Non-terminal symbols */
@@ -114,3 +116,103 @@ void export_parse_tree_to_dot(Node* root, const std::string& filename) {
     write_parse_tree(out, root, counter);
     out << "}";
 }
+
+/**
+ * Table of distinct strings of the binary AST, each string gets the id of its first occurrence
+ */
+struct StringTable {
+    std::unordered_map<std::string, uint32_t> ids;
+    std::vector<uint32_t> offsets = {0};
+    std::string data;
+
+    uint32_t intern(const std::string& s) {
+        auto found = ids.find(s);
+        if (found != ids.end()) return found->second;
+        uint32_t id = offsets.size() - 1;
+        ids.emplace(s, id);
+        data += s;
+        offsets.push_back(data.size());
+        return id;
+    }
+};
+
+static void write_u16(std::string& out, uint16_t value) {
+    out += (char)(value & 0xff);
+    out += (char)(value >> 8);
+}
+
+static void write_u32s(std::string& out, const std::vector<uint32_t>& values) {
+    for (uint32_t value : values) {
+        for (int b = 0; b < 4; b++) out += (char)((value >> (8 * b)) & 0xff);
+    }
+}
+
+std::string serialize_parse_tree_to_binary(Node* root) {
+    StringTable strings;
+    // labels of all symbol classes come first, so that a node label fits in one byte
+    uint16_t label_count = (uint16_t)SymbolClass::STRINGLITERAL + 1;
+    for (uint16_t i = 0; i < label_count; i++) {
+        strings.intern(escape_newlines(symbol_class_to_str((SymbolClass)i)));
+    }
+    // pre-order numbering with an explicit stack
+    std::vector<Node*> order;
+    std::vector<Node*> stack;
+    if (root != nullptr) stack.push_back(root);
+    while (!stack.empty()) {
+        Node* node = stack.back();
+        stack.pop_back();
+        order.push_back(node);
+        for (auto child = node->children.rbegin(); child != node->children.rend(); ++child) {
+            if (*child != nullptr) stack.push_back(*child);
+        }
+    }
+    std::unordered_map<Node*, uint32_t> ids;
+    ids.reserve(order.size());
+    for (uint32_t i = 0; i < order.size(); i++) ids[order[i]] = i;
+
+    std::vector<unsigned char> labels(order.size());
+    std::vector<uint32_t> lexemes(order.size());
+    std::vector<uint32_t> child_starts = {0};
+    std::vector<uint32_t> child_index;
+    for (uint32_t i = 0; i < order.size(); i++) {
+        labels[i] = (unsigned char)order[i]->symbol_class;
+        lexemes[i] = strings.intern(order[i]->lexeme);
+        for (auto* child : order[i]->children) {
+            if (child != nullptr) child_index.push_back(ids[child]);
+        }
+        child_starts.push_back(child_index.size());
+    }
+    labels.resize((labels.size() + 3) / 4 * 4, 0);
+
+    std::string out = "OAST";
+    write_u16(out, BINARY_AST_VERSION);
+    write_u16(out, label_count);
+    write_u32s(out, {(uint32_t)order.size(), (uint32_t)child_index.size(),
+                     (uint32_t)strings.offsets.size() - 1, (uint32_t)strings.data.size()});
+    out.append((const char*)labels.data(), labels.size());
+    write_u32s(out, lexemes);
+    write_u32s(out, child_starts);
+    write_u32s(out, child_index);
+    write_u32s(out, strings.offsets);
+    out += strings.data;
+    return out;
+}
+
+void export_parse_tree_to_binary(Node* root, const std::string& filename) {
+    std::ofstream out(filename, std::ios::binary);
+    auto data = serialize_parse_tree_to_binary(root);
+    out.write(data.data(), data.size());
+}
+
+void delete_parse_tree(Node* root) {
+    std::vector<Node*> stack;
+    if (root != nullptr) stack.push_back(root);
+    while (!stack.empty()) {
+        Node* node = stack.back();
+        stack.pop_back();
+        for (auto* child : node->children) {
+            if (child != nullptr) stack.push_back(child);
+        }
+        delete node;
+    }
+}
@@ -19,6 +19,7 @@
 #include <fstream>
 #include <string>
 #include <vector>
+#include <cstdint>
 
 /**
  * Define all classes of symbols for Micro language,
@@ -138,4 +139,42 @@ void write_parse_tree(std::ofstream& out, Node* node, int& counter);
  */
 void export_parse_tree_to_dot(Node* root, const std::string& filename);
 
+/**
+ * Version of the binary AST format, bumped whenever its layout changes
+ */
+const uint16_t BINARY_AST_VERSION = 1;
+
+/**
+ * Export tree structure in the binary AST format read by a4.py (construct_tree_from_binary)
+ * All integers are little-endian, and every section starts 4-byte aligned:
+ *   header:          "OAST", uint16 version, uint16 label count L,
+ *                    uint32 node count N, uint32 edge count E, uint32 string count S, uint32 string bytes B
+ *   node labels:     uint8[N] id of the label string of each node (< L), padded to 4 bytes
+ *   node lexemes:    uint32[N] id of the lexeme string of each node
+ *   child starts:    uint32[N + 1] children of node i are child index[child starts[i]:child starts[i + 1]]
+ *   child index:     uint32[E]
+ *   string offsets:  uint32[S + 1] string i is string data[string offsets[i]:string offsets[i + 1]]
+ *   string data:     uint8[B] utf-8, the first L strings are the labels of all symbol classes
+ * Nodes are numbered in pre-order like in the .dot file, so node 0 is the root.
+ * The tree is walked without recursion, so deep trees do not overflow the stack.
+ * @param root: the root node of the tree to export
+ * @param filename: filename to write to
+ * @return
+ */
+void export_parse_tree_to_binary(Node* root, const std::string& filename);
+
+/**
+ * Serialize tree structure in the binary AST format into memory, see export_parse_tree_to_binary
+ * @param root: the root node of the tree to serialize
+ * @return the bytes of the binary AST
+ */
+std::string serialize_parse_tree_to_binary(Node* root);
+
+/**
+ * Delete all nodes of a tree, without recursion
+ * @param root: the root node of the tree to delete
+ * @return
+ */
+void delete_parse_tree(Node* root);
+
 #endif  // CSC4180_NODE_HPP
@@ -0,0 +1,100 @@
+/**
+ * --------------------------------------
+ * CUHK-SZ CSC4180: Compiler Construction
+ * Assignment 4: Oat v.1 Compiler Frontend
+ * --------------------------------------
+ *
+ * File: parser_binding.cpp
+ * -----------------------------
+ * C interface of the flex/bison parser, built into the shared library liboatparser.so
+ * and called by a4.py through ctypes (see load_parser_library and parse_oat in a4.py),
+ * so that .oat programs are parsed in the Python process, without the compiler executable and .dot files.
+ *
+ * The AST is returned in the binary AST format of export_parse_tree_to_binary (node.hpp).
+ * The scanner and parser keep their state in globals: calls must not run concurrently.
+ */
+
+#include <cstdarg>
+#include <cstdlib>
+#include <cstring>
+#include <sstream>
+
+#include "node.hpp"
+
+extern int yyparse();
+extern int yylineno;
+extern bool end;        // set by the scanner at the end of the input
+extern Node* root_node;
+
+typedef struct yy_buffer_state *YY_BUFFER_STATE;
+extern YY_BUFFER_STATE yy_scan_bytes(const char *bytes, int len);
+extern void yy_delete_buffer(YY_BUFFER_STATE buffer);
+
+static bool log_tokens = false;
+
+extern "C" int oat_token_printf(const char *format, ...) {
+    if (!log_tokens) return 0;
+    va_list args;
+    va_start(args, format);
+    int written = vprintf(format, args);
+    va_end(args);
+    return written;
+}
+
+/**
+ * Print the tokens on stdout while parsing, like the compiler executable does
+ * @param enabled: 0 to stop printing them (the default)
+ */
+extern "C" void oat_log_tokens(int enabled) {
+    log_tokens = enabled != 0;
+}
+
+/**
+ * Parse an Oat program
+ * @param source: the program, it does not need to end with a null character
+ * @param length: bytes of source
+ * @param ast: receives the binary AST, to be released with oat_free
+ * @param ast_length: receives the bytes of the binary AST
+ * @param error: receives the syntax errors reported by the parser (null terminated, truncated to error_length)
+ * @param error_length: size of error
+ * @return 0 on success, 1 on syntax errors
+ */
+extern "C" int oat_parse(const char *source, size_t length, unsigned char **ast, size_t *ast_length,
+                         char *error, size_t error_length) {
+    // yyerror reports on std::cerr, keep its messages for the caller
+    std::ostringstream errors;
+    auto *cerr_buffer = std::cerr.rdbuf(errors.rdbuf());
+    root_node = nullptr;
+    yylineno = 1;
+    end = false;
+    YY_BUFFER_STATE buffer = yy_scan_bytes(source, (int)length);
+    int status = yyparse();
+    yy_delete_buffer(buffer);
+    std::cerr.rdbuf(cerr_buffer);
+
+    auto messages = errors.str();
+    if (status != 0 || root_node == nullptr || !messages.empty()) {
+        if (messages.empty()) messages = "the parser did not build an AST";
+        if (error_length > 0) {
+            std::strncpy(error, messages.c_str(), error_length - 1);
+            error[error_length - 1] = '\0';
+        }
+        // the nodes of a failed parse are not reachable from root_node, they are leaked
+        root_node = nullptr;
+        return 1;
+    }
+    auto data = serialize_parse_tree_to_binary(root_node);
+    delete_parse_tree(root_node);
+    root_node = nullptr;
+    *ast = (unsigned char *)std::malloc(data.size());
+    std::memcpy(*ast, data.data(), data.size());
+    *ast_length = data.size();
+    return 0;
+}
+
+/**
+ * Release the binary AST returned by oat_parse
+ */
+extern "C" void oat_free(unsigned char *ast) {
+    std::free(ast);
+}
@@ -0,0 +1,23 @@
+/**
+ * --------------------------------------
+ * CUHK-SZ CSC4180: Compiler Construction
+ * Assignment 4: Oat v.1 Compiler Frontend
+ * --------------------------------------
+ *
+ * File: parser_binding.hpp
+ * -----------------------------
+ * Force-included (g++ -include) in every source of the parser library liboatparser.so loaded by a4.py,
+ * so that the token listing the scanner prints with printf is only written when asked for
+ * (oat_log_tokens), instead of flooding the stdout of the Python process.
+ */
+
+#ifndef CSC4180_PARSER_BINDING_HPP
+#define CSC4180_PARSER_BINDING_HPP
+
+#include <cstdio>
+
+extern "C" int oat_token_printf(const char *format, ...);
+
+#define printf oat_token_printf
+
+#endif  // CSC4180_PARSER_BINDING_HPP
@@ -0,0 +1,68 @@
+"""
+Regression tests of incremental compilation (CompileOptions.incremental): compiling the edited versions
+of a program one after the other must give the IR of a full compilation of each version
+
+Usage:
+    python3 -m unittest test_incremental
+"""
+import os
+import tempfile
+import unittest
+
+import a4
+
+MAIN = """
+int main() {
+    print_string(t);
+    print_string("c");
+    return 0;
+}
+"""
+
+class IncrementalGlobalsTest(unittest.TestCase):
+    def setUp(self):
+        a4.initialize_llvm()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.compiler = a4.Compiler()
+        # incremental compilations share the fragments of the process
+        a4.FRAGMENT_CACHE.fragments.clear()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def compile_versions(self, versions):
+        """
+        Compile each version incrementally after the ones before it, and compare it to a full compilation
+        """
+        for number, source in enumerate(versions):
+            oat_path = os.path.join(self.temp_dir.name, "v%d.oat" % number)
+            with open(oat_path, "w") as f:
+                f.write(source)
+            incremental = self.compiler.compile_dot(oat_path, a4.CompileOptions(codegen=True, incremental=True))
+            full = self.compiler.compile_dot(oat_path, a4.CompileOptions(codegen=True))
+            self.assertEqual(incremental.ir_text, full.ir_text, "version %d:\n%s" % (number, source))
+
+    def test_edit_global_string(self):
+        self.compile_versions([
+            'global s = "a";\nglobal t = "b";\n' + MAIN,
+            'global s = "a";\nglobal t = "zz";\n' + MAIN,
+            'global s = "a";\nglobal t = "b";\n' + MAIN,
+        ])
+
+    def test_reorder_globals(self):
+        self.compile_versions([
+            'global s = "a";\nglobal t = "b";\n' + MAIN,
+            'global t = "b";\nglobal s = "a";\n' + MAIN,
+            'global s = "a";\nglobal t = "b";\n' + MAIN,
+        ])
+
+    def test_remove_globals(self):
+        self.compile_versions([
+            'global s = "a";\nglobal t = "b";\n' + MAIN,
+            'global t = "b";\n' + MAIN,
+            'global s = "c";\nglobal u = "a";\nglobal t = "b";\n' + MAIN,
+            'global t = "c";\n' + MAIN,
+        ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,11 +24,9 @@ for test_idx in {0..5}; do
     output="./output/${test}.txt"
     echo "$test"
     # Visualize initial output AST and the one after semantic analysis
-    python3 ../a4.py ${parser_ast_dot} ${ast_png_after_semantic_analysis} ${self_ir}
-    ## Uncomment the following after you finish output the LLVM IR
-    # # Combine LLVM IR of source program and runtime functions into one merged IR file
-    llvm-link-10 ${self_ir} ../runtime.ll -o ${merged_ir}
-    llc -march=riscv64 ${merged_ir} -o ${assembly}
+    # Combine LLVM IR of source program and runtime functions into one merged IR file,
+    # and emit its RISC-V assembly in the same process (instead of llvm-link-10 and llc -march=riscv64)
+    python3 ../a4.py ${parser_ast_dot} ${ast_png_after_semantic_analysis} ${self_ir} --visualize --merged-ll ${merged_ir} --emit-asm riscv64=${assembly}
     riscv64-unknown-linux-gnu-gcc ${assembly} -o ${exe}
     qemu-riscv64 -L /opt/riscv/sysroot ${exe} > ${output}
 done
\ No newline at end of file